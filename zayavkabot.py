@@ -4,21 +4,43 @@ from discord.ext import commands
 from discord import app_commands
 import json
 import re
-from datetime import datetime
+from datetime import datetime, timedelta
 import traceback
 import sys
 import asyncpg
 import asyncio
+import zlib
+import gzip
+import io
+import csv
+import random
+import argparse
+import tempfile
+import time
+import functools
+import itertools
+import bisect
+import signal
+import socket
+import contextvars
+import cProfile
+import pstats
+from collections import deque, OrderedDict
+from urllib.parse import urlsplit, parse_qs
+
+# Команды командной строки, которым не нужен Discord (см. run_cli)
+CLI_COMMANDS = ("export", "import", "generate", "bench")
+CLI_MODE = __name__ == "__main__" and len(sys.argv) > 1 and sys.argv[1] in CLI_COMMANDS
 
 # Получаем данные из переменных окружения Railway
 TOKEN = os.environ.get('DISCORD_TOKEN')
-if not TOKEN:
+if not TOKEN and not CLI_MODE:
     print("❌ ОШИБКА: Переменная окружения DISCORD_TOKEN не установлена!")
     sys.exit(1)
 
 # Данные для PostgreSQL (Railway предоставляет DATABASE_URL)
 DATABASE_URL = os.environ.get('DATABASE_URL')
-if not DATABASE_URL:
+if not DATABASE_URL and not CLI_MODE:
     print("❌ ОШИБКА: Переменная окружения DATABASE_URL не установлена!")
     sys.exit(1)
 
@@ -28,7 +50,22 @@ intents.message_content = True
 intents.guilds = True
 intents.members = True
 
-bot = commands.Bot(command_prefix='!', intents=intents)
+# Шардирование: SHARD_COUNT - всего шардов, SHARD_IDS - шарды этого процесса ("0,1").
+# Несколько процессов с разными SHARD_IDS делят одну БД и координируются через нее.
+SHARD_COUNT = int(os.environ.get('SHARD_COUNT', '0'))
+SHARD_IDS = [int(x) for x in os.environ.get('SHARD_IDS', '').split(',') if x.strip()]
+
+if SHARD_COUNT:
+    bot = commands.AutoShardedBot(
+        command_prefix='!', intents=intents,
+        shard_count=SHARD_COUNT, shard_ids=SHARD_IDS or None
+    )
+else:
+    bot = commands.Bot(command_prefix='!', intents=intents)
+
+# ID основного сервера и его настройки по умолчанию
+# (другие серверы настраиваются командой /настройка)
+MAIN_GUILD_ID = 1003525677640851496
 
 # ID каналов для основного сервера
 LOGS_CHANNEL_ID = 1317565432210915379  # Канал для логов
@@ -50,18 +87,556 @@ SLASH_COMMAND_ROLE_IDS = [1310673963000528949, 1381685630555258931]
 IMAGE_URL = "https://media.discordapp.net/attachments/1189879069991510066/1449528629775302698/zastavki-gas-kvas-com-n1e0-p-zastavki-na-telefon-am-nyam-2.png?ex=694285fc&is=6941347c&hm=560b40c38fbc83ae9821b60df73fadefb0d917eb0082f53635350b686b33b605&=&format=webp&quality=lossless"
 SMALL_ICON_URL = "https://cdn.discordapp.com/attachments/1381981605848944720/1449946500057792543/4.png?ex=6940bf68&is=693f6de8&hm=df622f91cff0f82216929fb398fbc04aea2ab256c4323a18840538c0bbdabb08&"
 
+# Автоматическая обработка зависших заявок
+PENDING_SLA_HOURS = int(os.environ.get('PENDING_SLA_HOURS', '48'))  # 0 - отключено
+PENDING_SLA_ACTION = os.environ.get('PENDING_SLA_ACTION', 'escalate')  # reject / escalate
+PENDING_SLA_SWEEP_MINUTES = int(os.environ.get('PENDING_SLA_SWEEP_MINUTES', '30'))
+
+# Ограничение частоты подачи заявок
+SUBMIT_USER_BURST = int(os.environ.get('SUBMIT_USER_BURST', '3'))  # Открытий формы подряд
+SUBMIT_USER_PER_HOUR = float(os.environ.get('SUBMIT_USER_PER_HOUR', '6'))
+SUBMIT_GLOBAL_BURST = int(os.environ.get('SUBMIT_GLOBAL_BURST', '5'))  # Каналов подряд на сервер
+SUBMIT_GLOBAL_PER_MINUTE = float(os.environ.get('SUBMIT_GLOBAL_PER_MINUTE', '10'))
+SUBMIT_QUEUE_SIZE = int(os.environ.get('SUBMIT_QUEUE_SIZE', '20'))  # Очередь при превышении глобального лимита
+REJECT_COOLDOWN_HOURS = int(os.environ.get('REJECT_COOLDOWN_HOURS', '24'))  # 0 - без кулдауна
+
+# Сколько минут заявка закреплена за рекрутом после "Взять на рассмотрение" или /очередь
+CLAIM_LEASE_MINUTES = int(os.environ.get('CLAIM_LEASE_MINUTES', '30'))
+
+# Режим процесса: all - все в одном процессе, gateway - только прием взаимодействий
+# и постановка задач в очередь, worker - выполнение задач из очереди
+BOT_MODE = os.environ.get('BOT_MODE', 'all')
+JOB_WORKER_CONCURRENCY = int(os.environ.get('JOB_WORKER_CONCURRENCY', '4'))
+JOB_TIMEOUT_SECONDS = int(os.environ.get('JOB_TIMEOUT_SECONDS', '120'))
+
+# Архив переписки каналов заявок перед удалением: db / disk / off
+TRANSCRIPT_STORAGE = os.environ.get('TRANSCRIPT_STORAGE', 'db')
+TRANSCRIPT_DIR = os.environ.get('TRANSCRIPT_DIR', 'transcripts')
+TRANSCRIPT_FETCH_WINDOWS = 4  # На сколько временных окон делится история при чтении
+TRANSCRIPT_WINDOW_BUFFER = 500  # Сколько сообщений окна читается впрок
+
+# Перенос обработанных заявок старше N дней в applications_archive (0 - отключено)
+ARCHIVE_AFTER_DAYS = int(os.environ.get('ARCHIVE_AFTER_DAYS', '30'))
+ARCHIVE_BATCH_SIZE = 1000
+
 # Глобальный пул подключений к БД
 db_pool = None
 
+# Сколько секунд при остановке (SIGTERM) ждать завершения фоновых задач
+SHUTDOWN_DEADLINE_SECONDS = int(os.environ.get('SHUTDOWN_DEADLINE_SECONDS', '10'))
+
+# Флаг первичной инициализации (on_ready вызывается и при переподключениях)
+startup_done = False
+
+# ============ НАСТРОЙКИ СЕРВЕРОВ ============
+
+# Подписи полей формы по умолчанию (можно переопределить для сервера)
+DEFAULT_FORM_LABELS = {
+    "title": "Подача заявки в семью",
+    "nickname_static": "Никнейм и Статик Средний онлайн за день",
+    "ooc_info": "OOC имя и возраст",
+    "fam_history": "История семей",
+    "reason": "Почему выбрали именно нас?",
+    "rollbacks": "Откаты с ГГ (ссылки)",
+}
+DEFAULT_CHANNEL_NAME_TEMPLATE = "заявление-{name}"
+
+class GuildConfig:
+    """Настройки системы заявок для одного сервера"""
+    
+    def __init__(self, guild_id, logs_channel_id=None, applications_category_id=None,
+                 tag_role_ids=(), slash_role_ids=(), form_labels=None,
+                 channel_name_template=None):
+        self.guild_id = guild_id
+        self.logs_channel_id = logs_channel_id
+        self.applications_category_id = applications_category_id
+        # Кортеж сохраняет порядок для упоминаний, frozenset дает проверку за O(1)
+        self.tag_role_ids = tuple(tag_role_ids or ())
+        self.tag_role_set = frozenset(self.tag_role_ids)
+        self.slash_role_ids = tuple(slash_role_ids or ())
+        self.slash_role_set = frozenset(self.slash_role_ids)
+        self.form_labels = {**DEFAULT_FORM_LABELS, **(form_labels or {})}
+        self.channel_name_template = channel_name_template or DEFAULT_CHANNEL_NAME_TEMPLATE
+    
+    @classmethod
+    def from_record(cls, record):
+        return cls(
+            guild_id=record['guild_id'],
+            logs_channel_id=record['logs_channel_id'],
+            applications_category_id=record['applications_category_id'],
+            tag_role_ids=record['tag_role_ids'],
+            slash_role_ids=record['slash_role_ids'],
+            form_labels=json.loads(record['form_labels']) if record['form_labels'] else None,
+            channel_name_template=record['channel_name_template']
+        )
+    
+    def channel_name(self, discord_user):
+        clean_name = re.sub(r'[^\w\s-]', '', discord_user)
+        clean_name = re.sub(r'[-\s]+', '-', clean_name).strip().lower()
+        return self.channel_name_template.replace("{name}", clean_name)[:100]
+
+def default_guild_config(guild_id):
+    """Настройки по умолчанию: основной сервер берет их из констант выше"""
+    if guild_id == MAIN_GUILD_ID or guild_id is None:
+        return GuildConfig(
+            guild_id=MAIN_GUILD_ID,
+            logs_channel_id=LOGS_CHANNEL_ID,
+            applications_category_id=APPLICATIONS_CATEGORY_ID,
+            tag_role_ids=TAG_ROLE_IDS,
+            slash_role_ids=SLASH_COMMAND_ROLE_IDS
+        )
+    return GuildConfig(guild_id=guild_id)
+
+class GuildConfigCache:
+    """In-memory кэш настроек серверов, перечитывается по NOTIFY guild_config_changed"""
+    
+    def __init__(self):
+        self.configs = {}
+    
+    def get(self, guild_id):
+        """Настройки сервера за O(1); guild_id=None - основной сервер"""
+        config = self.configs.get(guild_id or MAIN_GUILD_ID)
+        if config is None:
+            config = self.configs[guild_id or MAIN_GUILD_ID] = default_guild_config(guild_id)
+        return config
+    
+    async def load_all(self):
+        async with db_acquire() as conn:
+            records = await conn.fetch('SELECT * FROM guild_config')
+        self.configs = {record['guild_id']: GuildConfig.from_record(record) for record in records}
+        print(f"✅ Загружены настройки серверов: {len(self.configs)}")
+    
+    async def reload(self, guild_id):
+        async with db_acquire() as conn:
+            record = await conn.fetchrow('SELECT * FROM guild_config WHERE guild_id = $1', guild_id)
+        if record:
+            self.configs[guild_id] = GuildConfig.from_record(record)
+        else:
+            self.configs.pop(guild_id, None)
+        print(f"🔄 Настройки сервера {guild_id} перечитаны")
+    
+    async def save(self, config):
+        """Сохраняет настройки и оповещает все процессы бота"""
+        async with db_acquire() as conn:
+            async with conn.transaction():
+                await conn.execute('''
+                    INSERT INTO guild_config
+                    (guild_id, logs_channel_id, applications_category_id, tag_role_ids,
+                     slash_role_ids, form_labels, channel_name_template, updated_at)
+                    VALUES ($1, $2, $3, $4, $5, $6, $7, CURRENT_TIMESTAMP)
+                    ON CONFLICT (guild_id) DO UPDATE SET
+                        logs_channel_id = EXCLUDED.logs_channel_id,
+                        applications_category_id = EXCLUDED.applications_category_id,
+                        tag_role_ids = EXCLUDED.tag_role_ids,
+                        slash_role_ids = EXCLUDED.slash_role_ids,
+                        form_labels = EXCLUDED.form_labels,
+                        channel_name_template = EXCLUDED.channel_name_template,
+                        updated_at = CURRENT_TIMESTAMP
+                ''', config.guild_id, config.logs_channel_id, config.applications_category_id,
+                list(config.tag_role_ids), list(config.slash_role_ids),
+                json.dumps(config.form_labels, ensure_ascii=False), config.channel_name_template)
+                await cluster_bus.publish('guild_config_changed', str(config.guild_id), conn)
+        self.configs[config.guild_id] = config
+    
+    def on_notify(self, payload):
+        supervisor.spawn(self.reload(int(payload)), "guild_config_reload")
+
+guild_configs = GuildConfigCache()
+
+# ============ КООРДИНАЦИЯ ПРОЦЕССОВ ============
+
+class ClusterBus:
+    """LISTEN/NOTIFY между процессами бота, использующими одну БД"""
+    
+    def __init__(self):
+        self.conn = None
+        self.handlers = {}
+        self.stopping = False
+    
+    def subscribe(self, channel, handler):
+        """handler(payload) вызывается на каждое уведомление канала"""
+        self.handlers.setdefault(channel, []).append(handler)
+    
+    async def start(self):
+        """Открывает отдельное соединение для LISTEN и переподключается при обрыве"""
+        try:
+            self.conn = await asyncpg.connect(DATABASE_URL)
+            for channel in self.handlers:
+                await self.conn.add_listener(channel, self.dispatch)
+            self.conn.add_termination_listener(self.on_termination)
+            print(f"✅ Подписка на события кластера: {', '.join(self.handlers)}")
+            # Пока подписки не было, уведомления об изменении заявок могли потеряться
+            application_cache.clear()
+            supervisor.spawn(duplicate_index.sync(), "duplicate_index_sync")
+        except Exception as e:
+            print(f"❌ Не удалось подписаться на события кластера: {e}")
+            supervisor.spawn(self.restart(), "cluster_bus_restart", service=True)
+    
+    def dispatch(self, connection, pid, channel, payload):
+        for handler in self.handlers.get(channel, []):
+            try:
+                handler(payload)
+            except Exception as e:
+                print(f"❌ Ошибка обработки события {channel}: {e}")
+    
+    def on_termination(self, connection):
+        if not bot.is_closed() and not self.stopping:
+            supervisor.spawn(self.restart(), "cluster_bus_restart", service=True)
+    
+    async def restart(self, delay=5):
+        await asyncio.sleep(delay)
+        await self.start()
+    
+    async def stop(self):
+        """Закрывает соединение подписки без переподключения"""
+        self.stopping = True
+        if self.conn is not None and not self.conn.is_closed():
+            try:
+                await asyncio.wait_for(self.conn.close(), timeout=5)
+            except Exception:
+                self.conn.terminate()
+    
+    @staticmethod
+    async def publish(channel, payload, conn=None):
+        """Отправляет уведомление (внутри транзакции conn - после ее коммита)"""
+        if conn is not None:
+            await conn.execute("SELECT pg_notify($1, $2)", channel, payload)
+            return
+        async with db_acquire() as conn:
+            await conn.execute("SELECT pg_notify($1, $2)", channel, payload)
+
+cluster_bus = ClusterBus()
+
+async def run_exclusive(lock_name, job):
+    """Выполняет job только в одном процессе (pg_try_advisory_lock); False - занято другим"""
+    key = zlib.crc32(f"zayavkabot:{lock_name}".encode())
+    async with db_acquire() as conn:
+        if not await conn.fetchval("SELECT pg_try_advisory_lock($1)", key):
+            return False
+        try:
+            await job()
+        finally:
+            await conn.execute("SELECT pg_advisory_unlock($1)", key)
+    return True
+
+def owned_guild_ids():
+    """Серверы, которые обслуживают шарды этого процесса"""
+    return [guild.id for guild in bot.guilds]
+
+def required_roles_text(guild_id):
+    """Список ролей для сообщения об отсутствии прав"""
+    role_ids = guild_configs.get(guild_id).slash_role_ids
+    if not role_ids:
+        return "права администратора сервера"
+    return " или ".join(f"<@&{role_id}>" for role_id in role_ids)
+
+# ============ ФОНОВЫЕ ЗАДАЧИ И ОСТАНОВКА ============
+
+class TaskSupervisor:
+    """Реестр фоновых задач процесса.
+    
+    service - бесконечные циклы (SLA, архив, подписки): при остановке отменяются сразу.
+    Остальные задачи при остановке дожидаются до дедлайна; незавершенные с persist=(kind, payload)
+    сохраняются в bot_jobs и выполняются после перезапуска, прочие считаются потерянными.
+    """
+    
+    def __init__(self):
+        self.tasks = {}
+        self.closing = False
+        self.stats = {"started": 0, "finished": 0, "failed": 0, "persisted": 0, "dropped": 0}
+    
+    def spawn(self, coroutine, name, persist=None, service=False):
+        """Запускает и регистрирует задачу; во время остановки новые задачи не запускаются"""
+        if self.closing:
+            coroutine.close()
+            if persist:
+                # Сохраняем, чтобы не потерять работу, пришедшую в последние секунды
+                task = asyncio.ensure_future(self.persist_jobs([persist]))
+                self.tasks[task] = ("persist", None, False)
+                self.stats["started"] += 1
+                task.add_done_callback(self.on_done)
+            else:
+                self.stats["dropped"] += 1
+            return None
+        task = asyncio.ensure_future(coroutine)
+        self.tasks[task] = (name, persist, service)
+        self.stats["started"] += 1
+        task.add_done_callback(self.on_done)
+        return task
+    
+    async def run(self, coroutine, name, persist=None):
+        """Выполняет корутину как зарегистрированную задачу и ждет результата"""
+        task = self.spawn(coroutine, name, persist)
+        if task is None:
+            return None
+        return await asyncio.shield(task)
+    
+    def on_done(self, task):
+        name, _, _ = self.tasks.pop(task, ("?", None, False))
+        if task.cancelled():
+            return
+        if task.exception() is not None:
+            self.stats["failed"] += 1
+            print(f"❌ Фоновая задача {name} завершилась с ошибкой: {task.exception()!r}")
+        else:
+            self.stats["finished"] += 1
+    
+    def in_flight(self):
+        """Количество выполняющихся задач по именам"""
+        counts = {}
+        for name, _, _ in self.tasks.values():
+            counts[name] = counts.get(name, 0) + 1
+        return counts
+    
+    def format_metrics(self):
+        in_flight = self.in_flight()
+        running = ", ".join(f"{name}: {count}" for name, count in sorted(in_flight.items())) or "нет"
+        return (f"В работе: {sum(in_flight.values())} ({running})\n"
+                f"Запущено: {self.stats['started']}, завершено: {self.stats['finished']}, "
+                f"с ошибкой: {self.stats['failed']}\n"
+                f"Сохранено при остановке: {self.stats['persisted']}, потеряно: {self.stats['dropped']}")
+    
+    async def persist_jobs(self, jobs):
+        """Записывает незавершенную работу в очередь bot_jobs"""
+        try:
+            async with db_acquire() as conn:
+                await conn.executemany('''
+                    INSERT INTO bot_jobs (kind, payload) VALUES ($1, $2)
+                ''', [(kind, json.dumps(payload, ensure_ascii=False)) for kind, payload in jobs])
+            self.stats["persisted"] += len(jobs)
+        except DB_CONNECTION_ERRORS + (DatabaseUnavailable,):
+            # БД недоступна: задачи попадут в bot_jobs после перезапуска из локального журнала
+            try:
+                db_journal.append("enqueue_jobs", {"jobs": jobs})
+                self.stats["persisted"] += len(jobs)
+            except OSError as e:
+                # Диск тоже недоступен: остановка продолжается, задачи теряются
+                self.stats["dropped"] += len(jobs)
+                print(f"❌ Не удалось записать незавершенные задачи в журнал ({len(jobs)}): {e}")
+        except Exception as e:
+            self.stats["dropped"] += len(jobs)
+            print(f"❌ Не удалось сохранить незавершенные задачи ({len(jobs)}): {e}")
+    
+    async def shutdown(self, deadline):
+        """Отменяет сервисные задачи, ждет остальные до дедлайна, незавершенные сохраняет или отменяет"""
+        self.closing = True
+        for task, (_, _, service) in list(self.tasks.items()):
+            if service:
+                task.cancel()
+                
+        pending = [task for task, (_, _, service) in self.tasks.items() if not service]
+        if pending:
+            print(f"⏳ Ожидание фоновых задач: {len(pending)} (до {deadline} с)")
+            _, pending = await asyncio.wait(pending, timeout=deadline)
+            
+        unfinished = [(task, self.tasks.get(task)) for task in pending]
+        for task, _ in unfinished:
+            task.cancel()
+        jobs = [info[1] for _, info in unfinished if info and info[1]]
+        self.stats["dropped"] += sum(1 for _, info in unfinished if not info or not info[1])
+        if jobs:
+            await self.persist_jobs(jobs)
+        await asyncio.gather(*(task for task in list(self.tasks)), return_exceptions=True)
+        print(f"✅ Фоновые задачи остановлены. {self.format_metrics()}")
+
+supervisor = TaskSupervisor()
+shutdown_done = asyncio.Event()
+
+async def close_db_pool(timeout=5):
+    """Закрывает пул подключений, при зависании - принудительно"""
+    global db_pool
+    if db_pool is None:
+        return
+    try:
+        await asyncio.wait_for(db_pool.close(), timeout=timeout)
+    except (asyncio.TimeoutError, Exception) as e:
+        print(f"⚠️ Пул БД закрыт принудительно: {e!r}")
+        db_pool.terminate()
+    db_pool = None
+
+async def graceful_shutdown(reason):
+    """Останавливает процесс: задачи, подписка, пул БД, сессия Discord"""
+    if supervisor.closing:
+        # Остановка уже идет (например, по сигналу) - дожидаемся ее
+        await shutdown_done.wait()
+        return
+    print(f"🛑 Остановка ({reason})...")
+    job_queue.wakeup.set()
+    await supervisor.shutdown(SHUTDOWN_DEADLINE_SECONDS)
+    await cluster_bus.stop()
+    await close_db_pool()
+    # bot.close закрывает gateway и HTTP-сессию discord.py
+    await bot.close()
+    shutdown_done.set()
+    print("✅ Бот остановлен")
+
+def install_shutdown_handlers():
+    """SIGTERM (редеплой) и SIGINT запускают корректную остановку"""
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, lambda sig=sig: loop.create_task(graceful_shutdown(sig.name)))
+        except NotImplementedError:
+            # Windows: обработчики сигналов в цикле событий недоступны
+            pass
+
+# ============ ТРАССИРОВКА ============
+
+TRACE_KEEP = int(os.environ.get('TRACE_KEEP', '200'))  # Сколько последних трасс хранить
+# Доля трасс, выполняемых под cProfile (для локальных замеров; 0 - выключено)
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', '0'))
+PROFILE_DIR = os.environ.get('PROFILE_DIR', 'profiles')
+
+current_trace = contextvars.ContextVar("current_trace", default=None)
+current_span_depth = contextvars.ContextVar("current_span_depth", default=0)
+
+class Trace:
+    """Трасса одного взаимодействия или задачи: список участков с длительностями"""
+    
+    __slots__ = ("trace_id", "name", "started_at", "started", "duration", "spans", "error", "finished")
+    
+    def __init__(self, trace_id, name):
+        self.trace_id = trace_id
+        self.name = name
+        self.started_at = datetime.now()
+        self.started = time.perf_counter()
+        self.duration = 0.0
+        self.spans = []
+        self.error = None
+        self.finished = False
+    
+    def add_span(self, name, started, duration, depth):
+        # Фоновые задачи могут пережить трассу - их участки уже не записываются
+        if not self.finished and len(self.spans) < 500:
+            self.spans.append((started - self.started, duration, depth, name))
+
+class TraceRecorder:
+    """Последние завершенные трассы и выборочное профилирование"""
+    
+    def __init__(self, keep):
+        self.recent = deque(maxlen=keep)
+        self.profiling = False
+        self.stats = {"traces": 0, "profiled": 0}
+    
+    def slowest(self, count):
+        return sorted(self.recent, key=lambda trace: -trace.duration)[:count]
+    
+    @staticmethod
+    def format_trace(trace, max_lines=15):
+        """Участки трассы по времени начала, с отступом по вложенности"""
+        lines = []
+        for offset, duration, depth, name in sorted(trace.spans)[:max_lines]:
+            lines.append(f"`+{offset * 1000:6.0f}` {'  ' * depth}{name}: **{duration * 1000:.1f} мс**")
+        if len(trace.spans) > max_lines:
+            lines.append(f"… еще участков: {len(trace.spans) - max_lines}")
+        if trace.error:
+            lines.append(f"❌ {trace.error}")
+        return "\n".join(lines) or "Без участков"
+
+trace_recorder = TraceRecorder(TRACE_KEEP)
+
+class span:
+    """Участок текущей трассы: with span("имя") или async with span("имя").
+    
+    Без активной трассы ничего не записывает.
+    """
+    
+    __slots__ = ("name", "trace", "started", "token")
+    
+    def __init__(self, name):
+        self.name = name
+        self.trace = None
+    
+    def __enter__(self):
+        self.trace = current_trace.get()
+        if self.trace is not None:
+            self.started = time.perf_counter()
+            self.token = current_span_depth.set(current_span_depth.get() + 1)
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        if self.trace is not None:
+            current_span_depth.reset(self.token)
+            self.trace.add_span(self.name, self.started, time.perf_counter() - self.started, current_span_depth.get())
+        return False
+    
+    async def __aenter__(self):
+        return self.__enter__()
+    
+    async def __aexit__(self, exc_type, exc, tb):
+        return self.__exit__(exc_type, exc, tb)
+
+class start_trace:
+    """Начинает трассу (async with start_trace("имя", id)); внутри другой трассы - просто участок"""
+    
+    __slots__ = ("name", "trace_id", "trace", "token", "nested", "profiler")
+    
+    def __init__(self, name, trace_id=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.profiler = None
+    
+    async def __aenter__(self):
+        self.nested = current_trace.get() is not None
+        if self.nested:
+            self.trace = span(self.name)
+            return self.trace.__enter__()
+        self.trace = Trace(self.trace_id or f"{time.time_ns():x}", self.name)
+        self.token = current_trace.set(self.trace)
+        if PROFILE_SAMPLE_RATE > 0 and not trace_recorder.profiling and random.random() < PROFILE_SAMPLE_RATE:
+            # cProfile снимает весь поток, поэтому одновременно профилируется одна трасса
+            trace_recorder.profiling = True
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        return self.trace
+    
+    async def __aexit__(self, exc_type, exc, tb):
+        if self.nested:
+            return self.trace.__exit__(exc_type, exc, tb)
+        trace = self.trace
+        trace.duration = time.perf_counter() - trace.started
+        trace.finished = True
+        if exc_type is not None:
+            trace.error = f"{exc_type.__name__}: {exc}"
+        current_trace.reset(self.token)
+        trace_recorder.recent.append(trace)
+        trace_recorder.stats["traces"] += 1
+        if self.profiler is not None:
+            self.profiler.disable()
+            trace_recorder.profiling = False
+            trace_recorder.stats["profiled"] += 1
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            path = os.path.join(PROFILE_DIR, f"{trace.name}-{trace.trace_id}.prof")
+            self.profiler.dump_stats(path)
+            print(f"📊 Профиль {trace.name} ({trace.duration * 1000:.0f} мс): {path}")
+        return False
+
+def traced(name=None):
+    """Декоратор корутины: участок трассы, а для обработчиков взаимодействий - новая трасса
+    с ID взаимодействия (slash-команды, кнопки, формы)."""
+    def decorator(func):
+        span_name = name or func.__qualname__
+        
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            if current_trace.get() is None:
+                interaction = next((arg for arg in args if isinstance(arg, discord.Interaction)), None)
+                if interaction is not None:
+                    async with start_trace(span_name, interaction.id):
+                        return await func(*args, **kwargs)
+            with span(span_name):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
 # Функция проверки прав для slash-команд
 def has_slash_command_permission(interaction: discord.Interaction):
     """Проверяет, есть ли у пользователя права на использование slash-команд"""
     try:
-        for role_id in SLASH_COMMAND_ROLE_IDS:
-            role = discord.utils.get(interaction.user.roles, id=role_id)
-            if role:
-                return True
-        return False
+        config = guild_configs.get(interaction.guild_id)
+        if not config.slash_role_set:
+            return interaction.user.guild_permissions.administrator
+        return any(role.id in config.slash_role_set for role in interaction.user.roles)
     except Exception as e:
         print(f"Ошибка проверки прав для slash-команд: {e}")
         return False
@@ -69,8 +644,9 @@ def has_slash_command_permission(interaction: discord.Interaction):
 class Application:
     def __init__(self, username_static, ooc_info, fam_history, reason, rollbacks, discord_user, discord_id, 
                  message_id=None, status="pending", channel_id=None, moderator=None, reason_reject=None,
-                 created_at=None, updated_at=None, id=None):
+                 created_at=None, updated_at=None, id=None, guild_id=None):
         self.id = id
+        self.guild_id = guild_id
         self.username_static = username_static
         self.ooc_info = ooc_info
         self.fam_history = fam_history
@@ -96,6 +672,7 @@ class Application:
             "rollbacks": self.rollbacks,
             "discord_user": self.discord_user,
             "discord_id": self.discord_id,
+            "guild_id": self.guild_id,
             "message_id": self.message_id,
             "status": self.status,
             "channel_id": self.channel_id,
@@ -105,6 +682,28 @@ class Application:
             "updated_at": self.updated_at.isoformat() if isinstance(self.updated_at, datetime) else self.updated_at
         }
 
+    @classmethod
+    def from_record(cls, record):
+        """Создает заявку из строки asyncpg"""
+        return cls(
+            id=record['id'],
+            username_static=record['username_static'],
+            ooc_info=record['ooc_info'],
+            fam_history=record['fam_history'],
+            reason=record['reason'],
+            rollbacks=record['rollbacks'],
+            discord_user=record['discord_user'],
+            discord_id=record['discord_id'],
+            message_id=record['message_id'],
+            status=record['status'],
+            channel_id=record['channel_id'],
+            moderator=record['moderator'],
+            reason_reject=record['reason_reject'],
+            created_at=record['created_at'],
+            updated_at=record['updated_at'],
+            guild_id=record.get('guild_id')
+        )
+    
     @classmethod
     def from_dict(cls, data):
         app = cls(
@@ -116,6 +715,7 @@ class Application:
             rollbacks=data["rollbacks"],
             discord_user=data["discord_user"],
             discord_id=data["discord_id"],
+            guild_id=data.get("guild_id"),
             message_id=str(data.get("message_id")) if data.get("message_id") else None,  # Преобразуем
             status=data.get("status", "pending"),
             channel_id=str(data.get("channel_id")) if data.get("channel_id") else None,  # Преобразуем
@@ -126,15 +726,613 @@ class Application:
         )
         return app
 
+# Служебные таблицы и колонки (основная таблица applications создается заранее)
+AUX_TABLES_SQL = [
+    '''
+    CREATE TABLE IF NOT EXISTS application_transcripts (
+        id BIGSERIAL PRIMARY KEY,
+        application_id INTEGER,
+        channel_id TEXT NOT NULL,
+        channel_name TEXT,
+        message_count INTEGER NOT NULL,
+        data BYTEA NOT NULL,
+        created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+    )
+    ''',
+    '''
+    CREATE INDEX IF NOT EXISTS application_transcripts_app_idx ON application_transcripts (application_id)
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS bot_jobs (
+        id BIGSERIAL PRIMARY KEY,
+        kind TEXT NOT NULL,
+        payload TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'queued',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        run_after TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        locked_until TIMESTAMP,
+        last_error TEXT,
+        duration_ms INTEGER,
+        created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        started_at TIMESTAMP,
+        finished_at TIMESTAMP
+    )
+    ''',
+    '''
+    CREATE INDEX IF NOT EXISTS bot_jobs_ready_idx ON bot_jobs (id) WHERE status IN ('queued', 'running')
+    ''',
+    # Выполненные шаги задач (ЛС, лог): повтор задачи не дублирует сообщения
+    '''
+    CREATE TABLE IF NOT EXISTS application_job_steps (
+        application_id INTEGER NOT NULL,
+        step TEXT NOT NULL,
+        done_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (application_id, step)
+    )
+    ''',
+    '''
+    ALTER TABLE applications ADD COLUMN IF NOT EXISTS guild_id BIGINT
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS guild_config (
+        guild_id BIGINT PRIMARY KEY,
+        logs_channel_id BIGINT,
+        applications_category_id BIGINT,
+        tag_role_ids BIGINT[] NOT NULL DEFAULT '{}',
+        slash_role_ids BIGINT[] NOT NULL DEFAULT '{}',
+        form_labels TEXT,
+        channel_name_template TEXT,
+        updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS application_escalations (
+        application_id INTEGER PRIMARY KEY,
+        escalated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS application_claims (
+        application_id INTEGER PRIMARY KEY,
+        moderator_id BIGINT NOT NULL,
+        moderator TEXT,
+        claimed_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        lease_until TIMESTAMP NOT NULL
+    )
+    ''',
+    # Нормализованные ссылки на откаты (поиск одних и тех же видео у разных пользователей)
+    '''
+    CREATE TABLE IF NOT EXISTS application_links (
+        application_id INTEGER NOT NULL,
+        host TEXT NOT NULL,
+        video_id TEXT NOT NULL,
+        start_seconds INTEGER,
+        url TEXT NOT NULL,
+        PRIMARY KEY (application_id, url)
+    )
+    ''',
+    '''
+    CREATE INDEX IF NOT EXISTS application_links_video_idx ON application_links (host, video_id)
+    ''',
+    # Холодный архив обработанных заявок (та же структура). Создается до индексов горячей
+    # таблицы: INCLUDING INDEXES копирует только первичный ключ
+    '''
+    CREATE TABLE IF NOT EXISTS applications_archive (LIKE applications INCLUDING INDEXES)
+    ''',
+    '''
+    ALTER TABLE applications_archive ADD COLUMN IF NOT EXISTS guild_id BIGINT
+    ''',
+    # Копия индекса pending-заявок в архиве, созданном прежним порядком: там pending не бывает
+    '''
+    DROP INDEX IF EXISTS applications_archive_created_at_idx
+    ''',
+    '''
+    CREATE INDEX IF NOT EXISTS applications_archive_discord_id_idx ON applications_archive (discord_id)
+    ''',
+    # Горячая таблица: pending и недавние заявки
+    '''
+    CREATE INDEX IF NOT EXISTS applications_pending_idx ON applications (created_at) WHERE status = 'pending'
+    ''',
+    '''
+    CREATE INDEX IF NOT EXISTS applications_discord_id_idx ON applications (discord_id)
+    ''',
+]
+
+# ============ ДОСТУП К БД ============
+
+# Пул: воркерам очереди и обработчикам взаимодействий нужны свои соединения
+DB_POOL_MIN = int(os.environ.get('DB_POOL_MIN', '2'))
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', str(max(10, JOB_WORKER_CONCURRENCY + 6))))
+DB_ACQUIRE_TIMEOUT = float(os.environ.get('DB_ACQUIRE_TIMEOUT', '10'))
+DB_COMMAND_TIMEOUT = float(os.environ.get('DB_COMMAND_TIMEOUT', '30'))
+# Кэш подготовленных запросов на соединение (0 - для pgbouncer в режиме transaction)
+DB_STATEMENT_CACHE = int(os.environ.get('DB_STATEMENT_CACHE', '256'))
+# Предохранитель: после N подряд ошибок соединения запросы сразу отклоняются на M секунд
+DB_BREAKER_THRESHOLD = int(os.environ.get('DB_BREAKER_THRESHOLD', '5'))
+DB_BREAKER_COOLDOWN = float(os.environ.get('DB_BREAKER_COOLDOWN', '15'))
+# Локальный журнал отложенных записей (на Railway стоит держать на подключенном томе)
+DB_JOURNAL_PATH = os.environ.get('DB_JOURNAL_PATH', 'db_journal.jsonl')
+
+# Ошибки, означающие недоступность БД, а не ошибку в запросе. Таймауты сюда не входят:
+# медленный запрос (command_timeout) - ошибка запроса, а не обрыв соединения
+# (с Python 3.11 TimeoutError - подкласс OSError, поэтому OSError целиком не подходит)
+DB_CONNECTION_ERRORS = (
+    ConnectionError,
+    socket.gaierror,
+    asyncpg.PostgresConnectionError,  # SQLSTATE 08xxx, в т.ч. ConnectionDoesNotExistError
+    # Класс 57 (вмешательство оператора) - кроме QueryCanceledError: это ошибка запроса
+    asyncpg.exceptions.AdminShutdownError,
+    asyncpg.exceptions.CrashShutdownError,
+    asyncpg.exceptions.CannotConnectNowError,
+    asyncpg.exceptions.TooManyConnectionsError,
+    asyncpg.exceptions.InterfaceError,
+)
+
+class DatabaseUnavailable(Exception):
+    """БД недоступна (пул не создан или сработал предохранитель)"""
+
+class DbMetrics:
+    """Время ожидания соединения и время работы с ним по функциям"""
+    
+    def __init__(self, window=1000):
+        self.acquire_waits = deque(maxlen=window)
+        self.queries = {}
+        self.errors = 0
+        self.rejected = 0
+        self.saturated = 0
+    
+    def record_query(self, name, seconds):
+        stats = self.queries.get(name)
+        if stats is None:
+            stats = self.queries[name] = {"count": 0, "total": 0.0, "max": 0.0, "recent": deque(maxlen=200)}
+        stats["count"] += 1
+        stats["total"] += seconds
+        stats["max"] = max(stats["max"], seconds)
+        stats["recent"].append(seconds)
+    
+    @staticmethod
+    def percentile(samples, fraction):
+        if not samples:
+            return 0.0
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+    
+    def format_metrics(self, top=5):
+        pool_text = f"{db_pool.get_size() - db_pool.get_idle_size()}/{db_pool.get_size()} (макс. {DB_POOL_MAX})" if db_pool else "нет"
+        lines = [
+            f"Пул: занято {pool_text}, предохранитель: {db_breaker.state}",
+            f"Ожидание соединения: p50 {self.percentile(self.acquire_waits, 0.5) * 1000:.1f} мс, "
+            f"p95 {self.percentile(self.acquire_waits, 0.95) * 1000:.1f} мс",
+            f"Ошибок: {self.errors}, отклонено предохранителем: {self.rejected}, "
+            f"пул переполнен: {self.saturated}, "
+            f"в журнале: {db_journal.pending}",
+        ]
+        slowest = sorted(self.queries.items(), key=lambda item: -self.percentile(item[1]["recent"], 0.95))[:top]
+        for name, stats in slowest:
+            lines.append(
+                f"• {name}: {stats['count']} раз, p95 {self.percentile(stats['recent'], 0.95) * 1000:.1f} мс, "
+                f"макс. {stats['max'] * 1000:.1f} мс"
+            )
+        return "\n".join(lines)
+
+db_metrics = DbMetrics()
+
+class CircuitBreaker:
+    """closed - запросы идут; open - сразу отклоняются; half_open - пропускается одна проверка"""
+    
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+    
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < self.cooldown:
+            return "open"
+        return "half_open"
+    
+    def allow(self):
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half_open" and not self.probing:
+            self.probing = True
+            return True
+        return False
+    
+    def success(self):
+        recovered = self.opened_at is not None
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        if recovered:
+            print("✅ Соединение с БД восстановлено")
+        # Запись могла уйти в журнал после единичной ошибки, не открывшей предохранитель
+        if db_journal.pending:
+            db_journal.schedule_replay()
+    
+    def release(self):
+        """Проверка в half_open закончилась без ответа о состоянии БД (отмена, другая ошибка)"""
+        self.probing = False
+    
+    def failure(self):
+        self.failures += 1
+        self.probing = False
+        if self.failures >= self.threshold or self.opened_at is not None:
+            if self.opened_at is None:
+                print(f"❌ БД недоступна, запросы приостановлены на {self.cooldown:.0f} с")
+            self.opened_at = time.monotonic()
+
+db_breaker = CircuitBreaker(DB_BREAKER_THRESHOLD, DB_BREAKER_COOLDOWN)
+
+class DbAcquire:
+    """Соединение из пула с предохранителем и метриками"""
+    
+    __slots__ = ("name", "context", "started", "span")
+    
+    def __init__(self, name):
+        self.name = name
+        self.context = None
+        self.span = span(f"db:{name}")
+    
+    async def __aenter__(self):
+        if db_pool is None or not db_breaker.allow():
+            db_metrics.rejected += 1
+            raise DatabaseUnavailable("база данных недоступна")
+        # Участок трассы охватывает ожидание пула и всю работу с соединением
+        self.span.__enter__()
+        started = time.perf_counter()
+        # Все соединения открыты и заняты: таймаут ожидания - это нагрузка, а не сбой БД
+        saturated = db_pool.get_size() >= DB_POOL_MAX and db_pool.get_idle_size() == 0
+        self.context = db_pool.acquire(timeout=DB_ACQUIRE_TIMEOUT)
+        try:
+            conn = await self.context.__aenter__()
+        except BaseException as e:
+            # Любая ошибка (в том числе отмена) должна снять флаг проверки, иначе
+            # предохранитель навсегда останется в half_open
+            self.span.__exit__(type(e), e, e.__traceback__)
+            if saturated and isinstance(e, asyncio.TimeoutError):
+                db_metrics.saturated += 1
+                db_breaker.release()
+            elif isinstance(e, DB_CONNECTION_ERRORS + (OSError, asyncio.TimeoutError)):
+                # Не удалось открыть соединение (в том числе таймаут подключения при
+                # свободном пуле): БД недоступна, вызывающий код отложит запись в журнал
+                db_metrics.errors += 1
+                db_breaker.failure()
+                raise DatabaseUnavailable(f"не удалось подключиться к базе данных: {e!r}") from e
+            else:
+                db_breaker.release()
+            raise
+        self.started = time.perf_counter()
+        db_metrics.acquire_waits.append(self.started - started)
+        return conn
+    
+    async def __aexit__(self, exc_type, exc, tb):
+        db_metrics.record_query(self.name, time.perf_counter() - self.started)
+        if exc_type is not None and issubclass(exc_type, DB_CONNECTION_ERRORS):
+            db_metrics.errors += 1
+            db_breaker.failure()
+        else:
+            db_breaker.success()
+        try:
+            return await self.context.__aexit__(exc_type, exc, tb)
+        finally:
+            self.span.__exit__(exc_type, exc, tb)
+
+def db_acquire(name=None):
+    """Замена db_pool.acquire(): время ожидания пула и время работы с соединением
+    записываются в db_metrics под именем вызывающей функции."""
+    return DbAcquire(name or sys._getframe(1).f_code.co_name)
+
+class WriteBehindJournal:
+    """Локальный журнал записей, которые не удалось выполнить из-за недоступности БД.
+    
+    Записи - строки JSON {"kind": ..., "payload": ...}; при восстановлении соединения
+    они повторяются по порядку обработчиками JOURNAL_HANDLERS.
+    """
+    
+    def __init__(self, path):
+        self.path = path
+        self.pending = 0
+        self.lock = asyncio.Lock()
+        self.replay_task = None
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as file:
+                self.pending = sum(1 for line in file if line.strip())
+    
+    def append(self, kind, payload):
+        with open(self.path, "a", encoding="utf-8") as file:
+            file.write(json.dumps({"kind": kind, "payload": payload}, ensure_ascii=False, default=str) + "\n")
+            file.flush()
+            os.fsync(file.fileno())
+        self.pending += 1
+        print(f"⚠️ Запись {kind} отложена в журнал ({self.pending} в очереди)")
+    
+    def schedule_replay(self):
+        """Запускает повтор в фоне, если он еще не идет"""
+        if self.replay_task is None or self.replay_task.done():
+            self.replay_task = supervisor.spawn(self.replay(), "db_journal_replay")
+    
+    async def replay(self):
+        """Повторяет отложенные записи; неудачные остаются в журнале"""
+        async with self.lock:
+            if not os.path.exists(self.path):
+                return 0
+            replaying = self.path + ".replay"
+            os.replace(self.path, replaying)
+            with open(replaying, encoding="utf-8") as file:
+                entries = [json.loads(line) for line in file if line.strip()]
+            self.pending = 0
+            done = 0
+            for index, entry in enumerate(entries):
+                try:
+                    await JOURNAL_HANDLERS[entry["kind"]](entry["payload"])
+                    done += 1
+                except DB_CONNECTION_ERRORS + (DatabaseUnavailable,) as e:
+                    # БД снова недоступна: возвращаем остаток в журнал
+                    print(f"⚠️ Повтор журнала прерван: {e!r}")
+                    for rest in entries[index:]:
+                        self.append(rest["kind"], rest["payload"])
+                    break
+                except Exception as e:
+                    print(f"❌ Запись журнала {entry['kind']} отброшена: {e!r}")
+            os.remove(replaying)
+            if done:
+                print(f"✅ Повторено записей из журнала: {done}")
+            return done
+
+db_journal = WriteBehindJournal(DB_JOURNAL_PATH)
+
+async def journal_save_application(payload):
+    """Повтор обновления заявки: только поля канала и сообщения, решение не перезаписывается"""
+    async with db_acquire() as conn:
+        await conn.execute('''
+            UPDATE applications SET
+                message_id = COALESCE($2, message_id),
+                channel_id = COALESCE($3, channel_id),
+                updated_at = CURRENT_TIMESTAMP
+            WHERE id = $1
+        ''', payload["id"], payload["message_id"], payload["channel_id"])
+        await applications_changed([(payload["id"], None)], conn)
+
+async def journal_enqueue_jobs(payload):
+    """Повтор постановки задач в bot_jobs"""
+    async with db_acquire() as conn:
+        await conn.executemany('''
+            INSERT INTO bot_jobs (kind, payload) VALUES ($1, $2)
+        ''', [(kind, json.dumps(job_payload, ensure_ascii=False)) for kind, job_payload in payload["jobs"]])
+
+JOURNAL_HANDLERS = {
+    "save_application": journal_save_application,
+    "enqueue_jobs": journal_enqueue_jobs,
+}
+
+def error_text(error, default):
+    """Текст ошибки для пользователя: отдельное сообщение при недоступной БД"""
+    if isinstance(error, DatabaseUnavailable) or isinstance(error, DB_CONNECTION_ERRORS):
+        return "❌ База данных временно недоступна. Пожалуйста, попробуйте через минуту."
+    return default
+
+async def reply_ephemeral(interaction, text):
+    """Скрытый ответ на взаимодействие, даже если ответ уже начат (defer)"""
+    if interaction.response.is_done():
+        await interaction.followup.send(text, ephemeral=True)
+    else:
+        await interaction.response.send_message(text, ephemeral=True)
+
+# ============ КЭШ ЗАЯВОК ============
+
+APPLICATION_CACHE_BYTES = int(os.environ.get('APPLICATION_CACHE_BYTES', str(8 * 1024 * 1024)))  # 0 - выключен
+APPLICATION_CACHE_TTL = int(os.environ.get('APPLICATION_CACHE_TTL', '600'))  # Страховка на случай потери уведомлений
+CACHE_COMPRESS_MIN = 256  # Текстовые поля длиннее этого хранятся сжатыми
+
+# Поля Application в порядке хранения; большие свободные тексты сжимаются
+CACHE_FIELDS = (
+    "id", "guild_id", "username_static", "ooc_info", "fam_history", "reason", "rollbacks",
+    "discord_user", "discord_id", "message_id", "status", "channel_id", "moderator",
+    "reason_reject", "created_at", "updated_at"
+)
+CACHE_LARGE_FIELDS = frozenset(("fam_history", "reason", "rollbacks", "reason_reject"))
+NOTIFY_CHANGES_PER_MESSAGE = 150  # Пар (id, discord_id) в одном уведомлении, ~40 байт на пару
+CACHE_ENTRY_OVERHEAD = 400  # Примерный размер кортежа, дат и служебных полей в байтах
+
+class ApplicationCache:
+    """Read-through кэш заявок по id и списков заявок по пользователю.
+    
+    LRU с бюджетом в байтах. Заявка хранится кортежем, длинные тексты - сжатыми zlib;
+    при чтении каждый раз собирается новый Application, поэтому изменения объекта
+    вызывающим кодом не портят кэш. Списки пользователя хранят только id и считаются
+    промахом, если какая-то из заявок вытеснена.
+    
+    generation растет при каждом сбросе: читающий код запоминает его до запроса к БД
+    и передает в put - данные, прочитанные до параллельного сброса, не кэшируются.
+    """
+    
+    def __init__(self, budget, ttl):
+        self.budget = budget
+        self.ttl = ttl
+        self.entries = OrderedDict()  # id -> (время, размер, кортеж полей)
+        self.user_lists = OrderedDict()  # (discord_id, guild_id, с архивом) -> (время, кортеж id)
+        self.user_keys = {}  # discord_id -> ключи user_lists этого пользователя
+        self.generation = 0
+        self.size = 0
+        self.stats = {"id_hits": 0, "id_misses": 0, "user_hits": 0, "user_misses": 0, "evictions": 0, "invalidations": 0}
+    
+    @staticmethod
+    def pack(application):
+        values = []
+        size = CACHE_ENTRY_OVERHEAD
+        for name in CACHE_FIELDS:
+            value = getattr(application, name)
+            if name in CACHE_LARGE_FIELDS and value and len(value) > CACHE_COMPRESS_MIN:
+                value = zlib.compress(value.encode("utf-8"), 6)
+            if isinstance(value, (str, bytes)):
+                size += len(value)
+            values.append(value)
+        return tuple(values), size
+    
+    @staticmethod
+    def unpack(values):
+        data = dict(zip(CACHE_FIELDS, values))
+        for name in CACHE_LARGE_FIELDS:
+            if isinstance(data[name], bytes):
+                data[name] = zlib.decompress(data[name]).decode("utf-8")
+        return Application(**data)
+    
+    def fresh(self, cached_at):
+        return time.monotonic() - cached_at < self.ttl
+    
+    def drop(self, application_id):
+        entry = self.entries.pop(application_id, None)
+        if entry is not None:
+            self.size -= entry[1]
+    
+    def get(self, application_id):
+        entry = self.entries.get(application_id)
+        if entry is not None and not self.fresh(entry[0]):
+            self.drop(application_id)
+            entry = None
+        if entry is None:
+            self.stats["id_misses"] += 1
+            return None
+        self.entries.move_to_end(application_id)
+        self.stats["id_hits"] += 1
+        return self.unpack(entry[2])
+    
+    def put(self, application, generation=None):
+        if not self.budget or application.id is None:
+            return
+        if generation is not None and generation != self.generation:
+            return
+        values, size = self.pack(application)
+        old = self.entries.pop(application.id, None)
+        if old is not None:
+            self.size -= old[1]
+        self.entries[application.id] = (time.monotonic(), size, values)
+        self.size += size
+        while self.size > self.budget and self.entries:
+            _, (_, evicted_size, _) = self.entries.popitem(last=False)
+            self.size -= evicted_size
+            self.stats["evictions"] += 1
+    
+    def get_user(self, discord_id, guild_id, include_archive):
+        key = (discord_id, guild_id, include_archive)
+        cached = self.user_lists.get(key)
+        if cached is not None and not self.fresh(cached[0]):
+            self.drop_user_list(key)
+            cached = None
+        if cached is not None:
+            applications = []
+            for application_id in cached[1]:
+                # Срок жизни проверяется и у каждой заявки списка, как в get()
+                entry = self.entries.get(application_id)
+                if entry is None or not self.fresh(entry[0]):
+                    break
+                applications.append(self.unpack(entry[2]))
+            else:
+                self.user_lists.move_to_end(key)
+                for application_id in cached[1]:
+                    self.entries.move_to_end(application_id)
+                self.stats["user_hits"] += 1
+                return applications
+        self.stats["user_misses"] += 1
+        return None
+    
+    def put_user(self, discord_id, guild_id, include_archive, applications, generation=None):
+        if not self.budget:
+            return
+        if generation is not None and generation != self.generation:
+            return
+        for application in applications:
+            self.put(application)
+        key = (discord_id, guild_id, include_archive)
+        self.user_lists[key] = (time.monotonic(), tuple(app.id for app in applications))
+        self.user_keys.setdefault(discord_id, set()).add(key)
+        # Списки без заявок ничего не весят в байтах, но их число тоже ограничено
+        while len(self.user_lists) > max(len(self.entries), 1000):
+            self.drop_user_list(next(iter(self.user_lists)))
+    
+    def drop_user_list(self, key):
+        del self.user_lists[key]
+        keys = self.user_keys.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.user_keys[key[0]]
+    
+    def invalidate(self, changes):
+        """changes - пары (id, discord_id); None в паре - неизвестно"""
+        self.generation += 1
+        for application_id, discord_id in changes:
+            if application_id is not None:
+                self.drop(application_id)
+            if discord_id is not None:
+                for key in self.user_keys.pop(discord_id, ()):
+                    del self.user_lists[key]
+            self.stats["invalidations"] += 1
+    
+    def clear(self):
+        self.generation += 1
+        self.entries.clear()
+        self.user_lists.clear()
+        self.user_keys.clear()
+        self.size = 0
+    
+    def on_notify(self, payload):
+        if payload == "*":
+            self.clear()
+        else:
+            self.invalidate(tuple(pair) for pair in json.loads(payload))
+    
+    def format_metrics(self):
+        def ratio(hits, misses):
+            total = hits + misses
+            return f"{hits / total:.0%} из {total}" if total else "нет запросов"
+        return (f"по id {ratio(self.stats['id_hits'], self.stats['id_misses'])}, "
+                f"по пользователю {ratio(self.stats['user_hits'], self.stats['user_misses'])}; "
+                f"заявок {len(self.entries)}, {self.size / 1024:.0f}/{self.budget / 1024:.0f} КБ, "
+                f"вытеснено {self.stats['evictions']}")
+
+application_cache = ApplicationCache(APPLICATION_CACHE_BYTES, APPLICATION_CACHE_TTL)
+
+async def applications_changed(changes, conn=None):
+    """Сбрасывает кэш у себя и в других процессах (уведомление уходит после коммита conn).
+    
+    changes - пары (id, discord_id) или "*" - сбросить все.
+    """
+    if changes == "*":
+        application_cache.clear()
+        await cluster_bus.publish('application_changed', "*", conn)
+        return
+    changes = [(application_id, discord_id) for application_id, discord_id in changes]
+    if not changes:
+        return
+    application_cache.invalidate(changes)
+    # Ограничение размера payload в NOTIFY - 8000 байт: большие пачки уходят частями
+    for start in range(0, len(changes), NOTIFY_CHANGES_PER_MESSAGE):
+        payload = json.dumps(changes[start:start + NOTIFY_CHANGES_PER_MESSAGE])
+        await cluster_bus.publish('application_changed', payload, conn)
+
 async def init_database():
     """Подключение к существующей базе данных (без создания таблиц)"""
     global db_pool
     try:
-        # Создаем пул подключений
-        db_pool = await asyncpg.create_pool(DATABASE_URL, min_size=1, max_size=10)
+        # Создаем пул подключений; подготовленные запросы кэшируются на каждом соединении
+        db_pool = await asyncpg.create_pool(
+            DATABASE_URL,
+            min_size=DB_POOL_MIN,
+            max_size=DB_POOL_MAX,
+            command_timeout=DB_COMMAND_TIMEOUT,
+            statement_cache_size=DB_STATEMENT_CACHE,
+            max_inactive_connection_lifetime=300
+        )
         print("✅ Подключение к PostgreSQL установлено")
         
-        async with db_pool.acquire() as conn:
+        async with db_acquire() as conn:
             # Простая проверка подключения - проверяем существование таблицы
             try:
                 await conn.fetchval("SELECT COUNT(*) FROM applications LIMIT 1")
@@ -143,15 +1341,23 @@ async def init_database():
                 print(f"❌ Таблица applications не найдена: {e}")
                 raise Exception("Таблица applications должна быть создана заранее")
             
+            # Служебные таблицы бота создаются автоматически
+            for statement in AUX_TABLES_SQL:
+                await conn.execute(statement)
+            
     except Exception as e:
         print(f"❌ Ошибка при подключении к базе данных: {e}")
         traceback.print_exc()
         raise
 
 async def save_application(application):
-    """Сохраняет заявку в базу данных"""
+    """Сохраняет заявку в базу данных.
+    
+    Если БД недоступна, обновление уже сохраненной заявки (канал, сообщение) откладывается
+    в журнал; новую заявку без БД создать нельзя - ошибка пробрасывается.
+    """
     try:
-        async with db_pool.acquire() as conn:
+        async with db_acquire() as conn:
             if application.id:
                 await conn.execute('''
                     UPDATE applications SET
@@ -182,8 +1388,8 @@ async def save_application(application):
                 record = await conn.fetchrow('''
                     INSERT INTO applications 
                     (username_static, ooc_info, fam_history, reason, rollbacks, discord_user, 
-                     discord_id, message_id, status, channel_id, moderator, reason_reject)
-                    VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12)
+                     discord_id, message_id, status, channel_id, moderator, reason_reject, guild_id)
+                    VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13)
                     RETURNING id, created_at, updated_at
                 ''',
                 application.username_static, application.ooc_info, application.fam_history,
@@ -192,190 +1398,883 @@ async def save_application(application):
                 str(application.message_id) if application.message_id else None,
                 application.status,
                 str(application.channel_id) if application.channel_id else None,
-                application.moderator, application.reason_reject)
+                application.moderator, application.reason_reject, application.guild_id)
                 
                 if record:
                     application.id = record['id']
                     application.created_at = record['created_at']
                     application.updated_at = record['updated_at']
+                    await save_rollback_links(conn, application)
+                    duplicate_index.add(application)
+            
+            await applications_changed([(application.id, application.discord_id)], conn)
                     
         print(f"✅ Заявка сохранена в БД (ID: {application.id})")
         return True
-    except Exception as e:
-        print(f"❌ Ошибка сохранения заявки: {e}")
-        traceback.print_exc()
-        return False
+    except DB_CONNECTION_ERRORS + (DatabaseUnavailable,):
+        if not application.id:
+            raise
+        db_journal.append("save_application", {
+            "id": application.id,
+            "message_id": str(application.message_id) if application.message_id else None,
+            "channel_id": str(application.channel_id) if application.channel_id else None,
+        })
+        return True
 
-async def load_applications():
-    """Загружает все заявки из базы данных"""
-    try:
-        applications_list = []
-        async with db_pool.acquire() as conn:
-            records = await conn.fetch('''
-                SELECT * FROM applications ORDER BY created_at DESC
-            ''')
-            
-            for record in records:
-                app = Application(
-                    id=record['id'],
-                    username_static=record['username_static'],
-                    ooc_info=record['ooc_info'],
-                    fam_history=record['fam_history'],
-                    reason=record['reason'],
-                    rollbacks=record['rollbacks'],
-                    discord_user=record['discord_user'],
-                    discord_id=record['discord_id'],
-                    message_id=record['message_id'],
-                    status=record['status'],
-                    channel_id=record['channel_id'],
-                    moderator=record['moderator'],
-                    reason_reject=record['reason_reject'],
-                    created_at=record['created_at'],
-                    updated_at=record['updated_at']
-                )
-                applications_list.append(app)
-        
-        print(f"✅ Загружено {len(applications_list)} заявок из БД")
-        return applications_list
-    except Exception as e:
-        print(f"❌ Ошибка загрузки заявок: {e}")
-        traceback.print_exc()
-        return []
+def guild_filter_sql(param):
+    """SQL-фильтр по серверу; старые заявки без guild_id относятся к основному серверу"""
+    return f"(${param}::BIGINT IS NULL OR COALESCE(guild_id, ${param + 1}::BIGINT) = ${param})"
 
-async def get_user_applications(discord_id):
-    """Получает заявки пользователя по discord_id"""
-    try:
-        applications_list = []
-        async with db_pool.acquire() as conn:
-            records = await conn.fetch('''
-                SELECT * FROM applications 
-                WHERE discord_id = $1 
-                ORDER BY created_at DESC
-            ''', discord_id)
-            
-            for record in records:
-                app = Application(
-                    id=record['id'],
-                    username_static=record['username_static'],
-                    ooc_info=record['ooc_info'],
-                    fam_history=record['fam_history'],
-                    reason=record['reason'],
-                    rollbacks=record['rollbacks'],
-                    discord_user=record['discord_user'],
-                    discord_id=record['discord_id'],
-                    message_id=record['message_id'],
-                    status=record['status'],
-                    channel_id=record['channel_id'],
-                    moderator=record['moderator'],
-                    reason_reject=record['reason_reject'],
-                    created_at=record['created_at'],
-                    updated_at=record['updated_at']
+async def decide_application(application, status, moderator, reason_reject=None):
+    """Атомарно переводит pending заявку в итоговый статус.
+    
+    Возвращает (True, None) при успехе, (False, аренда), если заявку рассматривает другой
+    рекрут, и (False, None), если заявку уже обработали; ошибки БД пробрасываются.
+    """
+    async with db_acquire() as conn:
+        async with conn.transaction():
+            # Та же блокировка строки, что в claim_application: аренда не появится между
+            # проверкой и решением, а следующий запрос увидит уже закоммиченные аренды
+            await conn.execute('SELECT 1 FROM applications WHERE id = $1 FOR UPDATE', application.id)
+            # Решение и снятие аренды заявки одним запросом
+            record = await conn.fetchrow('''
+                WITH decided AS (
+                    UPDATE applications SET
+                        status = $2,
+                        moderator = $3,
+                        reason_reject = $4,
+                        updated_at = CURRENT_TIMESTAMP
+                    WHERE id = $1 AND status = 'pending'
+                      AND NOT EXISTS (
+                          SELECT 1 FROM application_claims
+                          WHERE application_id = $1 AND moderator_id <> $5 AND lease_until >= CURRENT_TIMESTAMP
+                      )
+                    RETURNING id, updated_at
+                ), released AS (
+                    DELETE FROM application_claims WHERE application_id IN (SELECT id FROM decided)
                 )
-                applications_list.append(app)
-        
-        return applications_list
-    except Exception as e:
-        print(f"❌ Ошибка получения заявок пользователя: {e}")
-        return []
+                SELECT updated_at FROM decided
+            ''', application.id, status, moderator.name, reason_reject, moderator.id)
+            if not record:
+                return False, await conn.fetchrow('''
+                    SELECT * FROM application_claims
+                    WHERE application_id = $1 AND moderator_id <> $2 AND lease_until >= CURRENT_TIMESTAMP
+                ''', application.id, moderator.id)
+            await applications_changed([(application.id, application.discord_id)], conn)
+    application.status = status
+    application.moderator = moderator.name
+    application.reason_reject = reason_reject
+    application.updated_at = record['updated_at']
+    print(f"✅ Заявка {application.id}: {status} ({moderator.name})")
+    return True, None
+
+async def load_applications(guild_id=None):
+    """Загружает все заявки из базы данных (или только заявки сервера)"""
+    async with db_acquire() as conn:
+        records = await conn.fetch(f'''
+            SELECT * FROM applications
+            WHERE {guild_filter_sql(1)}
+            ORDER BY created_at DESC
+        ''', guild_id, MAIN_GUILD_ID)
+    
+    applications_list = [Application.from_record(record) for record in records]
+    print(f"✅ Загружено {len(applications_list)} заявок из БД")
+    return applications_list
+
+# Функции get_* не скрывают ошибки БД: пустой список должен означать "заявок нет",
+# а не "БД недоступна" (иначе on_submit пропустит пользователя с активной заявкой)
 
-async def get_pending_applications():
+async def get_user_applications(discord_id, guild_id=None, include_archive=False):
+    """Получает заявки пользователя по discord_id (с архивом - все, включая старые)"""
+    cached = application_cache.get_user(discord_id, guild_id, include_archive)
+    if cached is not None:
+        return cached
+    generation = application_cache.generation
+    
+    query = f'''
+        SELECT {", ".join(EXPORT_COLUMNS)} FROM applications
+        WHERE discord_id = $1 AND {guild_filter_sql(2)}
+    '''
+    if include_archive:
+        query += f'''
+        UNION ALL
+        SELECT {", ".join(EXPORT_COLUMNS)} FROM applications_archive
+        WHERE discord_id = $1 AND {guild_filter_sql(2)}
+        '''
+    async with db_acquire() as conn:
+        records = await conn.fetch(query + " ORDER BY created_at DESC", discord_id, guild_id, MAIN_GUILD_ID)
+    applications = [Application.from_record(record) for record in records]
+    application_cache.put_user(discord_id, guild_id, include_archive, applications, generation)
+    return applications
+
+async def get_pending_applications(guild_id=None):
     """Получает все заявки со статусом pending"""
-    try:
-        applications_list = []
-        async with db_pool.acquire() as conn:
-            records = await conn.fetch('''
-                SELECT * FROM applications 
-                WHERE status = 'pending'
-                ORDER BY created_at DESC
-            ''')
-            
-            for record in records:
-                app = Application(
-                    id=record['id'],
-                    username_static=record['username_static'],
-                    ooc_info=record['ooc_info'],
-                    fam_history=record['fam_history'],
-                    reason=record['reason'],
-                    rollbacks=record['rollbacks'],
-                    discord_user=record['discord_user'],
-                    discord_id=record['discord_id'],
-                    message_id=record['message_id'],
-                    status=record['status'],
-                    channel_id=record['channel_id'],
-                    moderator=record['moderator'],
-                    reason_reject=record['reason_reject'],
-                    created_at=record['created_at'],
-                    updated_at=record['updated_at']
-                )
-                applications_list.append(app)
-        
-        return applications_list
-    except Exception as e:
-        print(f"❌ Ошибка получения pending заявок: {e}")
-        return []
+    async with db_acquire() as conn:
+        records = await conn.fetch(f'''
+            SELECT * FROM applications 
+            WHERE status = 'pending' AND {guild_filter_sql(1)}
+            ORDER BY created_at DESC
+        ''', guild_id, MAIN_GUILD_ID)
+    return [Application.from_record(record) for record in records]
+
+async def get_status_counts(guild_id=None):
+    """Количество заявок по статусам (горячая таблица + архив)"""
+    async with db_acquire() as conn:
+        records = await conn.fetch(f'''
+            SELECT status, COUNT(*) AS count FROM (
+                SELECT status FROM applications WHERE {guild_filter_sql(1)}
+                UNION ALL
+                SELECT status FROM applications_archive WHERE {guild_filter_sql(1)}
+            ) AS all_applications
+            GROUP BY status
+        ''', guild_id, MAIN_GUILD_ID)
+    return {record['status']: record['count'] for record in records}
 
 async def get_application_by_id(app_id):
-    """Получает заявку по ID"""
-    try:
-        async with db_pool.acquire() as conn:
+    """Получает заявку по ID (None - такой заявки нет)"""
+    cached = application_cache.get(app_id)
+    if cached is not None:
+        return cached
+    generation = application_cache.generation
+    
+    async with db_acquire() as conn:
+        record = await conn.fetchrow('''
+            SELECT * FROM applications WHERE id = $1
+        ''', app_id)
+        if not record:
             record = await conn.fetchrow('''
-                SELECT * FROM applications WHERE id = $1
+                SELECT * FROM applications_archive WHERE id = $1
             ''', app_id)
-            
-            if record:
-                app = Application(
-                    id=record['id'],
-                    username_static=record['username_static'],
-                    ooc_info=record['ooc_info'],
-                    fam_history=record['fam_history'],
-                    reason=record['reason'],
-                    rollbacks=record['rollbacks'],
-                    discord_user=record['discord_user'],
-                    discord_id=record['discord_id'],
-                    message_id=record['message_id'],
-                    status=record['status'],
-                    channel_id=record['channel_id'],
-                    moderator=record['moderator'],
-                    reason_reject=record['reason_reject'],
-                    created_at=record['created_at'],
-                    updated_at=record['updated_at']
-                )
-                return app
-        return None
-    except Exception as e:
-        print(f"❌ Ошибка получения заявки по ID: {e}")
+    if not record:
         return None
+    application = Application.from_record(record)
+    application_cache.put(application, generation)
+    return application
 
-def has_admin_permission(user):
-    """Проверяет, есть ли у пользователя одна из админских ролей"""
-    try:
-        for role_id in TAG_ROLE_IDS:
-            role = discord.utils.get(user.roles, id=role_id)
-            if role:
-                return True
+# ============ ОГРАНИЧЕНИЕ ЧАСТОТЫ ЗАЯВОК ============
+
+class TokenBucket:
+    """Классический token bucket: capacity жетонов, пополнение rate жетонов в секунду"""
+    
+    def __init__(self, capacity, rate):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+    
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def try_acquire(self):
+        """Забирает жетон, если он есть"""
+        self.refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
         return False
+    
+    def reserve(self):
+        """Резервирует жетон в долг и возвращает время ожидания в секундах"""
+        self.refill()
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+    
+    def retry_after(self):
+        self.refill()
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+class SubmissionRateLimiter:
+    """Лимиты на открытие формы (на пользователя) и создание каналов (глобально)"""
+    
+    def __init__(self):
+        self.user_buckets = {}
+        self.global_buckets = {}  # guild_id -> TokenBucket (лимит каналов на сервер)
+        self.queued = 0
+        self.reject_cooldowns = {}  # discord_id -> datetime окончания кулдауна
+        self.metrics = {
+            "user_limited": 0,
+            "cooldown_limited": 0,
+            "global_queued": 0,
+            "global_rejected": 0,
+        }
+    
+    def check_user(self, discord_id):
+        """Возвращает 0, если форму можно открыть, иначе сколько секунд ждать"""
+        bucket = self.user_buckets.get(discord_id)
+        if bucket is None:
+            if len(self.user_buckets) > 1000:
+                self.prune()
+            bucket = self.user_buckets[discord_id] = TokenBucket(SUBMIT_USER_BURST, SUBMIT_USER_PER_HOUR / 3600)
+        if bucket.try_acquire():
+            return 0
+        self.metrics["user_limited"] += 1
+        return bucket.retry_after()
+    
+    def prune(self):
+        """Удаляет полностью восстановившиеся корзины"""
+        for discord_id, bucket in list(self.user_buckets.items()):
+            bucket.refill()
+            if bucket.tokens >= bucket.capacity:
+                del self.user_buckets[discord_id]
+    
+    def set_reject_cooldown(self, discord_id, rejected_at):
+        if REJECT_COOLDOWN_HOURS > 0:
+            self.reject_cooldowns[str(discord_id)] = rejected_at + timedelta(hours=REJECT_COOLDOWN_HOURS)
+    
+    def cooldown_left(self, discord_id, applications=None):
+        """Оставшийся кулдаун после отказа; applications - заявки пользователя из БД"""
+        until = self.reject_cooldowns.get(str(discord_id))
+        for app in applications or []:
+            # Автоотказ по истечении срока (модератор - сам бот) кулдаун не дает
+            if app.status == "rejected" and REJECT_COOLDOWN_HOURS > 0 and app.moderator != bot.user.name:
+                app_until = app.updated_at.replace(tzinfo=None) + timedelta(hours=REJECT_COOLDOWN_HOURS)
+                if until is None or app_until > until:
+                    until = app_until
+        if until is None:
+            return None
+        left = until - datetime.now()
+        if left.total_seconds() <= 0:
+            self.reject_cooldowns.pop(str(discord_id), None)
+            return None
+        self.metrics["cooldown_limited"] += 1
+        return left
+    
+    async def acquire_global(self, guild_id):
+        """Ждет жетон сервера в очереди; возвращает позицию или None при переполнении"""
+        bucket = self.global_buckets.get(guild_id)
+        if bucket is None:
+            bucket = self.global_buckets[guild_id] = TokenBucket(SUBMIT_GLOBAL_BURST, SUBMIT_GLOBAL_PER_MINUTE / 60)
+        if self.queued >= SUBMIT_QUEUE_SIZE and bucket.retry_after() > 0:
+            self.metrics["global_rejected"] += 1
+            return None
+        delay = bucket.reserve()
+        if delay <= 0:
+            return 0
+        self.queued += 1
+        self.metrics["global_queued"] += 1
+        position = self.queued
+        try:
+            await asyncio.sleep(delay)
+        finally:
+            self.queued -= 1
+        return position
+    
+    def format_metrics(self):
+        return (f"ограничено пользователей: {self.metrics['user_limited']}, "
+                f"кулдаун после отказа: {self.metrics['cooldown_limited']}, "
+                f"в очереди сейчас: {self.queued}, "
+                f"через очередь: {self.metrics['global_queued']}, "
+                f"отклонено при переполнении: {self.metrics['global_rejected']}")
+
+submission_limiter = SubmissionRateLimiter()
+
+def format_wait(seconds):
+    """Форматирует время ожидания для сообщений пользователю"""
+    minutes = max(1, round(seconds / 60))
+    if minutes < 60:
+        return f"{minutes} мин."
+    return f"{minutes // 60} ч. {minutes % 60} мин."
+
+# ============ ССЫЛКИ НА ОТКАТЫ ============
+
+ROLLBACKS_NOT_SPECIFIED = "Не указано"  # Старое значение пустого поля в БД
+
+# Ссылки с протоколом и без него для известных видеохостингов
+ROLLBACK_URL_RE = re.compile(
+    r'https?://[^\s<>"\'`()\[\]]+'
+    r'|(?<![\w./])(?:www\.|m\.)?(?:youtube\.com|youtu\.be|twitch\.tv|clips\.twitch\.tv)/[^\s<>"\'`()\[\]]+',
+    re.IGNORECASE
+)
+YOUTUBE_ID_RE = re.compile(r'^[\w-]{11}$')
+TIMESTAMP_RE = re.compile(r'^(?:(\d+)h)?(?:(\d+)m)?(?:(\d+)s?)?$')
+TIMESTAMP_CLOCK_RE = re.compile(r'^(?:(\d+):)?(\d+):(\d+)$')
+
+def parse_timestamp(value):
+    """Переводит метку времени из ссылки (90, 90s, 1m30s, 1h2m3s, 1:30) в секунды"""
+    if not value:
+        return None
+    value = value.strip().lower()
+    match = TIMESTAMP_CLOCK_RE.match(value)
+    if match:
+        hours, minutes, seconds = (int(part or 0) for part in match.groups())
+        return hours * 3600 + minutes * 60 + seconds
+    match = TIMESTAMP_RE.match(value)
+    if not match or not any(match.groups()):
+        return None
+    hours, minutes, seconds = (int(part or 0) for part in match.groups())
+    return hours * 3600 + minutes * 60 + seconds
+
+def normalize_rollback_url(raw_url):
+    """Разбирает ссылку в (хостинг, ID видео, секунда начала, каноническая ссылка) или None"""
+    url = raw_url.rstrip('.,;:!?')
+    if not re.match(r'https?://', url, re.IGNORECASE):
+        url = "https://" + url
+    try:
+        parts = urlsplit(url)
+    except ValueError:
+        return None
+    host = (parts.hostname or "").lower()
+    for prefix in ("www.", "m."):
+        if host.startswith(prefix):
+            host = host[len(prefix):]
+    path = parts.path.strip("/")
+    query = parse_qs(parts.query)
+    fragment = parse_qs(parts.fragment)
+    start = parse_timestamp((query.get("t") or query.get("start") or fragment.get("t") or [None])[0])
+    
+    if host in ("youtube.com", "music.youtube.com", "youtu.be"):
+        if host == "youtu.be":
+            video_id = path.split("/")[0]
+        elif path == "watch":
+            video_id = (query.get("v") or [""])[0]
+        elif path.split("/")[0] in ("shorts", "live", "embed") and "/" in path:
+            video_id = path.split("/")[1]
+        else:
+            video_id = ""
+        if not YOUTUBE_ID_RE.match(video_id):
+            return None
+        canonical = f"https://youtu.be/{video_id}" + (f"?t={start}" if start else "")
+        return "youtube", video_id, start, canonical
+        
+    if host in ("twitch.tv", "clips.twitch.tv"):
+        segments = path.split("/")
+        if host == "clips.twitch.tv" and segments[0]:
+            return "twitch", segments[0], None, f"https://clips.twitch.tv/{segments[0]}"
+        if len(segments) >= 3 and segments[1] == "clip":
+            return "twitch", segments[2], None, f"https://clips.twitch.tv/{segments[2]}"
+        if len(segments) >= 2 and segments[0] == "videos" and segments[1].isdigit():
+            canonical = f"https://www.twitch.tv/videos/{segments[1]}" + (f"?t={start}s" if start else "")
+            return "twitch", f"v{segments[1]}", start, canonical
+        return None
+        
+    if not host or not path:
+        return None
+    return host, path, start, url
+
+def extract_rollback_links(text):
+    """Извлекает уникальные ссылки на откаты из свободного текста поля"""
+    links = []
+    seen = set()
+    for match in ROLLBACK_URL_RE.finditer(text or ""):
+        link = normalize_rollback_url(match.group(0))
+        if link and link[3] not in seen:
+            seen.add(link[3])
+            links.append(link)
+    return links
+
+def format_timestamp(seconds):
+    """Секунды в вид 1:02:03 / 2:03"""
+    hours, rest = divmod(seconds, 3600)
+    minutes, seconds = divmod(rest, 60)
+    return f"{hours}:{minutes:02}:{seconds:02}" if hours else f"{minutes}:{seconds:02}"
+
+def format_rollback_links(links):
+    """Строки списка ссылок для embed"""
+    lines = []
+    for host, video_id, start, url in links:
+        label = host.capitalize() if host in ("youtube", "twitch") else host
+        if start:
+            label += f" с {format_timestamp(start)}"
+        lines.append(f"• [{label}]({url})")
+    return lines
+
+def rollbacks_text(application):
+    """Поле 'Откаты' без обрамления ``` и старой заглушки; пустая строка - не указано"""
+    text = (application.rollbacks or "").strip()
+    if text.startswith("```") and text.endswith("```"):
+        text = text[3:-3].strip()
+    return "" if text == ROLLBACKS_NOT_SPECIFIED else text
+
+async def save_rollback_links(conn, application):
+    """Записывает нормализованные ссылки заявки в application_links"""
+    links = extract_rollback_links(application.rollbacks)
+    if links:
+        await conn.executemany('''
+            INSERT INTO application_links (application_id, host, video_id, start_seconds, url)
+            VALUES ($1, $2, $3, $4, $5)
+            ON CONFLICT DO NOTHING
+        ''', [(application.id, *link) for link in links])
+    return len(links)
+
+async def find_reused_links(links, guild_id, exclude_discord_id=None, limit=25):
+    """Ищет заявки других пользователей сервера с теми же видео (по индексу host, video_id)"""
+    if not links:
+        return []
+    async with db_acquire() as conn:
+        return await conn.fetch(f'''
+            WITH wanted AS (
+                SELECT * FROM unnest($1::text[], $2::text[]) AS w(host, video_id)
+            ), apps AS (
+                SELECT id, discord_id, discord_user, username_static, status, created_at FROM applications
+                WHERE {guild_filter_sql(5)}
+                UNION ALL
+                SELECT id, discord_id, discord_user, username_static, status, created_at FROM applications_archive
+                WHERE {guild_filter_sql(5)}
+            )
+            SELECT l.host, l.video_id, l.url, a.id AS application_id, a.discord_id, a.discord_user,
+                   a.username_static, a.status, a.created_at
+            FROM wanted w
+            JOIN application_links l ON l.host = w.host AND l.video_id = w.video_id
+            JOIN apps a ON a.id = l.application_id
+            WHERE $3::TEXT IS NULL OR a.discord_id <> $3
+            ORDER BY a.created_at DESC
+            LIMIT $4
+        ''', [link[0] for link in links], [link[1] for link in links], exclude_discord_id, limit,
+        guild_id, MAIN_GUILD_ID)
+
+async def backfill_rollback_links(batch_size=500):
+    """Фоновая задача: разбирает ссылки старых заявок, у которых их еще нет в таблице"""
+    total = 0
+    last_id = 0
+    try:
+        while True:
+            async with db_acquire() as conn:
+                records = await conn.fetch('''
+                    SELECT id, rollbacks FROM (
+                        SELECT id, rollbacks FROM applications
+                        UNION ALL
+                        SELECT id, rollbacks FROM applications_archive
+                    ) a
+                    WHERE id > $1 AND rollbacks ~* '(https?://|youtu|twitch)'
+                      AND NOT EXISTS (SELECT 1 FROM application_links l WHERE l.application_id = a.id)
+                    ORDER BY id
+                    LIMIT $2
+                ''', last_id, batch_size)
+                if not records:
+                    break
+                rows = [
+                    (record['id'], *link)
+                    for record in records
+                    for link in extract_rollback_links(record['rollbacks'])
+                ]
+                if rows:
+                    await conn.executemany('''
+                        INSERT INTO application_links (application_id, host, video_id, start_seconds, url)
+                        VALUES ($1, $2, $3, $4, $5)
+                        ON CONFLICT DO NOTHING
+                    ''', rows)
+                total += len(rows)
+                last_id = records[-1]['id']
+        if total:
+            print(f"✅ Разобрано ссылок на откаты из старых заявок: {total}")
+    except Exception as e:
+        print(f"❌ Ошибка разбора ссылок на откаты: {e}")
+        traceback.print_exc()
+
+def render_rollbacks(application, limit=1024):
+    """Значение поля 'Откаты' для embed: чистый список ссылок и комментарий, не длиннее limit"""
+    text = rollbacks_text(application)
+    if not text:
+        return ROLLBACKS_NOT_SPECIFIED
+    lines = format_rollback_links(extract_rollback_links(text))
+    comment = " ".join(ROLLBACK_URL_RE.sub(" ", text).split())
+    if not lines:
+        return text if len(text) <= limit else text[:limit - 3] + "..."
+    if re.search(r'[^\W\d_]{3,}', comment):
+        lines.append(comment if len(comment) <= 200 else comment[:197] + "...")
+    value = ""
+    for index, line in enumerate(lines):
+        candidate = value + ("\n" if value else "") + line
+        left = len(lines) - index - 1
+        # Оставляем место под "… и еще N", чтобы его можно было дописать на любом шаге
+        if len(candidate) + (len(f"\n… и еще {left}") if left else 0) > limit:
+            return value + f"\n… и еще {left + 1}"
+        value = candidate
+    return value
+
+# ============ ОТРИСОВКА EMBED ============
+
+# Ограничения Discord на embed
+EMBED_TITLE_LIMIT = 256
+EMBED_DESCRIPTION_LIMIT = 4096
+EMBED_FIELD_NAME_LIMIT = 256
+EMBED_FIELD_VALUE_LIMIT = 1024
+EMBED_FOOTER_LIMIT = 2048
+EMBED_MAX_FIELDS = 25
+EMBED_TOTAL_LIMIT = 6000
+
+STATUS_LABELS = {
+    "pending": ("⏳", "На рассмотрении"),
+    "approved": ("✅", "Принята"),
+    "rejected": ("❌", "Отклонена"),
+}
+
+def truncate(text, limit):
+    """Обрезает текст до limit символов с многоточием"""
+    text = str(text) if text is not None else ""
+    if len(text) <= limit:
+        return text
+    return text[:limit - 1] + "…" if limit > 0 else ""
+
+def field(name, value, inline=False, code=False, limit=EMBED_FIELD_VALUE_LIMIT):
+    """Описание поля для render_embed.
+    
+    value - строка или функция limit -> строка (для значений, которые сами умеют сокращаться,
+    например список ссылок). code=True оборачивает значение в ```.
+    """
+    return name, value, inline, code, limit
+
+def allocate_budget(sizes, budget):
+    """Делит budget символов между частями желаемых размеров sizes.
+    
+    Короткие части получают все, что просят, остаток поровну делится между длинными.
+    Один проход по частям, отсортированным по размеру.
+    """
+    allocated = [0] * len(sizes)
+    left = len(sizes)
+    for index in sorted(range(len(sizes)), key=sizes.__getitem__):
+        allocated[index] = min(sizes[index], max(budget // left, 0))
+        budget -= allocated[index]
+        left -= 1
+    return allocated
+
+def render_embed(title=None, fields=(), description=None, color=None, timestamp=None,
+                 footer=None, footer_icon=None, image=None):
+    """Собирает embed, гарантированно укладываясь в лимиты полей и общий лимит 6000 символов"""
+    footer = truncate(footer, EMBED_FOOTER_LIMIT) if footer else None
+    fields = list(fields)[:EMBED_MAX_FIELDS]
+    
+    # Гибкие части: заголовок, описание, названия и значения полей; подвал и ``` - фиксированная стоимость
+    parts = []
+    fixed = len(footer or "")
+    if title:
+        parts.append((title, EMBED_TITLE_LIMIT, False))
+    if description:
+        parts.append((description, EMBED_DESCRIPTION_LIMIT, False))
+    inlines = []
+    for name, value, inline, code, limit in fields:
+        inlines.append(inline)
+        wrapper = 6 if code else 0
+        fixed += wrapper
+        parts.append((name, EMBED_FIELD_NAME_LIMIT, False))
+        parts.append((value, min(limit, EMBED_FIELD_VALUE_LIMIT) - wrapper, code))
+        
+    texts = []
+    for value, cap, code in parts:
+        text = value(cap) if callable(value) else (str(value) if value not in (None, "") else "-")
+        if code:
+            text = text.replace("```", "'''")
+        texts.append(text)
+        
+    allocated = allocate_budget([min(len(text), cap) for text, (_, cap, _) in zip(texts, parts)],
+                                EMBED_TOTAL_LIMIT - fixed)
+    rendered = []
+    for text, (value, cap, code), size in zip(texts, parts, allocated):
+        if len(text) > size:
+            text = value(size) if callable(value) else truncate(text, size)
+            if len(text) > size:
+                text = truncate(text, size)
+        rendered.append(f"```{text}```" if code else text or "-")
+        
+    embed = discord.Embed(title=rendered.pop(0) if title else None, color=color, timestamp=timestamp)
+    if description:
+        embed.description = rendered.pop(0)
+    for index, inline in enumerate(inlines):
+        embed.add_field(name=rendered[2 * index], value=rendered[2 * index + 1], inline=inline)
+    if footer:
+        embed.set_footer(text=footer, icon_url=footer_icon)
+    if image:
+        embed.set_image(url=image)
+    return embed
+
+@functools.lru_cache(maxsize=1)
+def panel_embed():
+    """Embed панели подачи заявки: статичный, собирается один раз"""
+    return render_embed(
+        title="**ЗАЯВКА В СЕМЬЮ**",
+        color=discord.Color.from_rgb(0, 0, 0),
+        fields=[field(
+            "**<a:wave:1449952532129517570> Путь в семью начинается здесь!**\n\u200b",
+            "**<:outputonlinepngtools:1449964820999700721> После заполнения анкеты Вам придет оповещение в ЛС от бота с результатом (ответ не придёт, если закрыт доступ к сообщениям в discord) **\n\n"
+            "-# Заявка рассматривается в течении суток. САЙГИ ОБЯЗАТЕЛЬНЫ."
+        )],
+        image=IMAGE_URL,
+        footer="Amnyamov famq",
+        footer_icon=SMALL_ICON_URL
+    )
+
+def application_fields(application, compact=False):
+    """Поля анкеты заявки; compact - сокращенный вид для логов"""
+    limit = 500 if compact else EMBED_FIELD_VALUE_LIMIT
+    code = not compact
+    fields = [
+        field("Никнейм Статик", application.username_static, code=code),
+        field("OOC имя возраст", application.ooc_info, code=code),
+        field("История семей", application.fam_history, code=code, limit=limit),
+    ]
+    if application.reason or not compact:
+        fields.append(field("Почему выбрали именно нас?" if not compact else "Причина выбора",
+                            application.reason, code=code, limit=limit))
+    if rollbacks_text(application) or not compact:
+        fields.append(field("Откаты с ГГ", lambda size: render_rollbacks(application, size), limit=limit))
+    fields += [
+        field("Пользователь", f"<@{application.discord_id}>"),
+        field("Username", application.discord_user, inline=True, code=code),
+        field("ID", application.discord_id, inline=True, code=code),
+    ]
+    return fields
+
+def render_application_embed(application, extra_fields=()):
+    """Embed заявки для канала рассмотрения"""
+    return render_embed(
+        title="Заявление",
+        color=discord.Color.blue(),
+        timestamp=application.created_at,
+        fields=application_fields(application) + list(extra_fields)
+    )
+
+def render_status_line(status):
+    """'⏳ На рассмотрении' и т.п."""
+    emoji, text = STATUS_LABELS.get(status, ("•", status))
+    return f"{emoji} {text}"
+
+def run_render_benchmark(count=2000):
+    """Микробенчмарк отрисовки embed (python zayavkabot.py bench)"""
+    long_text = "длинная история семей " * 60
+    samples = [
+        Application("Test User 12345", "Тест 20", "кратко", "потому что", "https://youtu.be/dQw4w9WgXcQ?t=90",
+                    "test_user", "100000000000000000"),
+        Application("Test User 12345 " * 10, "Тест 20 " * 20, long_text, long_text,
+                    "\n".join(f"https://youtu.be/{i:011d}?t={i}" for i in range(60)) + " " + long_text,
+                    "test_user", "100000000000000000"),
+    ]
+    moderator = discord.Object(id=1)
+    duplicates = [field("⚠️ Возможные дубликаты", "• <@1> (`dup`): статик 12345\n" * 40)]
+    cases = [
+        ("panel_embed", lambda app: panel_embed()),
+        ("render_application_embed", lambda app: render_application_embed(app, duplicates)),
+        ("build_log_embed", lambda app: build_log_embed(app, moderator, "rejected", long_text)),
+        ("render_rollbacks", lambda app: render_rollbacks(app)),
+    ]
+    for name, render in cases:
+        for app in samples:
+            embed = render(app)
+            if isinstance(embed, discord.Embed):
+                assert len(embed) <= EMBED_TOTAL_LIMIT, (name, len(embed))
+                assert all(len(f.value) <= EMBED_FIELD_VALUE_LIMIT for f in embed.fields), name
+            started = time.perf_counter()
+            for _ in range(count):
+                render(app)
+            elapsed = (time.perf_counter() - started) / count * 1e6
+            print(f"{name:<26} {len(app.fam_history):>5} симв. анкеты -> {len(embed):>5} симв. embed: {elapsed:8.1f} мкс")
+
+# ============ ПОИСК ДУБЛИКАТОВ ============
+
+# Параметры MinHash: 32 корзины одного хеша (one permutation hashing), LSH из 8 полос по 4 строки
+MINHASH_PERMUTATIONS = 32
+MINHASH_BAND_ROWS = 4
+# Корзины - равные диапазоны 64-битного hash(): нижние границы
+MINHASH_BOUNDS = [-(1 << 63) + (index << 64) // MINHASH_PERMUTATIONS for index in range(MINHASH_PERMUTATIONS)]
+DUPLICATE_TEXT_THRESHOLD = 0.6  # Порог похожести текста анкеты
+DUPLICATE_MIN_TEXT_LENGTH = 40  # Короткие ответы ("нет", "-") не сравниваем
+# Догрузка после обрыва подписки берет заявки с created_at не раньше последней
+# известной минус запас: created_at ставится в начале транзакции, а не при коммите
+DUPLICATE_SYNC_OVERLAP_MINUTES = 10
+DUPLICATE_LOAD_PAGE = 200  # Строк между передачами управления циклу событий при загрузке
+WORD_RE = re.compile(r'[^\W_]+')
+DUPLICATE_COLUMNS = "id, username_static, fam_history, reason, discord_user, discord_id, guild_id, created_at"
+
+def normalize_static_ids(username_static):
+    """Извлекает статики (числа от 3 цифр) из поля 'Никнейм Статик'"""
+    return set(re.findall(r'\d{3,}', username_static or ""))
+
+def normalize_nickname(username_static):
+    """Возвращает никнейм в нижнем регистре без статика и лишних символов"""
+    head = re.split(r'\d', username_static or "", maxsplit=1)[0]
+    words = re.findall(r'[^\W\d_]+', head.lower())
+    nickname = " ".join(words[:2])
+    return nickname if len(nickname) >= 3 else None
+
+def text_signature(*texts):
+    """Считает MinHash-сигнатуру по словам и парам соседних слов свободных полей.
+    
+    Каждый шингл хешируется один раз (hash() случаен между процессами, но сигнатуры
+    сравниваются только внутри процесса). Минимум корзины - первый хеш не меньше ее
+    границы в отсортированном списке; у пустой корзины это минимум следующей непустой.
+    """
+    words = WORD_RE.findall(" ".join(t or "" for t in texts).lower())
+    if sum(map(len, words)) + len(words) < DUPLICATE_MIN_TEXT_LENGTH:
+        return None
+    hashes = sorted(set(map(hash, itertools.chain(words, zip(words, words[1:])))))
+    signature = []
+    for bound in MINHASH_BOUNDS:
+        position = bisect.bisect_left(hashes, bound)
+        signature.append(hashes[position] if position < len(hashes) else hashes[0])
+    return tuple(signature)
+
+class DuplicateIndex:
+    """In-memory индекс заявок для поиска дубликатов и твинков.
+    
+    Новые заявки приходят через уведомления application_changed (после коммита, поэтому
+    порядок id не важен); полная загрузка и догрузка пропущенного - в sync().
+    """
+    
+    def __init__(self):
+        self.entries = {}  # id -> (discord_id, discord_user, signature, guild_id)
+        self.by_static = {}
+        self.by_nickname = {}
+        self.bands = {}
+        self.loaded = False
+        self.max_id = 0
+        self.watermark = None  # Самый поздний created_at в индексе
+        self.lock = asyncio.Lock()
+    
+    def add(self, application):
+        """Добавляет заявку в индекс (повторное добавление игнорируется)"""
+        if not application.id or application.id in self.entries:
+            return
+        signature = text_signature(application.fam_history, application.reason)
+        self.entries[application.id] = (str(application.discord_id), application.discord_user, signature,
+                                        application.guild_id or MAIN_GUILD_ID)
+        for static_id in normalize_static_ids(application.username_static):
+            self.by_static.setdefault(static_id, set()).add(application.id)
+        nickname = normalize_nickname(application.username_static)
+        if nickname:
+            self.by_nickname.setdefault(nickname, set()).add(application.id)
+        if signature:
+            for band, key in enumerate(self._band_keys(signature)):
+                self.bands.setdefault((band, key), set()).add(application.id)
+        self.max_id = max(self.max_id, application.id)
+        if self.watermark is None or application.created_at > self.watermark:
+            self.watermark = application.created_at
+    
+    def find(self, application, limit=5):
+        """Ищет похожие заявки от других discord-аккаунтов"""
+        matches = {}
+        for static_id in normalize_static_ids(application.username_static):
+            for app_id in self.by_static.get(static_id, ()):
+                matches.setdefault(app_id, []).append(f"статик {static_id}")
+        nickname = normalize_nickname(application.username_static)
+        if nickname:
+            for app_id in self.by_nickname.get(nickname, ()):
+                matches.setdefault(app_id, []).append("никнейм")
+        signature = text_signature(application.fam_history, application.reason)
+        if signature:
+            candidates = set()
+            for band, key in enumerate(self._band_keys(signature)):
+                candidates.update(self.bands.get((band, key), ()))
+            for app_id in candidates:
+                other = self.entries[app_id][2]
+                similarity = sum(a == b for a, b in zip(signature, other)) / MINHASH_PERMUTATIONS
+                if similarity >= DUPLICATE_TEXT_THRESHOLD:
+                    matches.setdefault(app_id, []).append(f"текст анкеты {round(similarity * 100)}%")
+                    
+        discord_id = str(application.discord_id)
+        guild_id = application.guild_id or MAIN_GUILD_ID
+        result = []
+        for app_id, reasons in sorted(matches.items(), key=lambda item: (-len(item[1]), -item[0])):
+            other_discord_id, other_user, _, other_guild_id = self.entries[app_id]
+            if other_discord_id == discord_id or app_id == application.id or other_guild_id != guild_id:
+                continue
+            if any(other_discord_id == r[1] for r in result):
+                continue
+            result.append((app_id, other_discord_id, other_user, reasons))
+            if len(result) >= limit:
+                break
+        return result
+    
+    async def load(self, where, *args):
+        """Добавляет в индекс заявки (и архивные), подходящие под условие where.
+        
+        Строки читаются курсором; каждые DUPLICATE_LOAD_PAGE строк управление отдается
+        циклу событий, чтобы полная загрузка при запуске не останавливала gateway.
+        """
+        count = 0
+        async with db_acquire() as conn:
+            async with conn.transaction():
+                query = f'''
+                    SELECT {DUPLICATE_COLUMNS} FROM applications WHERE {where}
+                    UNION ALL
+                    SELECT {DUPLICATE_COLUMNS} FROM applications_archive WHERE {where}
+                '''
+                async for record in conn.cursor(query, *args, prefetch=DUPLICATE_LOAD_PAGE):
+                    self.add(Application(
+                        id=record['id'],
+                        username_static=record['username_static'],
+                        ooc_info=None,
+                        fam_history=record['fam_history'],
+                        reason=record['reason'],
+                        rollbacks=None,
+                        discord_user=record['discord_user'],
+                        discord_id=record['discord_id'],
+                        guild_id=record['guild_id'],
+                        created_at=record['created_at']
+                    ))
+                    count += 1
+                    if count % DUPLICATE_LOAD_PAGE == 0:
+                        await asyncio.sleep(0)
+        return count
+    
+    async def sync(self):
+        """Первый раз загружает все заявки, затем догружает пропущенные уведомлениями"""
+        async with self.lock:
+            try:
+                if not self.loaded or self.watermark is None:
+                    # Первая загрузка или пустые таблицы: догружать не от чего
+                    count = await self.load("TRUE")
+                    self.loaded = True
+                    return count
+                since = self.watermark - timedelta(minutes=DUPLICATE_SYNC_OVERLAP_MINUTES)
+                return await self.load("id > $1 OR created_at >= $2", self.max_id, since)
+            except Exception as e:
+                print(f"❌ Ошибка обновления индекса дубликатов: {e}")
+                return 0
+    
+    async def load_ids(self, application_ids):
+        try:
+            await self.load("id = ANY($1::int[])", application_ids)
+        except Exception as e:
+            print(f"❌ Ошибка обновления индекса дубликатов: {e}")
+    
+    def on_notify(self, payload):
+        """application_changed: догружаем заявки, которых еще нет в индексе"""
+        if payload == "*":
+            supervisor.spawn(self.sync(), "duplicate_index_sync")
+            return
+        missing = [application_id for application_id, _ in json.loads(payload)
+                   if application_id is not None and application_id not in self.entries]
+        if missing:
+            supervisor.spawn(self.load_ids(missing), "duplicate_index_load")
+    
+    @staticmethod
+    def _band_keys(signature):
+        for start in range(0, MINHASH_PERMUTATIONS, MINHASH_BAND_ROWS):
+            yield signature[start:start + MINHASH_BAND_ROWS]
+
+duplicate_index = DuplicateIndex()
+
+def has_admin_permission(user):
+    """Проверяет, есть ли у пользователя одна из админских ролей"""
+    try:
+        config = guild_configs.get(user.guild.id)
+        if not config.tag_role_set:
+            return user.guild_permissions.administrator
+        return any(role.id in config.tag_role_set for role in user.roles)
     except Exception as e:
         print(f"Ошибка проверки прав: {e}")
         return False
 
+@traced()
 async def create_application_channel(guild, discord_user, discord_id, application):
     """Создает канал для заявки в указанной категории"""
     try:
-        clean_name = re.sub(r'[^\w\s-]', '', discord_user)
-        clean_name = re.sub(r'[-\s]+', '-', clean_name).strip().lower()
-        
-        channel_name = f"заявление-{clean_name}"
+        config = guild_configs.get(guild.id)
+        channel_name = config.channel_name(discord_user)
         
-        category = guild.get_channel(APPLICATIONS_CATEGORY_ID)
+        category = await resolve_channel(config.applications_category_id)
         if not category:
             category = await guild.create_category("Заявки")
+            config.applications_category_id = category.id
+            await guild_configs.save(config)
         
         overwrites = {
             guild.default_role: discord.PermissionOverwrite(read_messages=False),
-            guild.me: discord.PermissionOverwrite(read_messages=True, send_messages=True, manage_channels=True)
+            (guild.me or await guild.fetch_member(bot.user.id)): discord.PermissionOverwrite(read_messages=True, send_messages=True, manage_channels=True)
         }
         
-        for role_id in TAG_ROLE_IDS:
+        for role_id in config.tag_role_ids:
             role = guild.get_role(role_id)
             if role:
                 overwrites[role] = discord.PermissionOverwrite(
@@ -402,19 +2301,542 @@ async def create_application_channel(guild, discord_user, discord_id, applicatio
         print(f"Ошибка создания канала: {e}")
         raise
 
-async def delete_application_channel(channel, delay_seconds=5):
-    """Удаляет канал заявки с задержкой"""
-    await asyncio.sleep(delay_seconds)
+# ============ АРХИВ ПЕРЕПИСКИ ============
+
+def serialize_message(message):
+    """Компактное представление сообщения для транскрипта"""
+    data = {
+        "id": message.id,
+        "author_id": message.author.id,
+        "author": message.author.name,
+        "created_at": message.created_at.isoformat(),
+        "content": message.content,
+    }
+    if message.attachments:
+        data["attachments"] = [attachment.url for attachment in message.attachments]
+    if message.embeds:
+        data["embeds"] = [embed.to_dict() for embed in message.embeds]
+    return data
+
+async def fetch_channel_history(channel):
+    """Читает историю канала параллельно по временным окнам (от старых к новым)"""
+    start = discord.utils.time_snowflake(channel.created_at)
+    end = discord.utils.time_snowflake(discord.utils.utcnow())
+    step = max(1, (end - start) // TRANSCRIPT_FETCH_WINDOWS)
+    bounds = [start + step * i for i in range(TRANSCRIPT_FETCH_WINDOWS)] + [None]
+    # Не больше двух окон одновременно: запросы истории делят один rate limit канала
+    semaphore = asyncio.Semaphore(2)
+    # Окна отдаются по порядку, как только готовы; очереди ограничены, поэтому
+    # в памяти не больше TRANSCRIPT_WINDOW_BUFFER сообщений на окно
+    queues = [asyncio.Queue(maxsize=TRANSCRIPT_WINDOW_BUFFER) for _ in range(TRANSCRIPT_FETCH_WINDOWS)]
+    
+    async def fetch_window(queue, after, before):
+        try:
+            async with semaphore:
+                async for message in channel.history(
+                    limit=None,
+                    after=discord.Object(id=after - 1),
+                    before=discord.Object(id=before) if before else None,
+                    oldest_first=True
+                ):
+                    await queue.put(message)
+            await queue.put(None)
+        except Exception as e:
+            await queue.put(e)
+            
+    tasks = [
+        asyncio.create_task(fetch_window(queues[i], bounds[i], bounds[i + 1]))
+        for i in range(TRANSCRIPT_FETCH_WINDOWS)
+    ]
+    try:
+        for queue in queues:
+            while True:
+                item = await queue.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+    finally:
+        for task in tasks:
+            task.cancel()
+
+@traced()
+async def archive_channel_transcript(channel, application_id=None):
+    """Сохраняет переписку канала заявки в сжатый JSONL (в БД или на диск)"""
+    if TRANSCRIPT_STORAGE == "off":
+        return None
+        
+    if application_id is None:
+        async with db_acquire() as conn:
+            application_id = await conn.fetchval(
+                'SELECT id FROM applications WHERE channel_id = $1 ORDER BY id DESC LIMIT 1', str(channel.id)
+            )
+            
+    buffer = io.BytesIO()
+    count = 0
+    with gzip.GzipFile(fileobj=buffer, mode="wb") as archive:
+        async for message in fetch_channel_history(channel):
+            archive.write(json.dumps(serialize_message(message), ensure_ascii=False).encode() + b"\n")
+            count += 1
+    data = buffer.getvalue()
+    
+    if TRANSCRIPT_STORAGE == "disk":
+        path = os.path.join(TRANSCRIPT_DIR, f"{application_id or 'channel'}-{channel.id}.jsonl.gz")
+        
+        def write_file():
+            os.makedirs(TRANSCRIPT_DIR, exist_ok=True)
+            with open(path, "wb") as file:
+                file.write(data)
+                
+        await asyncio.to_thread(write_file)
+    else:
+        async with db_acquire() as conn:
+            await conn.execute('''
+                INSERT INTO application_transcripts (application_id, channel_id, channel_name, message_count, data)
+                VALUES ($1, $2, $3, $4, $5)
+            ''', application_id, str(channel.id), channel.name, count, data)
+            
+    print(f"✅ Переписка канала {channel.name} сохранена: {count} сообщений, {len(data)} байт")
+    return count
+
+async def load_transcript(application_id):
+    """Возвращает (имя файла, сжатые данные) последнего транскрипта заявки"""
+    if TRANSCRIPT_STORAGE == "disk":
+        
+        def read_latest():
+            # Имя файла: <id заявки>-<id канала>.jsonl.gz; ID каналов растут со временем,
+            # поэтому последний транскрипт - с наибольшим числовым ID канала
+            prefix = f"{application_id}-"
+            names = os.listdir(TRANSCRIPT_DIR) if os.path.isdir(TRANSCRIPT_DIR) else []
+            indexed = []
+            for name in names:
+                index = name[len(prefix):].split(".", 1)[0]
+                if name.startswith(prefix) and index.isdigit():
+                    indexed.append((int(index), name))
+            if not indexed:
+                return None
+            _, name = max(indexed)
+            with open(os.path.join(TRANSCRIPT_DIR, name), "rb") as file:
+                return name, file.read()
+                
+        return await asyncio.to_thread(read_latest)
+    async with db_acquire() as conn:
+        record = await conn.fetchrow('''
+            SELECT channel_id, data FROM application_transcripts
+            WHERE application_id = $1 ORDER BY id DESC LIMIT 1
+        ''', application_id)
+    if not record:
+        return None
+    return f"{application_id}-{record['channel_id']}.jsonl.gz", record['data']
+
+@traced()
+async def delete_application_channel(channel, delay_seconds=5, reason="Заявка обработана", application_id=None):
+    """Сохраняет переписку и удаляет канал заявки с задержкой"""
+    started = time.monotonic()
     try:
-        await channel.delete(reason="Заявка обработана")
+        # Архивация идет во время задержки, поэтому удаление почти не откладывается
+        await archive_channel_transcript(channel, application_id)
+    except Exception as e:
+        print(f"Ошибка архивации переписки канала: {e}")
+        traceback.print_exc()
+    await asyncio.sleep(max(0, delay_seconds - (time.monotonic() - started)))
+    try:
+        await channel.delete(reason=reason)
+        return True
     except Exception as e:
         print(f"Ошибка при удалении канала: {e}")
+        return False
+
+async def gather_limited(coroutines, limit=5):
+    """Выполняет корутины пачкой с ограничением параллельности"""
+    semaphore = asyncio.Semaphore(limit)
+    
+    async def run(coroutine):
+        async with semaphore:
+            return await coroutine
+            
+    return await asyncio.gather(*(run(c) for c in coroutines), return_exceptions=True)
+
+APPROVED_DM_TEXT = "🎉 **Вы приняты в семью!** 🎉\n\nДобро пожаловать! Ожидайте дальнейших инструкций от администрации."
+REJECTED_DM_TEXT = (
+    "❌ **Ваша заявка отклонена.**\n\n**Причина:** {reason}\n\n"
+    "Вы можете подать заявку снова после устранения указанных замечаний."
+)
+
+@traced()
+async def send_user_dm(discord_id, text):
+    """Отправляет личное сообщение пользователю; False - не удалось (ошибка только логируется)"""
+    try:
+        user = await bot.fetch_user(int(discord_id))
+        await user.send(text)
+        return True
+    except Exception as e:
+        print(f"Не удалось отправить сообщение пользователю: {e}")
+        return False
+
+# ============ АВТООБРАБОТКА ЗАВИСШИХ ЗАЯВОК ============
+
+@traced()
+async def sweep_stale_applications():
+    """Отклоняет или эскалирует заявки серверов этого процесса, ожидающие дольше PENDING_SLA_HOURS"""
+    reason = f"Заявка не была рассмотрена в течение {PENDING_SLA_HOURS} ч."
+    
+    async with db_acquire() as conn:
+        if PENDING_SLA_ACTION == "reject":
+            # Один UPDATE на весь проход, аренды снимаются тем же запросом
+            records = await conn.fetch('''
+                WITH decided AS (
+                    UPDATE applications SET
+                        status = 'rejected',
+                        moderator = $2,
+                        reason_reject = $3,
+                        updated_at = CURRENT_TIMESTAMP
+                    WHERE status = 'pending'
+                      AND created_at < CURRENT_TIMESTAMP - make_interval(hours => $1)
+                      AND COALESCE(guild_id, $4::BIGINT) = ANY($5::BIGINT[])
+                    RETURNING *
+                ), released AS (
+                    DELETE FROM application_claims WHERE application_id IN (SELECT id FROM decided)
+                )
+                SELECT * FROM decided
+            ''', PENDING_SLA_HOURS, bot.user.name, reason, MAIN_GUILD_ID, owned_guild_ids())
+            await applications_changed([(record['id'], record['discord_id']) for record in records], conn)
+        else:
+            # Эскалируем каждую заявку только один раз
+            records = await conn.fetch('''
+                WITH escalated AS (
+                    INSERT INTO application_escalations (application_id)
+                    SELECT id FROM applications
+                    WHERE status = 'pending'
+                      AND created_at < CURRENT_TIMESTAMP - make_interval(hours => $1)
+                      AND COALESCE(guild_id, $2::BIGINT) = ANY($3::BIGINT[])
+                    ON CONFLICT DO NOTHING
+                    RETURNING application_id
+                )
+                SELECT a.* FROM applications a
+                JOIN escalated e ON e.application_id = a.id
+                ORDER BY a.created_at
+            ''', PENDING_SLA_HOURS, MAIN_GUILD_ID, owned_guild_ids())
+            
+    applications = [Application.from_record(record) for record in records]
+    if not applications:
+        return applications
+        
+    by_guild = {}
+    for app in applications:
+        by_guild.setdefault(app.guild_id or MAIN_GUILD_ID, []).append(app)
+    
+    if PENDING_SLA_ACTION == "reject":
+        # Строки уже отклонены: ЛС, логи и каналы - сохраняемой задачей, чтобы остановка
+        # процесса (проход идет служебной задачей) не потеряла уведомления
+        await dispatch_job("applications_decided", {
+            "application_ids": [app.id for app in applications],
+            "moderator_id": bot.user.id,
+        })
+    else:
+        channels = [bot.get_channel(int(app.channel_id)) if app.channel_id else None for app in applications]
+        await gather_limited(channel.send(f"⏰ **Заявка ожидает рассмотрения дольше {PENDING_SLA_HOURS} ч.**")
+                             for channel in channels if channel)
+    
+    # Один пинг ролей на всю пачку каждого сервера
+    for guild_id, guild_apps in by_guild.items():
+        config = guild_configs.get(guild_id)
+        logs_channel = bot.get_channel(config.logs_channel_id) if config.logs_channel_id else None
+        if not logs_channel:
+            continue
+        mentions = " ".join(f"<@&{role_id}>" for role_id in config.tag_role_ids)
+        title = "автоматически отклонены" if PENDING_SLA_ACTION == "reject" else "ожидают рассмотрения"
+        lines = []
+        for app in guild_apps[:20]:
+            line = f"• **{app.username_static}** - <@{app.discord_id}>"
+            if PENDING_SLA_ACTION != "reject" and app.channel_id:
+                line += f" - <#{app.channel_id}>"
+            lines.append(line)
+        if len(guild_apps) > 20:
+            lines.append(f"... и еще {len(guild_apps) - 20}")
+        await logs_channel.send(
+            f"{mentions}\n⏰ **{len(guild_apps)} заявок {title} дольше {PENDING_SLA_HOURS} ч.:**\n" + "\n".join(lines)
+        )
+    
+    return applications
+
+async def pending_sla_worker():
+    """Фоновая задача: периодически проверяет зависшие заявки"""
+    await bot.wait_until_ready()
+    while not bot.is_closed():
+        try:
+            processed = await sweep_stale_applications()
+            if processed:
+                print(f"✅ Обработано зависших заявок: {len(processed)} ({PENDING_SLA_ACTION})")
+        except Exception as e:
+            print(f"❌ Ошибка обработки зависших заявок: {e}")
+            traceback.print_exc()
+        await asyncio.sleep(PENDING_SLA_SWEEP_MINUTES * 60)
+
+# ============ ОЧЕРЕДЬ РАССМОТРЕНИЯ ============
+
+async def claim_application(application_id, moderator):
+    """Берет заявку на рассмотрение или продлевает свою аренду.
+    
+    Возвращает (True, запись) при успехе, (False, запись) если заявку держит другой рекрут
+    и (False, None) если заявка уже обработана.
+    """
+    async with db_acquire() as conn:
+        async with conn.transaction():
+            # Блокируем строку заявки - тот же порядок блокировок, что и в claim_next_application
+            locked = await conn.fetchval('''
+                SELECT id FROM applications WHERE id = $1 AND status = 'pending' FOR UPDATE
+            ''', application_id)
+            if not locked:
+                return False, None
+            claim = await conn.fetchrow(f'''
+                INSERT INTO application_claims (application_id, moderator_id, moderator, lease_until)
+                VALUES ($1, $2, $3, CURRENT_TIMESTAMP + make_interval(mins => {CLAIM_LEASE_MINUTES}))
+                ON CONFLICT (application_id) DO UPDATE SET
+                    moderator_id = EXCLUDED.moderator_id,
+                    moderator = EXCLUDED.moderator,
+                    claimed_at = CASE WHEN application_claims.moderator_id = EXCLUDED.moderator_id
+                                      THEN application_claims.claimed_at ELSE CURRENT_TIMESTAMP END,
+                    lease_until = EXCLUDED.lease_until
+                WHERE application_claims.moderator_id = EXCLUDED.moderator_id
+                   OR application_claims.lease_until < CURRENT_TIMESTAMP
+                RETURNING *
+            ''', application_id, moderator.id, moderator.name)
+            if claim:
+                return True, claim
+            return False, await conn.fetchrow('SELECT * FROM application_claims WHERE application_id = $1', application_id)
+
+async def claim_next_application(guild_id, moderator):
+    """Выдает рекруту следующую свободную заявку сервера (самую старую).
+    
+    Если у рекрута уже есть активная заявка, возвращает ее. Строки, которые в этот момент
+    берут другие рекруты, пропускаются (SKIP LOCKED), поэтому параллельные вызовы не ждут друг друга.
+    Возвращает (application_id, уже_была_взята) или (None, False).
+    """
+    async with db_acquire() as conn:
+        async with conn.transaction():
+            current = await conn.fetchval(f'''
+                SELECT c.application_id FROM application_claims c
+                JOIN applications a ON a.id = c.application_id
+                WHERE c.moderator_id = $3 AND c.lease_until >= CURRENT_TIMESTAMP
+                  AND a.status = 'pending' AND {guild_filter_sql(1)}
+                LIMIT 1
+            ''', guild_id, MAIN_GUILD_ID, moderator.id)
+            if current:
+                return current, True
+                
+            claimed = await conn.fetchval(f'''
+                WITH next AS (
+                    SELECT a.id FROM applications a
+                    LEFT JOIN application_claims c ON c.application_id = a.id
+                    WHERE a.status = 'pending' AND {guild_filter_sql(1)}
+                      AND (c.application_id IS NULL OR c.lease_until < CURRENT_TIMESTAMP)
+                    ORDER BY a.created_at
+                    LIMIT 1
+                    FOR UPDATE OF a SKIP LOCKED
+                )
+                INSERT INTO application_claims (application_id, moderator_id, moderator, lease_until)
+                SELECT id, $3, $4, CURRENT_TIMESTAMP + make_interval(mins => {CLAIM_LEASE_MINUTES}) FROM next
+                ON CONFLICT (application_id) DO UPDATE SET
+                    moderator_id = EXCLUDED.moderator_id,
+                    moderator = EXCLUDED.moderator,
+                    claimed_at = CURRENT_TIMESTAMP,
+                    lease_until = EXCLUDED.lease_until
+                WHERE application_claims.lease_until < CURRENT_TIMESTAMP
+                RETURNING application_id
+            ''', guild_id, MAIN_GUILD_ID, moderator.id, moderator.name)
+            return claimed, False
+
+async def get_active_claim(application_id):
+    """Действующая аренда заявки или None"""
+    async with db_acquire() as conn:
+        return await conn.fetchrow('''
+            SELECT * FROM application_claims
+            WHERE application_id = $1 AND lease_until >= CURRENT_TIMESTAMP
+        ''', application_id)
+
+def claimed_text(claim):
+    return f"❌ Заявку рассматривает <@{claim['moderator_id']}> (до {claim['lease_until'].strftime('%H:%M')})"
+
+async def check_claim(interaction, application_id):
+    """Не дает начать решение по заявке, которую рассматривает другой рекрут.
+    
+    Это только ранний отказ для интерфейса; окончательно правило проверяет decide_application.
+    """
+    claim = await get_active_claim(application_id)
+    if claim and claim['moderator_id'] != interaction.user.id:
+        await interaction.response.send_message(claimed_text(claim), ephemeral=True)
+        return False
+    return True
+
+REVIEW_ACTIONS = {
+    "approve": (discord.ButtonStyle.green, "Принять"),
+    "consider": (discord.ButtonStyle.blurple, "Взять на рассмотрение"),
+    "reject": (discord.ButtonStyle.red, "Отклонить"),
+}
+
+class ReviewButton(discord.ui.DynamicItem[discord.ui.Button],
+                   template=r"zayavka_(?P<action>approve|consider|reject):(?P<id>\d+)"):
+    """Кнопка рассмотрения заявки.
+    
+    Действие и ID заявки берутся из custom_id, поэтому нажатие обрабатывает процесс
+    с подключением к Discord без add_view на каждую заявку - в том числе если сообщение
+    отправил воркер очереди (BOT_MODE=worker) или бот был перезапущен.
+    """
+    
+    def __init__(self, action, application_id):
+        style, label = REVIEW_ACTIONS[action]
+        super().__init__(discord.ui.Button(
+            style=style, label=label, row=0, custom_id=f"zayavka_{action}:{application_id}"
+        ))
+        self.action = action
+        self.application_id = application_id
+    
+    @classmethod
+    async def from_custom_id(cls, interaction, item, match):
+        return cls(match["action"], int(match["id"]))
+    
+    async def callback(self, interaction):
+        view = ApplicationReviewView(self.application_id)
+        try:
+            await getattr(view, f"{self.action}_callback")(interaction)
+        except Exception as e:
+            # Ошибки динамических кнопок discord.py только пишет в лог - отвечаем сами
+            await view.on_error(interaction, e, self)
+
+class ApplicationReviewView(discord.ui.View):
+    """Кнопки рассмотрения заявки (обработчики нажатий ReviewButton)"""
+    
+    def __init__(self, application_id):
+        super().__init__(timeout=None)
+        self.application_id = application_id
+        for action in REVIEW_ACTIONS:
+            self.add_item(ReviewButton(action, application_id))
+    
+    async def on_error(self, interaction: discord.Interaction, error: Exception, item):
+        print(f"Ошибка кнопки заявки {self.application_id}: {error}")
+        traceback.print_exc()
+        try:
+            await reply_ephemeral(interaction, error_text(error, "❌ Произошла ошибка. Попробуйте еще раз."))
+        except discord.HTTPException:
+            pass
+    
+    async def get_pending_application(self, interaction_btn):
+        """Загружает актуальную заявку, если она еще на рассмотрении"""
+        application = await get_application_by_id(self.application_id)
+        if not application or application.status != "pending":
+            await interaction_btn.response.send_message("❌ Эта заявка уже обработана", ephemeral=True)
+            return None
+        return application
+    
+    @traced()
+    async def approve_callback(self, interaction_btn: discord.Interaction):
+        if not has_admin_permission(interaction_btn.user):
+            await interaction_btn.response.send_message("❌ У вас нет прав для этого действия", ephemeral=True)
+            return
+        
+        application = await self.get_pending_application(interaction_btn)
+        if not application or not await check_claim(interaction_btn, application.id):
+            return
+        channel = interaction_btn.channel
+        
+        decided, claim = await decide_application(application, "approved", interaction_btn.user)
+        if not decided:
+            await interaction_btn.response.send_message(
+                claimed_text(claim) if claim else "❌ Эта заявка уже обработана", ephemeral=True
+            )
+            return
+        
+        await interaction_btn.response.send_message("✅ Заявка принята! Канал будет удален через 5 секунд.", ephemeral=True)
+        await dispatch_job("application_decided", {
+            "application_id": application.id,
+            "moderator_id": interaction_btn.user.id,
+            "channel_id": channel.id,
+            "message_id": interaction_btn.message.id
+        })
+    
+    @traced()
+    async def reject_callback(self, interaction_btn: discord.Interaction):
+        if not has_admin_permission(interaction_btn.user):
+            await interaction_btn.response.send_message("❌ У вас нет прав для этого действия", ephemeral=True)
+            return
+        
+        application = await self.get_pending_application(interaction_btn)
+        if not application or not await check_claim(interaction_btn, application.id):
+            return
+        channel = interaction_btn.channel
+        
+        modal = discord.ui.Modal(title="Причина отказа")
+        reason_input = discord.ui.TextInput(
+            label="Укажите причину отказа",
+            style=discord.TextStyle.paragraph,
+            placeholder="Например: стрельба мувмент",
+            required=True,
+            max_length=500
+        )
+        modal.add_item(reason_input)
+        
+        async def modal_callback(modal_interaction: discord.Interaction):
+            await modal_interaction.response.defer(ephemeral=True)
+            
+            decided, claim = await decide_application(application, "rejected", modal_interaction.user, reason_input.value)
+            if not decided:
+                await modal_interaction.followup.send(
+                    claimed_text(claim) if claim else "❌ Эта заявка уже обработана", ephemeral=True
+                )
+                return
+            submission_limiter.set_reject_cooldown(application.discord_id, application.updated_at)
+            
+            await modal_interaction.followup.send("✅ Заявка отклонена! Канал будет удален через 5 секунд.", ephemeral=True)
+            await dispatch_job("application_decided", {
+                "application_id": application.id,
+                "moderator_id": modal_interaction.user.id,
+                "channel_id": channel.id,
+                "message_id": modal_interaction.message.id if modal_interaction.message else None
+            })
+        
+        modal.on_submit = traced("ApplicationReviewView.reject_modal")(modal_callback)
+        await interaction_btn.response.send_modal(modal)
+    
+    @traced()
+    async def consider_callback(self, interaction_btn: discord.Interaction):
+        if not has_admin_permission(interaction_btn.user):
+            await interaction_btn.response.send_message("❌ У вас нет прав для этого действия", ephemeral=True)
+            return
+        
+        claimed, claim = await claim_application(self.application_id, interaction_btn.user)
+        if not claim:
+            await interaction_btn.response.send_message("❌ Эта заявка уже обработана", ephemeral=True)
+            return
+        if not claimed:
+            await interaction_btn.response.send_message(
+                f"❌ Заявку уже рассматривает <@{claim['moderator_id']}> "
+                f"(до {claim['lease_until'].strftime('%H:%M')})",
+                ephemeral=True
+            )
+            return
+        
+        if claim['claimed_at'] < claim['lease_until'] - timedelta(minutes=CLAIM_LEASE_MINUTES):
+            # Повторное нажатие своим рекрутом только продлевает аренду
+            await interaction_btn.response.send_message(
+                f"✅ Заявка закреплена за вами до {claim['lease_until'].strftime('%H:%M')}", ephemeral=True
+            )
+            return
+        
+        await interaction_btn.response.defer()
+        await interaction_btn.channel.send(
+            f"**Заявка взята на рассмотрение рекрутом <@{interaction_btn.user.id}>** "
+            f"(до {claim['lease_until'].strftime('%H:%M')})"
+        )
 
+@traced()
 async def send_application_embed(channel, application, interaction_user, guild):
     """Отправляет заявку в новом формате"""
     try:
+        config = guild_configs.get(guild.id)
         role_mentions = []
-        for role_id in TAG_ROLE_IDS:
+        for role_id in config.tag_role_ids:
             role = guild.get_role(role_id)
             if role:
                 role_mentions.append(f"<@&{role.id}>")
@@ -425,217 +2847,1020 @@ async def send_application_embed(channel, application, interaction_user, guild):
         else:
             await channel.send("Новая заявка!")
         
-        embed = discord.Embed(
-            title="Заявление",
-            color=discord.Color.blue(),
-            timestamp=application.created_at
-        )
+        extra_fields = []
         
-        rollbacks_text = application.rollbacks
-        if rollbacks_text and rollbacks_text.startswith("```") and rollbacks_text.endswith("```"):
-            rollbacks_text = rollbacks_text[3:-3].strip()
+        async with span("duplicate_search"):
+            duplicates = duplicate_index.find(application)
+        if duplicates:
+            duplicates_text = "\n".join(
+                f"• <@{other_id}> (`{other_user}`): {', '.join(reasons)}"
+                for _, other_id, other_user, reasons in duplicates
+            )
+            extra_fields.append(field("⚠️ Возможные дубликаты", duplicates_text))
         
-        embed.add_field(name="Никнейм Статик", value=f"```{application.username_static}```", inline=False)
-        embed.add_field(name="OOC имя возраст", value=f"```{application.ooc_info}```", inline=False)
-        embed.add_field(name="История семей", value=f"```{application.fam_history}```", inline=False)
-        embed.add_field(name="Почему выбрали именно нас?", value=f"```{application.reason}```", inline=False)
-        embed.add_field(name="Откаты с ГГ", value=f"{rollbacks_text}", inline=False)
-        embed.add_field(name="Пользователь", value=f"<@{application.discord_id}>", inline=False)
-        embed.add_field(name="Username", value=f"```{application.discord_user}```", inline=True)
-        embed.add_field(name="ID", value=f"```{application.discord_id}```", inline=True)
+        reused = await find_reused_links(
+            extract_rollback_links(application.rollbacks), guild.id, application.discord_id, limit=10
+        )
+        if reused:
+            reused_text = "\n".join(
+                f"• [{record['host'].capitalize()}]({record['url']}) - <@{record['discord_id']}> "
+                f"(`{truncate(record['username_static'], 40)}`, {render_status_line(record['status'])})"
+                for record in reused
+            )
+            extra_fields.append(field("⚠️ Эти откаты уже присылали", reused_text))
         
-        user_previous_apps = await get_user_applications(application.discord_id)
+        user_previous_apps = await get_user_applications(application.discord_id, guild.id, include_archive=True)
         user_previous_apps = [app for app in user_previous_apps if app.status != "pending" and app.id != application.id]
         
         if user_previous_apps:
-            logs_channel = bot.get_channel(LOGS_CHANNEL_ID)
+            logs_channel = await resolve_channel(config.logs_channel_id)
             log_links = []
             if logs_channel:
-                async for message in logs_channel.history(limit=200):
-                    if message.embeds:
-                        for embed_msg in message.embeds:
-                            user_found = False
-                            for field in embed_msg.fields:
-                                if field.value and application.discord_id in field.value:
+                async with span("logs_history_scan"):
+                    async for message in logs_channel.history(limit=200):
+                        if message.embeds:
+                            for embed_msg in message.embeds:
+                                user_found = False
+                                for embed_field in embed_msg.fields:
+                                    if embed_field.value and application.discord_id in embed_field.value:
+                                        user_found = True
+                                        break
+                                
+                                if not user_found and embed_msg.description and application.discord_id in embed_msg.description:
                                     user_found = True
+                                
+                                if user_found:
+                                    status_icon = "✅" if embed_msg.title and "✅" in embed_msg.title else "❌"
+                                    log_links.append(f"{status_icon} [Ссылка]({message.jump_url})")
                                     break
-                            
-                            if not user_found and embed_msg.description and application.discord_id in embed_msg.description:
-                                user_found = True
-                            
-                            if user_found:
-                                status_icon = "✅" if embed_msg.title and "✅" in embed_msg.title else "❌"
-                                log_links.append(f"{status_icon} [Ссылка]({message.jump_url})")
-                                break
             
             if log_links:
                 links_text = "\n".join(log_links[:5])
-                embed.add_field(
-                    name="Предыдущие заявки",
-                    value=links_text,
-                    inline=False
-                )
+                extra_fields.append(field("Предыдущие заявки", links_text))
             else:
-                embed.add_field(
-                    name="Предыдущие заявки",
-                    value="Заявок не найдено.",
-                    inline=False
-                )
+                extra_fields.append(field("Предыдущие заявки", "Заявок не найдено."))
         else:
-            embed.add_field(
-                name="Предыдущие заявки",
-                value="Заявок не найдено.",
-                inline=False
-            )
+            extra_fields.append(field("Предыдущие заявки", "Заявок не найдено."))
         
-        message = await channel.send(embed=embed)
+        message = await channel.send(embed=render_application_embed(application, extra_fields))
         
-        view = discord.ui.View(timeout=None)
+        if not application.id:
+            # Сохраняем заранее: custom_id кнопок содержит ID заявки
+            await save_application(application)
         
-        async def approve_callback(interaction_btn: discord.Interaction):
-            if not has_admin_permission(interaction_btn.user):
-                await interaction_btn.response.send_message("❌ У вас нет прав для этого действия", ephemeral=True)
-                return
-            
-            application.status = "approved"
-            application.moderator = interaction_btn.user.name
-            application.updated_at = datetime.now()
+        view = ApplicationReviewView(application.id)
+        await channel.send(view=view)
+        
+        application.message_id = message.id
+        await save_application(application)
+        
+        return message, None
+    except Exception as e:
+        print(f"Ошибка отправки embed: {e}")
+        raise
+
+def build_log_embed(application, moderator, action, reason=None):
+    """Собирает embed лога о принятой или отклоненной заявке"""
+    fields = application_fields(application, compact=True)
+    if action == "approved":
+        fields.append(field("Принял", f"<@{moderator.id}>"))
+    elif action == "rejected":
+        fields.append(field("Отклонил", f"<@{moderator.id}>"))
+        fields.append(field("Причина отказа", reason, limit=500))
+    
+    return render_embed(
+        title="✅ Заявка принята" if action == "approved" else "❌ Заявка отклонена",
+        color=discord.Color.green() if action == "approved" else discord.Color.red(),
+        timestamp=application.updated_at,
+        fields=fields
+    )
+
+@traced()
+async def send_log_to_channel(application, moderator, action, reason=None, guild=None):
+    """Отправляет лог о заявке в канал логов"""
+    try:
+        config = guild_configs.get(guild.id if guild else application.guild_id)
+        logs_channel = await resolve_channel(config.logs_channel_id)
+        
+        if not logs_channel:
+            return
+        
+        await logs_channel.send(embed=build_log_embed(application, moderator, action, reason))
+    except Exception as e:
+        print(f"Ошибка отправки лога: {e}")
+
+# ============ ОЧЕРЕДЬ ЗАДАЧ ============
+
+async def resolve_guild(guild_id):
+    """Сервер из кэша gateway или через HTTP (в процессе-воркере кэша нет)"""
+    return bot.get_guild(int(guild_id)) or await bot.fetch_guild(int(guild_id))
+
+async def resolve_channel(channel_id):
+    """Канал из кэша gateway или через HTTP; None, если канал недоступен"""
+    if not channel_id:
+        return None
+    channel = bot.get_channel(int(channel_id))
+    if channel is None:
+        try:
+            channel = await bot.fetch_channel(int(channel_id))
+        except (discord.NotFound, discord.Forbidden):
+            return None
+    return channel
+
+async def edit_interaction_response(interaction_info, content):
+    """Редактирует отложенный (defer) ответ на взаимодействие по его токену"""
+    try:
+        route = discord.http.Route(
+            'PATCH', '/webhooks/{application_id}/{interaction_token}/messages/@original',
+            application_id=interaction_info["application_id"],
+            interaction_token=interaction_info["token"]
+        )
+        await bot.http.request(route, json={"content": content})
+    except Exception as e:
+        print(f"Не удалось обновить ответ на взаимодействие: {e}")
+
+@traced()
+async def job_submit_application(payload):
+    """Тяжелая часть подачи заявки: канал, embed, сохранение"""
+    try:
+        guild = await resolve_guild(payload["guild_id"])
+        user_apps = await get_user_applications(payload["discord_id"], guild.id)
+        pending = [app for app in user_apps if app.status == "pending"]
+        if pending:
+            # Повтор задачи или двойная отправка формы: заявка уже создана
+            application = pending[0]
+        else:
+            application = Application(
+                **payload["form"],
+                discord_user=payload["discord_user"],
+                discord_id=payload["discord_id"],
+                guild_id=guild.id
+            )
             await save_application(application)
-            
-            try:
-                user = await bot.fetch_user(int(application.discord_id))
-                await user.send("🎉 **Вы приняты в семью!** 🎉\n\nДобро пожаловать! Ожидайте дальнейших инструкций от администрации.")
-            except Exception as e:
-                print(f"Не удалось отправить сообщение пользователю: {e}")
-            
-            await send_log_to_channel(application, interaction_btn.user, "approved", guild)
-            
+        
+        channel = await resolve_channel(application.channel_id)
+        if channel is None:
+            channel = await create_application_channel(guild, application.discord_user, application.discord_id, application)
+            application.channel_id = channel.id
+            # ID канала сохраняется сразу: повтор задачи не создаст второй канал
+            await save_application(application)
+        if not application.message_id:
+            await send_application_embed(channel, application, None, guild)
+        
+        await edit_interaction_response(
+            payload["interaction"],
+            f"✅ Ваша заявка успешно отправлена!\n\n"
+            f"Заявка рассматривается в течение суток.\n"
+            f"Ответ придёт в личные сообщения от бота.\n"
+            f"Для обсуждения заявки создан канал: <#{application.channel_id}>"
+        )
+    except Exception:
+        await edit_interaction_response(
+            payload["interaction"],
+            "❌ Ошибка при создании заявки. Пожалуйста, попробуйте позже."
+        )
+        raise
+
+async def get_done_steps(application_ids):
+    """Шаги задач по заявкам, выполненные при прошлых попытках: id -> множество шагов"""
+    async with db_acquire() as conn:
+        records = await conn.fetch('''
+            SELECT application_id, step FROM application_job_steps WHERE application_id = ANY($1::int[])
+        ''', application_ids)
+    done = {application_id: set() for application_id in application_ids}
+    for record in records:
+        done[record['application_id']].add(record['step'])
+    return done
+
+async def mark_steps_done(application_ids, step):
+    if not application_ids:
+        return
+    async with db_acquire() as conn:
+        await conn.execute('''
+            INSERT INTO application_job_steps (application_id, step)
+            SELECT application_id, $2 FROM unnest($1::int[]) AS application_id
+            ON CONFLICT DO NOTHING
+        ''', application_ids, step)
+
+def decision_dm_text(application):
+    if application.status == "approved":
+        return APPROVED_DM_TEXT
+    return REJECTED_DM_TEXT.format(reason=application.reason_reject)
+
+@traced()
+async def job_application_decided(payload):
+    """Последствия решения по заявке: ЛС, лог, сообщение в канале, удаление канала.
+    
+    Каждый шаг отмечается в application_job_steps после выполнения, поэтому повтор задачи
+    после частичной ошибки или перезапуска не отправляет ЛС и лог второй раз.
+    """
+    application = await get_application_by_id(payload["application_id"])
+    if not application:
+        return
+    moderator = discord.Object(id=payload["moderator_id"])
+    done = (await get_done_steps([application.id]))[application.id]
+    
+    if application.status == "approved":
+        reason = None
+        channel_text = f"**Заявка принята рекрутом <@{moderator.id}>**"
+    else:
+        reason = application.reason_reject
+        channel_text = f"**Заявка отклонена рекрутом <@{moderator.id}>**\n**Причина:** {application.reason_reject}"
+    
+    if "dm" not in done:
+        await send_user_dm(application.discord_id, decision_dm_text(application))
+        await mark_steps_done([application.id], "dm")
+    if "log" not in done:
+        await send_log_to_channel(application, moderator, application.status, reason)
+        await mark_steps_done([application.id], "log")
+        
+    channel = await resolve_channel(payload["channel_id"])
+    if channel is None:
+        return
+    if "channel_message" not in done:
+        if payload.get("message_id"):
             try:
-                await interaction_btn.message.edit(view=None)
+                await channel.get_partial_message(payload["message_id"]).edit(view=None)
             except:
                 pass
-            
-            await channel.send(f"**Заявка принята рекрутом <@{interaction_btn.user.id}>**")
-            bot.loop.create_task(delete_application_channel(channel))
-            
-            await interaction_btn.response.send_message("✅ Заявка принята! Канал будет удален через 5 секунд.", ephemeral=True)
+        await channel.send(channel_text)
+        await mark_steps_done([application.id], "channel_message")
+    supervisor.spawn(
+        delete_application_channel(channel, application_id=application.id),
+        "delete_channel",
+        persist=("delete_channel", {"channel_id": channel.id, "application_id": application.id})
+    )
+
+@traced()
+async def job_applications_decided(payload):
+    """Последствия массового решения: ЛС, логи пачками по серверам, закрытие каналов.
+    
+    Шаги отмечаются в application_job_steps, как в job_application_decided.
+    """
+    async with db_acquire() as conn:
+        records = await conn.fetch(
+            'SELECT * FROM applications WHERE id = ANY($1::int[]) ORDER BY id', payload["application_ids"]
+        )
+    applications = [Application.from_record(record) for record in records]
+    if not applications:
+        return
+    moderator = discord.Object(id=payload["moderator_id"])
+    done = await get_done_steps([app.id for app in applications])
+    
+    pending = [app for app in applications if "dm" not in done[app.id]]
+    await gather_limited(send_user_dm(app.discord_id, decision_dm_text(app)) for app in pending)
+    await mark_steps_done([app.id for app in pending], "dm")
+    
+    by_guild = {}
+    for app in applications:
+        if "log" not in done[app.id]:
+            by_guild.setdefault(app.guild_id or MAIN_GUILD_ID, []).append(app)
+    for guild_id, guild_apps in by_guild.items():
+        await send_log_embeds(guild_id, [build_log_embed(app, moderator, app.status, app.reason_reject) for app in guild_apps])
+        await mark_steps_done([app.id for app in guild_apps], "log")
+    
+    pending = [app for app in applications if "channel_message" not in done[app.id]]
+    closed = await gather_limited((
+        close_decided_channel(app, moderator.id, "Заявка принята" if app.status == "approved" else "Заявка отклонена")
+        for app in pending
+    ), limit=3)
+    await mark_steps_done([app.id for app, result in zip(pending, closed) if not isinstance(result, Exception)],
+                          "channel_message")
+    failed = [app.id for app, result in zip(pending, closed) if isinstance(result, Exception)]
+    if failed:
+        raise RuntimeError(f"не закрыты каналы заявок {failed}")
+
+@traced()
+async def job_delete_channel(payload):
+    """Удаление канала, не завершенное до остановки процесса"""
+    channel = await resolve_channel(payload["channel_id"])
+    if channel is not None:
+        await delete_application_channel(channel, delay_seconds=0, application_id=payload.get("application_id"))
+
+# Обработчики задач и максимальное число попыток
+JOB_HANDLERS = {
+    "submit_application": (job_submit_application, 2),
+    "application_decided": (job_application_decided, 3),
+    "applications_decided": (job_applications_decided, 3),
+    "delete_channel": (job_delete_channel, 3),
+}
+
+class JobQueue:
+    """Очередь задач в таблице bot_jobs (FOR UPDATE SKIP LOCKED) с повторами"""
+    
+    def __init__(self):
+        self.wakeup = asyncio.Event()
+        self.stats = {"done": 0, "retried": 0, "failed": 0}
+    
+    async def enqueue(self, kind, payload):
+        async with db_acquire() as conn:
+            async with conn.transaction():
+                job_id = await conn.fetchval('''
+                    INSERT INTO bot_jobs (kind, payload) VALUES ($1, $2) RETURNING id
+                ''', kind, json.dumps(payload, ensure_ascii=False))
+                await cluster_bus.publish('bot_jobs', str(job_id), conn)
+        return job_id
+    
+    def on_notify(self, payload):
+        self.wakeup.set()
+    
+    async def fetch_next(self):
+        """Забирает следующую задачу; зависшие (locked_until в прошлом) берутся повторно"""
+        async with db_acquire() as conn:
+            return await conn.fetchrow('''
+                UPDATE bot_jobs SET
+                    status = 'running',
+                    attempts = attempts + 1,
+                    started_at = CURRENT_TIMESTAMP,
+                    locked_until = CURRENT_TIMESTAMP + make_interval(secs => $1)
+                WHERE id = (
+                    SELECT id FROM bot_jobs
+                    WHERE (status = 'queued' AND run_after <= CURRENT_TIMESTAMP)
+                       OR (status = 'running' AND locked_until < CURRENT_TIMESTAMP)
+                    ORDER BY id
+                    FOR UPDATE SKIP LOCKED
+                    LIMIT 1
+                )
+                RETURNING *
+            ''', JOB_TIMEOUT_SECONDS)
+    
+    async def run_job(self, job):
+        handler, max_attempts = JOB_HANDLERS[job['kind']]
+        started = time.perf_counter()
+        error = None
+        try:
+            async with start_trace(f"job:{job['kind']}", f"job-{job['id']}"):
+                await asyncio.wait_for(handler(json.loads(job['payload'])), timeout=JOB_TIMEOUT_SECONDS)
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            traceback.print_exc()
+        duration_ms = int((time.perf_counter() - started) * 1000)
         
-        async def reject_callback(interaction_btn: discord.Interaction):
-            if not has_admin_permission(interaction_btn.user):
-                await interaction_btn.response.send_message("❌ У вас нет прав для этого действия", ephemeral=True)
-                return
+        async with db_acquire() as conn:
+            if error is None:
+                await conn.execute('''
+                    UPDATE bot_jobs SET status = 'done', finished_at = CURRENT_TIMESTAMP,
+                        duration_ms = $2, last_error = NULL
+                    WHERE id = $1
+                ''', job['id'], duration_ms)
+                self.stats["done"] += 1
+                print(f"✅ Задача {job['kind']} #{job['id']} выполнена за {duration_ms} мс")
+            elif job['attempts'] < max_attempts:
+                await conn.execute('''
+                    UPDATE bot_jobs SET status = 'queued', duration_ms = $2, last_error = $3,
+                        run_after = CURRENT_TIMESTAMP + make_interval(secs => $4)
+                    WHERE id = $1
+                ''', job['id'], duration_ms, error, 2 ** job['attempts'])
+                self.stats["retried"] += 1
+                print(f"⚠️ Задача {job['kind']} #{job['id']} будет повторена: {error}")
+            else:
+                await conn.execute('''
+                    UPDATE bot_jobs SET status = 'failed', finished_at = CURRENT_TIMESTAMP,
+                        duration_ms = $2, last_error = $3
+                    WHERE id = $1
+                ''', job['id'], duration_ms, error)
+                self.stats["failed"] += 1
+                print(f"❌ Задача {job['kind']} #{job['id']} не выполнена: {error}")
+    
+    async def worker_loop(self, number):
+        # При остановке текущая задача дорабатывает, новые не берутся
+        while not bot.is_closed() and not supervisor.closing:
+            try:
+                job = await self.fetch_next()
+                if job is None:
+                    self.wakeup.clear()
+                    try:
+                        await asyncio.wait_for(self.wakeup.wait(), timeout=5)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                await self.run_job(job)
+            except Exception as e:
+                print(f"❌ Ошибка воркера #{number}: {e}")
+                traceback.print_exc()
+                await asyncio.sleep(5)
+    
+    async def cleanup_loop(self):
+        """Удаляет выполненные задачи старше суток"""
+        while not bot.is_closed():
+            try:
+                async with db_acquire() as conn:
+                    await conn.execute('''
+                        DELETE FROM bot_jobs
+                        WHERE status = 'done' AND finished_at < CURRENT_TIMESTAMP - INTERVAL '1 day'
+                    ''')
+                    # Повторы задач укладываются в сутки, отметки шагов дольше не нужны
+                    await conn.execute('''
+                        DELETE FROM application_job_steps WHERE done_at < CURRENT_TIMESTAMP - INTERVAL '7 days'
+                    ''')
+            except Exception as e:
+                print(f"❌ Ошибка очистки очереди задач: {e}")
+            await asyncio.sleep(3600)
+
+job_queue = JobQueue()
+
+async def enqueue_job(kind, payload):
+    """Ставит задачу в bot_jobs; при недоступной БД - в журнал до восстановления"""
+    try:
+        await job_queue.enqueue(kind, payload)
+    except DB_CONNECTION_ERRORS + (DatabaseUnavailable,):
+        db_journal.append("enqueue_jobs", {"jobs": [(kind, payload)]})
+
+async def dispatch_job(kind, payload):
+    """В режиме gateway ставит задачу в очередь, иначе выполняет ее сразу"""
+    if BOT_MODE == "gateway":
+        await enqueue_job(kind, payload)
+        return
+    handler, _ = JOB_HANDLERS[kind]
+    try:
+        # Зарегистрирована в супервизоре: при остановке не потеряется, а уйдет в bot_jobs
+        await supervisor.run(handler(payload), kind, persist=(kind, payload))
+    except Exception as e:
+        print(f"❌ Ошибка выполнения задачи {kind}, повтор через очередь: {e}")
+        traceback.print_exc()
+        # Шаги, уже выполненные первой попыткой, обработчики пропускают
+        await enqueue_job(kind, payload)
+
+async def run_job_worker():
+    """Процесс-воркер: только HTTP-доступ к Discord, без подключения к gateway"""
+    install_shutdown_handlers()
+    async with bot:
+        await bot.login(TOKEN)
+        await init_database()
+        if db_journal.pending:
+            db_journal.schedule_replay()
+        await guild_configs.load_all()
+        cluster_bus.subscribe('guild_config_changed', guild_configs.on_notify)
+        cluster_bus.subscribe('application_changed', application_cache.on_notify)
+        cluster_bus.subscribe('application_changed', duplicate_index.on_notify)
+        cluster_bus.subscribe('bot_jobs', job_queue.on_notify)
+        await cluster_bus.start()
+        print(f"✅ Воркер запущен, параллельных задач: {JOB_WORKER_CONCURRENCY}")
+        supervisor.spawn(job_queue.cleanup_loop(), "jobs_cleanup", service=True)
+        workers = [
+            supervisor.spawn(job_queue.worker_loop(number), "job_worker")
+            for number in range(JOB_WORKER_CONCURRENCY)
+        ]
+        await asyncio.gather(*workers, return_exceptions=True)
+        await graceful_shutdown("воркеры остановлены")
+
+async def run_bot():
+    """Процесс с подключением к gateway и корректной остановкой по SIGTERM"""
+    discord.utils.setup_logging()
+    install_shutdown_handlers()
+    async with bot:
+        await bot.start(TOKEN)
+    if supervisor.closing:
+        await shutdown_done.wait()
+
+# ============ ЭКСПОРТ И ИМПОРТ ============
+
+EXPORT_COLUMNS = [
+    "id", "username_static", "ooc_info", "fam_history", "reason", "rollbacks",
+    "discord_user", "discord_id", "guild_id", "message_id", "status", "channel_id",
+    "moderator", "reason_reject", "created_at", "updated_at"
+]
+EXPORT_FORMATS = ("jsonl", "csv")
+
+async def stream_applications(conn, guild_id=None, prefetch=500):
+    """Построчно отдает заявки через серверный курсор (память не растет с размером таблицы)"""
+    async with conn.transaction():
+        query = f'''
+            SELECT {", ".join(EXPORT_COLUMNS)} FROM applications
+            WHERE {guild_filter_sql(1)}
+            UNION ALL
+            SELECT {", ".join(EXPORT_COLUMNS)} FROM applications_archive
+            WHERE {guild_filter_sql(1)}
+            ORDER BY id
+        '''
+        async for record in conn.cursor(query, guild_id, MAIN_GUILD_ID, prefetch=prefetch):
+            yield record
+
+def export_value(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+async def export_applications(file, fmt, guild_id=None, chunk_rows=500):
+    """Пишет заявки в открытый текстовый файл в формате jsonl/csv; возвращает число строк.
+    
+    Строки копятся в памяти пачками по chunk_rows, запись и сжатие .gz идут в отдельном потоке.
+    """
+    count = 0
+    buffer = io.StringIO()
+    writer = None
+    if fmt == "csv":
+        writer = csv.writer(buffer)
+        writer.writerow(EXPORT_COLUMNS)
+    async with db_acquire() as conn:
+        async for record in stream_applications(conn, guild_id):
+            values = [export_value(record[column]) for column in EXPORT_COLUMNS]
+            if writer:
+                writer.writerow(values)
+            else:
+                buffer.write(json.dumps(dict(zip(EXPORT_COLUMNS, values)), ensure_ascii=False) + "\n")
+            count += 1
+            if count % chunk_rows == 0:
+                await asyncio.to_thread(file.write, buffer.getvalue())
+                buffer.seek(0)
+                buffer.truncate()
+    await asyncio.to_thread(file.write, buffer.getvalue())
+    return count
+
+def open_export_file(path, mode):
+    """Открывает файл экспорта, .gz сжимается на лету"""
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8", newline="")
+    return open(path, mode, encoding="utf-8", newline="")
+
+def detect_format(path):
+    name = path[:-3] if path.endswith(".gz") else path
+    for fmt in EXPORT_FORMATS:
+        if name.endswith("." + fmt):
+            return fmt
+    raise ValueError(f"Не удалось определить формат файла {path}")
+
+# Колонки, в которых пустое значение CSV означает NULL
+NULLABLE_COLUMNS = {"id", "guild_id", "message_id", "channel_id", "moderator", "reason_reject"}
+
+def import_row(data, columns):
+    """Приводит строку файла к типам колонок таблицы applications"""
+    row = []
+    for column in columns:
+        value = data.get(column)
+        if value == "" and column in NULLABLE_COLUMNS:
+            value = None
+        if value is not None:
+            if column in ("id", "guild_id"):
+                value = int(value)
+            elif column in ("created_at", "updated_at"):
+                value = datetime.fromisoformat(value).replace(tzinfo=None)
+            elif column in ("discord_id", "message_id", "channel_id"):
+                value = str(value)
+        elif column in ("created_at", "updated_at"):
+            value = datetime.now()
+        row.append(value)
+    return tuple(row)
+
+async def import_applications(path, keep_ids=True, batch_size=5000):
+    """Загружает заявки из файла через COPY; файл читается потоково пачками.
+    
+    Если в файле нет id (например, файл от generate), id выдает база.
+    Заявки с id, уже занятыми в архиве, не загружаются: импорт отменяется целиком.
+    """
+    fmt = detect_format(path)
+    total = 0
+    with open_export_file(path, "r") as file:
+        if fmt == "csv":
+            rows = csv.DictReader(file)
+            has_ids = "id" in (rows.fieldnames or [])
+        else:
+            lines = (json.loads(line) for line in file if line.strip())
+            first = next(lines, None)
+            has_ids = first is not None and first.get("id") is not None
+            rows = itertools.chain([first] if first is not None else [], lines)
+        if keep_ids and not has_ids:
+            print(f"⚠️ В файле {path} нет id - заявкам будут выданы новые id")
+            keep_ids = False
+        columns = EXPORT_COLUMNS if keep_ids else [c for c in EXPORT_COLUMNS if c != "id"]
+        async with db_acquire() as conn:
             
-            modal = discord.ui.Modal(title="Причина отказа")
-            reason_input = discord.ui.TextInput(
-                label="Укажите причину отказа",
-                style=discord.TextStyle.paragraph,
-                placeholder="Например: стрельба мувмент",
-                required=True,
-                max_length=500
-            )
-            modal.add_item(reason_input)
+            async def copy_batch(batch):
+                if keep_ids:
+                    # Первичный ключ не видит архив: пересечения проверяем сами
+                    archived = await conn.fetch(
+                        'SELECT id FROM applications_archive WHERE id = ANY($1::bigint[]) ORDER BY id LIMIT 10',
+                        [row[0] for row in batch]
+                    )
+                    if archived:
+                        raise ValueError(
+                            f"Заявки с id {', '.join(str(r['id']) for r in archived)} уже есть в архиве"
+                        )
+                await conn.copy_records_to_table('applications', records=batch, columns=columns)
+                return len(batch)
             
-            async def modal_callback(modal_interaction: discord.Interaction):
-                await modal_interaction.response.defer(ephemeral=True)
-                
-                application.status = "rejected"
-                application.moderator = modal_interaction.user.name
-                application.reason_reject = reason_input.value
-                application.updated_at = datetime.now()
-                await save_application(application)
-                
-                try:
-                    user = await bot.fetch_user(int(application.discord_id))
-                    await user.send(f"❌ **Ваша заявка отклонена.**\n\n**Причина:** {reason_input.value}\n\nВы можете подать заявку снова после устранения указанных замечаний.")
-                except Exception as e:
-                    print(f"Не удалось отправить сообщение пользователю: {e}")
-                
-                await send_log_to_channel(application, modal_interaction.user, "rejected", reason_input.value, guild)
-                
-                try:
-                    await modal_interaction.message.edit(view=None)
-                except:
-                    pass
-                
-                await channel.send(f"**Заявка отклонена рекрутом <@{modal_interaction.user.id}>**\n**Причина:** {reason_input.value}")
-                bot.loop.create_task(delete_application_channel(channel))
+            async with conn.transaction():
+                batch = []
+                for data in rows:
+                    batch.append(import_row(data, columns))
+                    if len(batch) >= batch_size:
+                        total += await copy_batch(batch)
+                        batch = []
+                if batch:
+                    total += await copy_batch(batch)
+                if keep_ids:
+                    # После вставки с явными id сдвигаем последовательность, не назад:
+                    # id из архива и уже выданные id повторно не выдаются
+                    sequence = await conn.fetchval("SELECT pg_get_serial_sequence('applications', 'id')")
+                    await conn.execute(f'''
+                        SELECT setval($1::text::regclass, GREATEST(
+                            (SELECT MAX(id) FROM applications),
+                            (SELECT MAX(id) FROM applications_archive),
+                            (SELECT last_value FROM {sequence})
+                        ))
+                    ''', sequence)
+                await applications_changed("*", conn)
+    return total
+
+def generate_applications(path, count, guild_id=None):
+    """Создает файл со случайными заявками для нагрузочных тестов"""
+    words = ["семья", "инактив", "кикнули", "маркет", "контент", "стрельба", "капт", "онлайн", "откаты", "ушел"]
+    statuses = ["pending", "approved", "rejected", "rejected"]
+    columns = [c for c in EXPORT_COLUMNS if c != "id"]
+    with open_export_file(path, "w") as file:
+        writer = csv.writer(file) if detect_format(path) == "csv" else None
+        if writer:
+            writer.writerow(columns)
+        for i in range(count):
+            created_at = datetime.now() - timedelta(minutes=random.randint(0, 60 * 24 * 365))
+            status = random.choice(statuses)
+            data = {
+                "username_static": f"Test User{i} {random.randint(1000, 99999)} {random.randint(1, 12)}+ часов",
+                "ooc_info": f"Тест {random.randint(16, 40)}",
+                "fam_history": " ".join(random.choices(words, k=random.randint(5, 150))),
+                "reason": " ".join(random.choices(words, k=random.randint(5, 100))),
+                "rollbacks": f"https://youtu.be/{random.randint(10**9, 10**10)}",
+                "discord_user": f"test_user_{i}",
+                "discord_id": str(10**17 + i),
+                "guild_id": guild_id,
+                "message_id": None,
+                "status": status,
+                "channel_id": None,
+                "moderator": None if status == "pending" else "test_moderator",
+                "reason_reject": "Тест" if status == "rejected" else None,
+                "created_at": created_at.isoformat(),
+                "updated_at": created_at.isoformat(),
+            }
+            if writer:
+                writer.writerow([data[c] for c in columns])
+            else:
+                file.write(json.dumps(data, ensure_ascii=False) + "\n")
+
+async def run_cli(argv):
+    """Командная строка: export / import / generate / bench (без подключения к Discord)"""
+    parser = argparse.ArgumentParser(prog="zayavkabot.py", description="Экспорт и импорт заявок")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    
+    export_parser = subparsers.add_parser("export", help="Выгрузить заявки в файл")
+    export_parser.add_argument("output", help="Файл .jsonl/.csv, с .gz - сжатый")
+    export_parser.add_argument("--guild", type=int, default=None, help="Только заявки сервера")
+    
+    import_parser = subparsers.add_parser("import", help="Загрузить заявки из файла через COPY")
+    import_parser.add_argument("input", help="Файл .jsonl/.csv (можно .gz)")
+    import_parser.add_argument("--new-ids", action="store_true", help="Не переносить id, выдать новые")
+    
+    generate_parser = subparsers.add_parser("generate", help="Создать файл тестовых заявок")
+    generate_parser.add_argument("output")
+    generate_parser.add_argument("count", type=int)
+    generate_parser.add_argument("--guild", type=int, default=None)
+    
+    bench_parser = subparsers.add_parser("bench", help="Замерить скорость отрисовки embed")
+    bench_parser.add_argument("--count", type=int, default=2000)
+    bench_parser.add_argument("--profile", action="store_true", help="Выполнить под cProfile и вывести топ функций")
+    
+    args = parser.parse_args(argv)
+    if args.command == "generate":
+        generate_applications(args.output, args.count, args.guild)
+        print(f"✅ Создано {args.count} тестовых заявок: {args.output}")
+        return
+    if args.command == "bench":
+        if not args.profile:
+            run_render_benchmark(args.count)
+            return
+        profiler = cProfile.Profile()
+        profiler.runcall(run_render_benchmark, args.count)
+        pstats.Stats(profiler).sort_stats("cumulative").print_stats(25)
+        return
+    
+    if not DATABASE_URL:
+        print("❌ ОШИБКА: Переменная окружения DATABASE_URL не установлена!")
+        sys.exit(1)
+    await init_database()
+    started = time.perf_counter()
+    if args.command == "export":
+        with open_export_file(args.output, "w") as file:
+            count = await export_applications(file, detect_format(args.output), args.guild)
+        print(f"✅ Выгружено {count} заявок в {args.output} за {time.perf_counter() - started:.1f} с")
+    else:
+        count = await import_applications(args.input, keep_ids=not args.new_ids)
+        print(f"✅ Загружено {count} заявок из {args.input} за {time.perf_counter() - started:.1f} с")
+    await db_pool.close()
+
+# ============ АРХИВ ОБРАБОТАННЫХ ЗАЯВОК ============
+
+async def move_decided_to_archive(batch_size=ARCHIVE_BATCH_SIZE):
+    """Переносит одну пачку обработанных заявок старше ARCHIVE_AFTER_DAYS в архив"""
+    columns = ", ".join(EXPORT_COLUMNS)
+    async with db_acquire() as conn:
+        async with conn.transaction():
+            moved = await conn.fetch(f'''
+                WITH moved AS (
+                    DELETE FROM applications
+                    WHERE id IN (
+                        SELECT id FROM applications
+                        WHERE status <> 'pending'
+                          AND updated_at < CURRENT_TIMESTAMP - make_interval(days => $1)
+                        ORDER BY id
+                        LIMIT $2
+                        FOR UPDATE SKIP LOCKED
+                    )
+                    RETURNING {columns}
+                ), released AS (
+                    DELETE FROM application_claims WHERE application_id IN (SELECT id FROM moved)
+                ), archived AS (
+                    INSERT INTO applications_archive ({columns})
+                    SELECT {columns} FROM moved
+                    RETURNING id, discord_id
+                )
+                SELECT id, discord_id FROM archived
+            ''', ARCHIVE_AFTER_DAYS, batch_size)
+            # Заявки сменили таблицу: сбрасываем их и списки "без архива" их авторов
+            await applications_changed([(record['id'], record['discord_id']) for record in moved], conn)
+            return len(moved)
+
+async def archive_worker():
+    """Фоновая задача: раз в час переносит старые заявки пачками"""
+    await bot.wait_until_ready()
+    while not bot.is_closed():
+        async def move_all():
+            total = 0
+            while True:
+                moved = await move_decided_to_archive()
+                total += moved
+                if moved < ARCHIVE_BATCH_SIZE:
+                    break
+                # Пауза между пачками, чтобы не мешать основному трафику
+                await asyncio.sleep(1)
+            if total:
+                print(f"✅ Перенесено в архив заявок: {total}")
                 
-                await modal_interaction.followup.send("✅ Заявка отклонена! Канал будет удален через 5 секунд.", ephemeral=True)
-            
-            modal.on_submit = modal_callback
-            await interaction_btn.response.send_modal(modal)
-        
-        async def consider_callback(interaction_btn: discord.Interaction):
-            if not has_admin_permission(interaction_btn.user):
-                await interaction_btn.response.send_message("❌ У вас нет прав для этого действия", ephemeral=True)
-                return
-            
-            await interaction_btn.response.defer()
-            await channel.send(f"**Заявка взята на рассмотрение рекрутом <@{interaction_btn.user.id}>**")
-        
-        approve_button = discord.ui.Button(style=discord.ButtonStyle.green, label="Принять", row=0)
-        approve_button.callback = approve_callback
-        
-        consider_button = discord.ui.Button(style=discord.ButtonStyle.blurple, label="Взять на рассмотрение", row=0)
-        consider_button.callback = consider_callback
-        
-        reject_button = discord.ui.Button(style=discord.ButtonStyle.red, label="Отклонить", row=0)
-        reject_button.callback = reject_callback
+        try:
+            await run_exclusive("archive_mover", move_all)
+        except Exception as e:
+            print(f"❌ Ошибка переноса заявок в архив: {e}")
+            traceback.print_exc()
+        await asyncio.sleep(3600)
+
+# ============ МАССОВЫЕ РЕШЕНИЯ ============
+
+async def send_log_embeds(guild_id, embeds):
+    """Отправляет логи пачками: до 10 embed и 6000 символов в одном сообщении"""
+    config = guild_configs.get(guild_id)
+    logs_channel = await resolve_channel(config.logs_channel_id)
+    if not logs_channel:
+        return
+    chunk, size = [], 0
+    for embed in embeds:
+        if chunk and (len(chunk) == 10 or size + len(embed) > 6000):
+            await logs_channel.send(embeds=chunk)
+            chunk, size = [], 0
+        chunk.append(embed)
+        size += len(embed)
+    if chunk:
+        await logs_channel.send(embeds=chunk)
+
+async def close_decided_channel(application, moderator_id, action_text):
+    """Сообщение о решении и удаление канала заявки; False - канал не удален"""
+    channel = await resolve_channel(application.channel_id)
+    if channel is None:
+        return False
+    try:
+        await channel.send(f"**{action_text} рекрутом <@{moderator_id}>**")
+    except discord.HTTPException:
+        pass
+    return await delete_application_channel(channel, delay_seconds=0, application_id=application.id)
+
+@traced()
+async def bulk_decide_applications(guild_id, application_ids, status, moderator, reason=None):
+    """Принимает или отклоняет несколько заявок одним UPDATE; возвращает итог по каждой.
+    
+    Заявки, которые по действующей аренде рассматривает другой рекрут, пропускаются
+    (то же правило, что у кнопок заявки - check_claim).
+    """
+    async with db_acquire() as conn:
+        async with conn.transaction():
+            # Блокируем строки (по порядку id) так же, как claim_application: пока идет решение,
+            # новую аренду на них не взять
+            await conn.execute('''
+                SELECT 1 FROM applications WHERE id = ANY($1::int[]) ORDER BY id FOR UPDATE
+            ''', application_ids)
+            leased = await conn.fetch('''
+                SELECT application_id, moderator_id FROM application_claims
+                WHERE application_id = ANY($1::int[])
+                  AND lease_until >= CURRENT_TIMESTAMP AND moderator_id <> $2
+            ''', application_ids, moderator.id)
+            leased = {record['application_id']: record['moderator_id'] for record in leased}
+            records = await conn.fetch(f'''
+                WITH decided AS (
+                    UPDATE applications SET
+                        status = $2,
+                        moderator = $3,
+                        reason_reject = $4,
+                        updated_at = CURRENT_TIMESTAMP
+                    WHERE id = ANY($1::int[]) AND status = 'pending' AND {guild_filter_sql(5)}
+                    RETURNING *
+                ), released AS (
+                    DELETE FROM application_claims WHERE application_id IN (SELECT id FROM decided)
+                )
+                SELECT * FROM decided
+            ''', [app_id for app_id in application_ids if app_id not in leased],
+            status, moderator.name, reason, guild_id, MAIN_GUILD_ID)
+            await applications_changed([(record['id'], record['discord_id']) for record in records], conn)
+    decided = [Application.from_record(record) for record in records]
+    results = {
+        app_id: f"🔒 рассматривает <@{leased[app_id]}>" if app_id in leased else "⚠️ уже обработана"
+        for app_id in application_ids
+    }
+    
+    if status == "rejected":
+        for app in decided:
+            submission_limiter.set_reject_cooldown(app.discord_id, app.updated_at)
+    if decided:
+        # ЛС, логи и закрытие каналов - одной сохраняемой задачей (в режиме gateway - у воркеров)
+        await dispatch_job("applications_decided", {
+            "application_ids": [app.id for app in decided],
+            "moderator_id": moderator.id,
+        })
+    for app in decided:
+        results[app.id] = "✅ готово"
+    return decided, results
+
+class BulkDecisionView(discord.ui.View):
+    """Выбор pending заявок для массового решения"""
+    
+    def __init__(self, moderator_id, status, reason, applications):
+        super().__init__(timeout=300)
+        self.moderator_id = moderator_id
+        self.status = status
+        self.reason = reason
+        self.names = {app.id: app.username_static for app in applications}
         
-        view.add_item(approve_button)
-        view.add_item(consider_button)
-        view.add_item(reject_button)
+        self.select = discord.ui.Select(
+            placeholder="Выберите заявки",
+            min_values=1,
+            max_values=len(applications),
+            options=[
+                discord.SelectOption(
+                    label=app.username_static[:100],
+                    description=f"{app.discord_user} • {app.created_at.strftime('%d.%m.%Y %H:%M')}"[:100],
+                    value=str(app.id)
+                )
+                for app in applications
+            ]
+        )
+        self.select.callback = self.select_callback
+        self.add_item(self.select)
         
-        await channel.send(view=view)
+        confirm_button = discord.ui.Button(
+            style=discord.ButtonStyle.green if status == "approved" else discord.ButtonStyle.red,
+            label="Принять выбранные" if status == "approved" else "Отклонить выбранные"
+        )
+        confirm_button.callback = self.confirm_callback
+        self.add_item(confirm_button)
+    
+    async def select_callback(self, interaction: discord.Interaction):
+        await interaction.response.defer()
+    
+    @traced()
+    async def confirm_callback(self, interaction: discord.Interaction):
+        if interaction.user.id != self.moderator_id:
+            await interaction.response.send_message("❌ Это меню открыто другим рекрутом", ephemeral=True)
+            return
+        if not self.select.values:
+            await interaction.response.send_message("❌ Сначала выберите заявки", ephemeral=True)
+            return
+            
+        application_ids = [int(value) for value in self.select.values]
+        await interaction.response.edit_message(content=f"⏳ Обработка заявок: {len(application_ids)}...", view=None)
+        self.stop()
         
-        application.message_id = message.id
-        await save_application(application)
+        decided, results = await bulk_decide_applications(
+            interaction.guild_id, application_ids, self.status, interaction.user, self.reason
+        )
         
-        return message, None
+        embed = render_embed(
+            title=f"{'✅ Принято' if self.status == 'approved' else '❌ Отклонено'} заявок: {len(decided)} из {len(application_ids)}",
+            description="\n".join(
+                f"• **{truncate(self.names.get(app_id, app_id), 60)}** - {result}" for app_id, result in results.items()
+            ),
+            color=discord.Color.green() if self.status == "approved" else discord.Color.red(),
+            timestamp=datetime.now()
+        )
+        await interaction.edit_original_response(content=None, embed=embed)
+
+# ============ СВЕРКА КАНАЛОВ С БД ============
+
+async def channel_exists(guild, channel_id):
+    """Проверяет, что канал существует; при ошибке запроса считается существующим"""
+    if guild.get_channel(int(channel_id)) is not None:
+        return True
+    try:
+        await guild.fetch_channel(int(channel_id))
+        return True
+    except discord.NotFound:
+        return False
     except Exception as e:
-        print(f"Ошибка отправки embed: {e}")
-        raise
+        print(f"Не удалось проверить канал {channel_id}: {e}")
+        return True
+
+async def reconcile_application_channels(guild):
+    """Сверяет каналы в категории заявок с pending-заявками в БД и чинит расхождения"""
+    config = guild_configs.get(guild.id)
+    category = guild.get_channel(config.applications_category_id) if config.applications_category_id else None
+    if not category:
+        return None
+    
+    channels = {str(channel.id): channel for channel in category.text_channels}
+    report = {"linked": [], "stale_deleted": [], "dead_links": [], "unknown_channels": []}
+    
+    async with db_acquire() as conn:
+        # Один запрос: все pending заявки и все заявки, привязанные к каналам категории
+        records = await conn.fetch(f'''
+            SELECT id, discord_id, status, channel_id FROM applications
+            WHERE (status = 'pending' AND {guild_filter_sql(2)}) OR channel_id = ANY($1::text[])
+            ORDER BY created_at DESC
+        ''', list(channels.keys()), guild.id, MAIN_GUILD_ID)
+        
+        by_channel = {}
+        pending_without_channel = {}
+        dead = []
+        for record in records:
+            if record['channel_id'] and record['channel_id'] in channels:
+                by_channel.setdefault(record['channel_id'], record)
+            elif record['status'] == 'pending':
+                if record['channel_id']:
+                    # Канал вне категории (например, перенесен вручную) - ссылка не мертвая
+                    if await channel_exists(guild, record['channel_id']):
+                        continue
+                    dead.append(record['id'])
+                pending_without_channel.setdefault(record['discord_id'], []).append(record)
+                
+        # Каналы без pending заявки: привязываем, удаляем или помечаем
+        relink = []
+        for channel_id, channel in channels.items():
+            record = by_channel.get(channel_id)
+            if record:
+                if record['status'] != 'pending':
+                    report["stale_deleted"].append(channel.name)
+                    supervisor.spawn(
+                        delete_application_channel(channel, delay_seconds=0),
+                        "delete_channel",
+                        persist=("delete_channel", {"channel_id": channel.id})
+                    )
+                continue
+            match = re.search(r'ID: (\d+)', channel.topic or "")
+            candidates = pending_without_channel.get(match.group(1)) if match else None
+            if candidates:
+                record = candidates.pop(0)
+                relink.append((channel_id, record['id']))
+                by_channel[channel_id] = record
+                report["linked"].append(channel.mention)
+            else:
+                report["unknown_channels"].append(channel.mention)
+                
+        if relink:
+            await conn.executemany('UPDATE applications SET channel_id = $1 WHERE id = $2', relink)
+            await applications_changed([(application_id, None) for _, application_id in relink], conn)
+            
+        # Pending заявки, канал которых удален вручную: убираем мертвую ссылку
+        relinked = {application_id for _, application_id in relink}
+        dead = [application_id for application_id in dead if application_id not in relinked]
+        if dead:
+            await conn.execute('UPDATE applications SET channel_id = NULL WHERE id = ANY($1::int[])', dead)
+            await applications_changed([(application_id, None) for application_id in dead], conn)
+            report["dead_links"] = dead
+            
+    return report
 
-async def send_log_to_channel(application, moderator, action, reason=None, guild=None):
-    """Отправляет лог о заявке в канал логов"""
+async def run_startup_reconciliation():
+    """Фоновая сверка каналов заявок при запуске бота"""
     try:
-        logs_channel = bot.get_channel(LOGS_CHANNEL_ID)
-        
-        if not logs_channel:
-            return
-        
-        embed = discord.Embed(
-            title="✅ Заявка принята" if action == "approved" else "❌ Заявка отклонена",
-            color=discord.Color.green() if action == "approved" else discord.Color.red(),
-            timestamp=application.updated_at
-        )
-        
-        embed.add_field(name="Никнейм Статик", value=application.username_static, inline=False)
-        embed.add_field(name="OOC имя возраст", value=application.ooc_info, inline=False)
-        embed.add_field(name="История семей", value=application.fam_history[:500] + "..." if len(application.fam_history) > 500 else application.fam_history, inline=False)
-        
-        if application.reason:
-            embed.add_field(name="Причина выбора", value=application.reason[:500] + "..." if len(application.reason) > 500 else application.reason, inline=False)
-        
-        if application.rollbacks and application.rollbacks != "Не указано":
-            rollbacks_text = application.rollbacks
-            if rollbacks_text.startswith("```") and rollbacks_text.endswith("```"):
-                rollbacks_text = rollbacks_text[3:-3].strip()
-            embed.add_field(name="Откаты с ГГ", value=rollbacks_text[:500] + "..." if len(rollbacks_text) > 500 else rollbacks_text, inline=False)
-        
-        embed.add_field(name="Пользователь", value=f"<@{application.discord_id}>", inline=False)
-        embed.add_field(name="Username", value=application.discord_user, inline=True)
-        embed.add_field(name="ID", value=application.discord_id, inline=True)
-        
-        if action == "approved":
-            embed.add_field(name="Принял", value=f"<@{moderator.id}>", inline=False)
-        elif action == "rejected":
-            embed.add_field(name="Отклонил", value=f"<@{moderator.id}>", inline=False)
-            embed.add_field(name="Причина отказа", value=reason[:500] + "..." if len(reason) > 500 else reason, inline=False)
-        
-        await logs_channel.send(embed=embed)
+        for guild in bot.guilds:
+            report = await reconcile_application_channels(guild)
+            if report is None:
+                continue
+                
+            print(f"✅ Сверка каналов заявок ({guild.name}): "
+                  f"привязано каналов {len(report['linked'])}, "
+                  f"удалено устаревших {len(report['stale_deleted'])}, "
+                  f"мертвых ссылок {len(report['dead_links'])}, "
+                  f"каналов без заявки {len(report['unknown_channels'])}")
+                  
+            lines = []
+            if report["linked"]:
+                lines.append(f"🔗 Привязаны к заявкам: {', '.join(report['linked'])}")
+            if report["stale_deleted"]:
+                lines.append(f"🗑️ Удалены каналы обработанных заявок: {len(report['stale_deleted'])}")
+            if report["dead_links"]:
+                lines.append(f"⚠️ Заявки с удаленным каналом (ID): {', '.join(map(str, report['dead_links']))}")
+            if report["unknown_channels"]:
+                lines.append(f"❓ Каналы без заявки в БД: {', '.join(report['unknown_channels'])}")
+            
+            config = guild_configs.get(guild.id)
+            logs_channel = bot.get_channel(config.logs_channel_id) if config.logs_channel_id else None
+            if lines and logs_channel:
+                await logs_channel.send("**Сверка каналов заявок после запуска**\n" + "\n".join(lines)[:1900])
     except Exception as e:
-        print(f"Ошибка отправки лога: {e}")
+        print(f"❌ Ошибка сверки каналов заявок: {e}")
+        traceback.print_exc()
 
 class ApplicationForm(discord.ui.Modal, title='Подача заявки в семью'):
     """Модальная форма для подачи заявки"""
@@ -678,10 +3903,18 @@ class ApplicationForm(discord.ui.Modal, title='Подача заявки в се
         required=False
     )
     
+    def __init__(self, config=None):
+        config = config or guild_configs.get(None)
+        super().__init__(title=config.form_labels["title"][:45])
+        # Подписи полей берутся из настроек сервера
+        for field in ("nickname_static", "ooc_info", "fam_history", "reason", "rollbacks"):
+            getattr(self, field).label = config.form_labels[field][:45]
+    
+    @traced()
     async def on_submit(self, interaction: discord.Interaction):
         try:
-            user_active_apps = await get_user_applications(str(interaction.user.id))
-            user_active_apps = [app for app in user_active_apps if app.status == "pending"]
+            user_apps = await get_user_applications(str(interaction.user.id), interaction.guild_id)
+            user_active_apps = [app for app in user_apps if app.status == "pending"]
             
             if user_active_apps:
                 await interaction.response.send_message(
@@ -691,39 +3924,46 @@ class ApplicationForm(discord.ui.Modal, title='Подача заявки в се
                 )
                 return
             
-            await interaction.response.defer(ephemeral=True)
-            
-            application = Application(
-                username_static=self.nickname_static.value.strip(),
-                ooc_info=self.ooc_info.value.strip(),
-                fam_history=self.fam_history.value,
-                reason=self.reason.value,
-                rollbacks=self.rollbacks.value if self.rollbacks.value else "Не указано",
-                discord_user=interaction.user.name,
-                discord_id=str(interaction.user.id)
-            )
+            cooldown = submission_limiter.cooldown_left(str(interaction.user.id), user_apps)
+            if cooldown:
+                await interaction.response.send_message(
+                    f"❌ После отказа подать заявку снова можно через {format_wait(cooldown.total_seconds())}",
+                    ephemeral=True
+                )
+                return
             
-            channel = await create_application_channel(interaction.guild, interaction.user.name, interaction.user.id, application)
-            application.channel_id = channel.id
+            await interaction.response.defer(ephemeral=True)
             
-            message, _ = await send_application_embed(channel, application, interaction.user, interaction.guild)
+            if await submission_limiter.acquire_global(interaction.guild_id) is None:
+                await interaction.followup.send(
+                    "❌ Сейчас подается слишком много заявок. Пожалуйста, попробуйте через несколько минут.",
+                    ephemeral=True
+                )
+                return
             
-            await interaction.followup.send(
-                f"✅ Ваша заявка успешно отправлена!\n\n"
-                f"Заявка рассматривается в течение суток.\n"
-                f"Ответ придёт в личные сообщения от бота.\n"
-                f"Для обсуждения заявки создан канал: <#{application.channel_id}>",
-                ephemeral=True
-            )
+            # Канал, embed и ответ пользователю - в задаче (в режиме gateway ее выполнит воркер)
+            await dispatch_job("submit_application", {
+                "guild_id": interaction.guild_id,
+                "discord_user": interaction.user.name,
+                "discord_id": str(interaction.user.id),
+                "form": {
+                    "username_static": self.nickname_static.value.strip(),
+                    "ooc_info": self.ooc_info.value.strip(),
+                    "fam_history": self.fam_history.value,
+                    "reason": self.reason.value,
+                    "rollbacks": self.rollbacks.value.strip() or ROLLBACKS_NOT_SPECIFIED
+                },
+                "interaction": {
+                    "application_id": interaction.application_id,
+                    "token": interaction.token
+                }
+            })
             
         except Exception as e:
             print(f"Ошибка при создании заявки: {e}")
             traceback.print_exc()
             try:
-                await interaction.followup.send(
-                    "❌ Ошибка при создании заявки. Пожалуйста, попробуйте позже.", 
-                    ephemeral=True
-                )
+                await reply_ephemeral(interaction, error_text(e, "❌ Ошибка при создании заявки. Пожалуйста, попробуйте позже."))
             except:
                 pass
     
@@ -738,25 +3978,92 @@ class ApplicationForm(discord.ui.Modal, title='Подача заявки в се
         except:
             pass
 
+class ApplicationButtonView(discord.ui.View):
+    """Постоянная кнопка 'Подать заявку' на панели"""
+    
+    def __init__(self):
+        super().__init__(timeout=None)
+    
+    @discord.ui.button(
+        label="Подать заявку",
+        emoji="<:icons848:1449967782308614244>",
+        style=discord.ButtonStyle.gray,
+        custom_id="apply_button_amnyamov",
+        row=0
+    )
+    @traced()
+    async def apply_button_callback(self, interaction: discord.Interaction, button: discord.ui.Button):
+        discord_id = str(interaction.user.id)
+        cooldown = submission_limiter.cooldown_left(discord_id)
+        if cooldown:
+            await interaction.response.send_message(
+                f"❌ После отказа подать заявку снова можно через {format_wait(cooldown.total_seconds())}",
+                ephemeral=True
+            )
+            return
+        
+        wait = submission_limiter.check_user(discord_id)
+        if wait:
+            await interaction.response.send_message(
+                f"❌ Слишком много попыток. Попробуйте снова через {format_wait(wait)}",
+                ephemeral=True
+            )
+            return
+        
+        await interaction.response.send_modal(ApplicationForm(guild_configs.get(interaction.guild_id)))
+
 @bot.event
 async def on_ready():
     print(f'✅ {bot.user} запущен!')
     print(f'ID бота: {bot.user.id}')
     
+    global startup_done
+    if startup_done:
+        print('Переподключение: повторная инициализация не требуется')
+        return
+    startup_done = True
+    
     await init_database()
+    if db_journal.pending:
+        db_journal.schedule_replay()
+    await guild_configs.load_all()
+    cluster_bus.subscribe('guild_config_changed', guild_configs.on_notify)
+    cluster_bus.subscribe('application_changed', application_cache.on_notify)
+    cluster_bus.subscribe('application_changed', duplicate_index.on_notify)
+    if BOT_MODE == "all":
+        cluster_bus.subscribe('bot_jobs', job_queue.on_notify)
+    await cluster_bus.start()
+    bot.add_view(ApplicationButtonView())
+    bot.add_dynamic_items(ReviewButton)
+    supervisor.spawn(run_startup_reconciliation(), "startup_reconciliation")
+    supervisor.spawn(run_exclusive("links_backfill", backfill_rollback_links), "links_backfill")
+    if BOT_MODE == "all":
+        # Задачи, сохраненные при прошлой остановке, и повторы неудачных задач
+        supervisor.spawn(job_queue.cleanup_loop(), "jobs_cleanup", service=True)
+        supervisor.spawn(job_queue.worker_loop(0), "job_worker")
+    if PENDING_SLA_HOURS > 0:
+        supervisor.spawn(pending_sla_worker(), "pending_sla", service=True)
+    if ARCHIVE_AFTER_DAYS > 0:
+        supervisor.spawn(archive_worker(), "archive", service=True)
     
-    try:
+    async def sync_commands():
         synced = await bot.tree.sync()
         print(f"✅ Синхронизировано {len(synced)} slash-команд")
+    
+    try:
+        # Глобальная синхронизация команд нужна только одному процессу
+        if not await run_exclusive("tree_sync", sync_commands):
+            print("Синхронизация slash-команд выполняется другим процессом")
     except Exception as e:
         print(f"❌ Ошибка синхронизации slash-команд: {e}")
     
     for guild in bot.guilds:
         print(f'Сервер: {guild.name} (ID: {guild.id})')
-        if guild.id == 1003525677640851496:
+        config = guild_configs.get(guild.id)
+        if guild.id == MAIN_GUILD_ID:
             print(f'  → Основной сервер: {guild.name}')
-            print(f'  → Админские роли: {len(TAG_ROLE_IDS)}')
-            print(f'  → Роли для slash-команд: {len(SLASH_COMMAND_ROLE_IDS)}')
+        print(f'  → Админские роли: {len(config.tag_role_ids)}')
+        print(f'  → Роли для slash-команд: {len(config.slash_role_ids)}')
     
     print('Бот готов к работе!')
 
@@ -771,49 +4078,19 @@ async def on_error(event, *args, **kwargs):
     name="заявко",
     description="Создает панель для подачи заявки в семью"
 )
+@traced()
 async def slash_create_application_panel(interaction: discord.Interaction):
     """Slash-команда для создания панели заявки"""
     try:
         if not has_slash_command_permission(interaction):
             await interaction.response.send_message(
                 "❌ У вас нет прав для выполнения этой команды.\n"
-                "Требуется одна из ролей: <@&1310673963000528949> или <@&1381685630555258931>",
+                f"Требуется одна из ролей: {required_roles_text(interaction.guild_id)}",
                 ephemeral=True
             )
             return
         
-        embed = discord.Embed(
-            title="**ЗАЯВКА В СЕМЬЮ**",
-            color=discord.Color.from_rgb(0, 0, 0)
-        )
-        
-        embed.add_field(
-            name="**<a:wave:1449952532129517570> Путь в семью начинается здесь!**\n\u200b",
-            value=(
-                "**<:outputonlinepngtools:1449964820999700721> После заполнения анкеты Вам придет оповещение в ЛС от бота с результатом (ответ не придёт, если закрыт доступ к сообщениям в discord) **\n\n"
-                "-# Заявка рассматривается в течении суток. САЙГИ ОБЯЗАТЕЛЬНЫ."
-            ),
-            inline=False
-        )
-        
-        embed.set_image(url=IMAGE_URL)
-        embed.set_footer(text="Amnyamov famq", icon_url=SMALL_ICON_URL)
-        
-        class ApplicationButtonView(discord.ui.View):
-            def __init__(self):
-                super().__init__(timeout=None)
-            
-            @discord.ui.button(
-                label="Подать заявку",
-                emoji="<:icons848:1449967782308614244>",
-                style=discord.ButtonStyle.gray,
-                custom_id="apply_button_amnyamov",
-                row=0
-            )
-            async def apply_button_callback(self, interaction: discord.Interaction, button: discord.ui.Button):
-                await interaction.response.send_modal(ApplicationForm())
-        
-        await interaction.response.send_message(embed=embed, view=ApplicationButtonView())
+        await interaction.response.send_message(embed=panel_embed(), view=ApplicationButtonView())
         
     except Exception as e:
         print(f"Ошибка команды заявка: {e}")
@@ -824,40 +4101,40 @@ async def slash_create_application_panel(interaction: discord.Interaction):
     name="заявки",
     description="Показать все заявки"
 )
+@traced()
 async def slash_applications_list(interaction: discord.Interaction):
     """Slash-команда для просмотра заявок"""
     try:
         if not has_slash_command_permission(interaction):
             await interaction.response.send_message(
                 "❌ У вас нет прав для выполнения этой команды.\n"
-                "Требуется одна из ролей: <@&1310673963000528949> или <@&1381685630555258931>",
+                f"Требуется одна из ролей: {required_roles_text(interaction.guild_id)}",
                 ephemeral=True
             )
             return
         
-        pending_apps = await get_pending_applications()
-        all_apps = await load_applications()
-        
-        approved_apps = [app for app in all_apps if app.status == "approved"]
-        rejected_apps = [app for app in all_apps if app.status == "rejected"]
-        
-        embed = discord.Embed(
-            title="📋 Активные заявки",
-            color=discord.Color.blue(),
-            timestamp=datetime.now()
-        )
+        pending_apps = await get_pending_applications(interaction.guild_id)
+        counts = await get_status_counts(interaction.guild_id)
         
-        embed.add_field(name="⏳ На рассмотрении", value=str(len(pending_apps)), inline=True)
-        embed.add_field(name="✅ Принято", value=str(len(approved_apps)), inline=True)
-        embed.add_field(name="❌ Отклонено", value=str(len(rejected_apps)), inline=True)
+        fields = [
+            field("⏳ На рассмотрении", len(pending_apps), inline=True),
+            field("✅ Принято", counts.get("approved", 0), inline=True),
+            field("❌ Отклонено", counts.get("rejected", 0), inline=True),
+        ]
         
         if pending_apps:
             apps_text = ""
             for app in pending_apps[:5]:
                 channel_info = f"<#{app.channel_id}>" if app.channel_id else "Канал не создан"
-                apps_text += f"• **{app.username_static}** - {channel_info}\n"
-            embed.add_field(name="Последние заявки:", value=apps_text, inline=False)
+                apps_text += f"• **{truncate(app.username_static, 100)}** - {channel_info}\n"
+            fields.append(field("Последние заявки:", apps_text))
         
+        embed = render_embed(
+            title="📋 Активные заявки",
+            color=discord.Color.blue(),
+            timestamp=datetime.now(),
+            fields=fields
+        )
         await interaction.response.send_message(embed=embed)
     except Exception as e:
         print(f"Ошибка команды заявки: {e}")
@@ -868,20 +4145,22 @@ async def slash_applications_list(interaction: discord.Interaction):
     name="очистка",
     description="Очистка старых каналов с заявками"
 )
+@traced()
 async def slash_cleanup_channels(interaction: discord.Interaction):
     """Slash-команда для очистки каналов"""
     try:
         if not has_slash_command_permission(interaction):
             await interaction.response.send_message(
                 "❌ У вас нет прав для выполнения этой команды.\n"
-                "Требуется одна из ролей: <@&1310673963000528949> или <@&1381685630555258931>",
+                f"Требуется одна из ролей: {required_roles_text(interaction.guild_id)}",
                 ephemeral=True
             )
             return
         
         await interaction.response.defer()
         
-        category = interaction.guild.get_channel(APPLICATIONS_CATEGORY_ID)
+        config = guild_configs.get(interaction.guild_id)
+        category = interaction.guild.get_channel(config.applications_category_id) if config.applications_category_id else None
         
         if not category:
             await interaction.followup.send("Категория заявок не найдена.")
@@ -892,11 +4171,8 @@ async def slash_cleanup_channels(interaction: discord.Interaction):
             if hasattr(channel, 'created_at'):
                 age = datetime.now() - channel.created_at.replace(tzinfo=None)
                 if age.days > 30:
-                    try:
-                        await channel.delete(reason="Очистка старых заявок")
+                    if await delete_application_channel(channel, delay_seconds=0, reason="Очистка старых заявок"):
                         deleted += 1
-                    except:
-                        pass
         
         await interaction.followup.send(f"✅ Удалено {deleted} старых каналов с заявками.")
     except Exception as e:
@@ -911,13 +4187,14 @@ async def slash_cleanup_channels(interaction: discord.Interaction):
 @app_commands.describe(
     пользователь="Пользователь для проверки (оставьте пустым для себя)"
 )
+@traced()
 async def slash_application_status(interaction: discord.Interaction, пользователь: discord.User = None):
     """Slash-команда для проверки статуса заявки"""
     try:
         if not has_slash_command_permission(interaction):
             await interaction.response.send_message(
                 "❌ У вас нет прав для выполнения этой команды.\n"
-                "Требуется одна из ролей: <@&1310673963000528949> или <@&1381685630555258931>",
+                f"Требуется одна из ролей: {required_roles_text(interaction.guild_id)}",
                 ephemeral=True
             )
             return
@@ -929,38 +4206,36 @@ async def slash_application_status(interaction: discord.Interaction, польз
             discord_id = str(пользователь.id)
             user_mention = f"<@{discord_id}>"
         
-        user_apps = await get_user_applications(discord_id)
+        user_apps = await get_user_applications(discord_id, interaction.guild_id, include_archive=True)
         
         if not user_apps:
             await interaction.response.send_message("Заявок не найдено.")
             return
         
-        embed = discord.Embed(
-            title=f"Заявки пользователя {user_mention}",
-            color=discord.Color.blue(),
-            timestamp=datetime.now()
-        )
-        
+        fields = []
         for i, app in enumerate(user_apps[:3], 1):
-            status_emoji = "⏳" if app.status == "pending" else "✅" if app.status == "approved" else "❌"
-            status_text = "На рассмотрении" if app.status == "pending" else "Принята" if app.status == "approved" else "Отклонена"
-            
-            app_info = f"**Статус:** {status_emoji} {status_text}\n"
-            app_info += f"**Никнейм и статик:** {app.username_static}\n"
+            app_info = f"**Статус:** {render_status_line(app.status)}\n"
+            app_info += f"**Никнейм и статик:** {truncate(app.username_static, 200)}\n"
             
             if app.channel_id:
                 app_info += f"**Канал:** <#{app.channel_id}>\n"
             
             if app.status == "rejected" and app.reason_reject:
-                app_info += f"**Причина отказа:** {app.reason_reject[:100]}...\n"
+                app_info += f"**Причина отказа:** {truncate(app.reason_reject, 100)}\n"
             
             if app.status == "approved" and app.moderator:
                 app_info += f"**Принял:** <@{next((m.id for m in interaction.guild.members if m.name == app.moderator), app.moderator)}>\n"
             
             app_info += f"**Дата:** {app.created_at.strftime('%d.%m.%Y %H:%M')}"
             
-            embed.add_field(name=f"Заявка #{i}", value=app_info, inline=False)
+            fields.append(field(f"Заявка #{i}", app_info))
         
+        embed = render_embed(
+            title=f"Заявки пользователя {user_mention}",
+            color=discord.Color.blue(),
+            timestamp=datetime.now(),
+            fields=fields
+        )
         await interaction.response.send_message(embed=embed)
     except Exception as e:
         print(f"Ошибка команды статус: {e}")
@@ -974,19 +4249,21 @@ async def slash_application_status(interaction: discord.Interaction, польз
 @app_commands.describe(
     канал="Канал для удаления (оставьте пустым для текущего канала)"
 )
+@traced()
 async def slash_delete_channel_manual(interaction: discord.Interaction, канал: discord.TextChannel = None):
     """Slash-команда для удаления канала"""
     try:
         if not has_slash_command_permission(interaction):
             await interaction.response.send_message(
                 "❌ У вас нет прав для выполнения этой команды.\n"
-                "Требуется одна из ролей: <@&1310673963000528949> или <@&1381685630555258931>",
+                f"Требуется одна из ролей: {required_roles_text(interaction.guild_id)}",
                 ephemeral=True
             )
             return
         
         if канал is None:
-            category = interaction.guild.get_channel(APPLICATIONS_CATEGORY_ID)
+            config = guild_configs.get(interaction.guild_id)
+            category = interaction.guild.get_channel(config.applications_category_id) if config.applications_category_id else None
             
             if category and interaction.channel.category_id == category.id:
                 channel = interaction.channel
@@ -999,29 +4276,414 @@ async def slash_delete_channel_manual(interaction: discord.Interaction, кана
         else:
             channel = канал
         
-        await channel.delete(reason="Ручное удаление администратором")
-        await interaction.response.send_message(f"✅ Канал {channel.name} удален.", ephemeral=True)
+        # Переписка сохраняется перед удалением, это может занять больше 3 секунд
+        await interaction.response.defer(ephemeral=True)
+        if not await delete_application_channel(channel, delay_seconds=0, reason="Ручное удаление администратором"):
+            await interaction.followup.send("❌ Ошибка при удалении канала.", ephemeral=True)
+            return
+        try:
+            await interaction.followup.send(f"✅ Канал {channel.name} удален.", ephemeral=True)
+        except discord.HTTPException:
+            pass
     except Exception as e:
         print(f"Ошибка команды удалить_канал: {e}")
         traceback.print_exc()
-        await interaction.response.send_message(f"❌ Ошибка при удалении канала: {str(e)}", ephemeral=True)
+        if interaction.response.is_done():
+            await interaction.followup.send(f"❌ Ошибка при удалении канала: {str(e)}", ephemeral=True)
+        else:
+            await interaction.response.send_message(f"❌ Ошибка при удалении канала: {str(e)}", ephemeral=True)
+
+@bot.tree.command(
+    name="транскрипт",
+    description="Получить сохраненную переписку канала заявки"
+)
+@app_commands.describe(
+    заявка="ID заявки"
+)
+@traced()
+async def slash_application_transcript(interaction: discord.Interaction, заявка: int):
+    """Slash-команда для выгрузки архива переписки"""
+    try:
+        if not has_slash_command_permission(interaction):
+            await interaction.response.send_message(
+                "❌ У вас нет прав для выполнения этой команды.\n"
+                f"Требуется одна из ролей: {required_roles_text(interaction.guild_id)}",
+                ephemeral=True
+            )
+            return
+        
+        application = await get_application_by_id(заявка)
+        if not application or (application.guild_id or MAIN_GUILD_ID) != interaction.guild_id:
+            await interaction.response.send_message("Заявка не найдена.", ephemeral=True)
+            return
+        
+        transcript = await load_transcript(заявка)
+        if not transcript:
+            await interaction.response.send_message("Переписка по этой заявке не сохранена.", ephemeral=True)
+            return
+        
+        filename, data = transcript
+        await interaction.response.send_message(
+            f"Переписка по заявке **{application.username_static}**",
+            file=discord.File(io.BytesIO(data), filename=filename),
+            ephemeral=True
+        )
+    except Exception as e:
+        print(f"Ошибка команды транскрипт: {e}")
+        traceback.print_exc()
+        await interaction.response.send_message("❌ Произошла ошибка при получении переписки.", ephemeral=True)
+
+@bot.tree.command(
+    name="экспорт",
+    description="Выгрузить все заявки сервера в файл"
+)
+@app_commands.describe(
+    формат="Формат файла"
+)
+@app_commands.choices(
+    формат=[
+        app_commands.Choice(name="JSONL", value="jsonl"),
+        app_commands.Choice(name="CSV", value="csv"),
+    ]
+)
+@traced()
+async def slash_export_applications(interaction: discord.Interaction, формат: app_commands.Choice[str] = None):
+    """Slash-команда для выгрузки заявок"""
+    try:
+        if not has_slash_command_permission(interaction):
+            await interaction.response.send_message(
+                "❌ У вас нет прав для выполнения этой команды.\n"
+                f"Требуется одна из ролей: {required_roles_text(interaction.guild_id)}",
+                ephemeral=True
+            )
+            return
+        
+        await interaction.response.defer(ephemeral=True)
+        
+        fmt = формат.value if формат else "jsonl"
+        filename = f"applications-{datetime.now().strftime('%Y%m%d-%H%M')}.{fmt}.gz"
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, filename)
+            # Открытие и закрытие gzip (сброс сжатого хвоста) - тоже вне цикла событий
+            file = await asyncio.to_thread(open_export_file, path, "w")
+            try:
+                count = await export_applications(file, fmt, interaction.guild_id)
+            finally:
+                await asyncio.to_thread(file.close)
+            
+            if os.path.getsize(path) > interaction.guild.filesize_limit:
+                await interaction.followup.send(
+                    f"❌ Файл выгрузки ({count} заявок) слишком большой для Discord. "
+                    f"Используйте `python zayavkabot.py export`.",
+                    ephemeral=True
+                )
+                return
+            
+            await interaction.followup.send(
+                f"✅ Выгружено заявок: {count}",
+                file=discord.File(path, filename=filename),
+                ephemeral=True
+            )
+    except Exception as e:
+        print(f"Ошибка команды экспорт: {e}")
+        traceback.print_exc()
+        await interaction.followup.send("❌ Произошла ошибка при выгрузке заявок.", ephemeral=True)
+
+@bot.tree.command(
+    name="массово",
+    description="Принять или отклонить несколько заявок сразу"
+)
+@app_commands.describe(
+    решение="Что сделать с выбранными заявками",
+    причина="Причина отказа (обязательна при отклонении)"
+)
+@app_commands.choices(
+    решение=[
+        app_commands.Choice(name="Принять", value="approved"),
+        app_commands.Choice(name="Отклонить", value="rejected"),
+    ]
+)
+@traced()
+async def slash_bulk_decision(interaction: discord.Interaction, решение: app_commands.Choice[str], причина: str = None):
+    """Slash-команда для массового решения по заявкам"""
+    try:
+        if not has_slash_command_permission(interaction):
+            await interaction.response.send_message(
+                "❌ У вас нет прав для выполнения этой команды.\n"
+                f"Требуется одна из ролей: {required_roles_text(interaction.guild_id)}",
+                ephemeral=True
+            )
+            return
+        
+        if решение.value == "rejected" and not причина:
+            await interaction.response.send_message("❌ Укажите причину отказа.", ephemeral=True)
+            return
+        
+        pending = await get_pending_applications(interaction.guild_id)
+        if not pending:
+            await interaction.response.send_message("Нет заявок на рассмотрении.", ephemeral=True)
+            return
+        
+        # В выпадающем списке Discord не больше 25 вариантов
+        shown = pending[:25]
+        text = f"Выберите заявки ({len(shown)} из {len(pending)}) и нажмите кнопку."
+        await interaction.response.send_message(
+            text,
+            view=BulkDecisionView(
+                interaction.user.id, решение.value, причина if решение.value == "rejected" else None, shown
+            ),
+            ephemeral=True
+        )
+    except Exception as e:
+        print(f"Ошибка команды массово: {e}")
+        traceback.print_exc()
+        await interaction.response.send_message("❌ Произошла ошибка при получении заявок.", ephemeral=True)
+
+@bot.tree.command(
+    name="очередь",
+    description="Взять на рассмотрение следующую свободную заявку"
+)
+@traced()
+async def slash_review_queue(interaction: discord.Interaction):
+    """Slash-команда: выдает рекруту самую старую незанятую заявку"""
+    try:
+        if not has_admin_permission(interaction.user):
+            await interaction.response.send_message("❌ У вас нет прав для этого действия", ephemeral=True)
+            return
+        
+        await interaction.response.defer(ephemeral=True)
+        
+        application_id, already_claimed = await claim_next_application(interaction.guild_id, interaction.user)
+        if not application_id:
+            await interaction.followup.send("✅ Свободных заявок нет.", ephemeral=True)
+            return
+        
+        application = await get_application_by_id(application_id)
+        channel = await resolve_channel(application.channel_id)
+        where = channel.mention if channel else "канал не найден"
+        
+        if already_claimed:
+            await interaction.followup.send(
+                f"ℹ️ Сначала закончите текущую заявку: **{application.username_static}** ({where})",
+                ephemeral=True
+            )
+            return
+        
+        if channel:
+            await channel.send(
+                f"**Заявка взята на рассмотрение рекрутом <@{interaction.user.id}>** (из очереди)"
+            )
+        await interaction.followup.send(
+            f"📋 Ваша заявка: **{application.username_static}** от <@{application.discord_id}> ({where})\n"
+            f"Закреплена за вами на {CLAIM_LEASE_MINUTES} мин.",
+            ephemeral=True
+        )
+    except Exception as e:
+        print(f"Ошибка команды очередь: {e}")
+        traceback.print_exc()
+        await interaction.followup.send("❌ Произошла ошибка при выдаче заявки.", ephemeral=True)
+
+@bot.tree.command(
+    name="клип",
+    description="Найти заявки, в которых уже присылали это видео"
+)
+@app_commands.describe(
+    ссылка="Ссылка на видео (YouTube, Twitch и др.)"
+)
+@traced()
+async def slash_find_clip(interaction: discord.Interaction, ссылка: str):
+    """Slash-команда поиска повторно используемых откатов"""
+    try:
+        if not has_slash_command_permission(interaction):
+            await interaction.response.send_message(
+                "❌ У вас нет прав для выполнения этой команды.\n"
+                f"Требуется одна из ролей: {required_roles_text(interaction.guild_id)}",
+                ephemeral=True
+            )
+            return
+        
+        links = extract_rollback_links(ссылка)
+        if not links:
+            await interaction.response.send_message("❌ Не удалось распознать ссылку.", ephemeral=True)
+            return
+        
+        records = await find_reused_links(links, interaction.guild_id)
+        if not records:
+            await interaction.response.send_message("Это видео не встречается в заявках.", ephemeral=True)
+            return
+        
+        lines = [
+            f"{STATUS_LABELS.get(record['status'], ('•',))[0]} **{truncate(record['username_static'], 40)}** - <@{record['discord_id']}> "
+            f"(заявка #{record['application_id']}, {record['created_at'].strftime('%d.%m.%Y')})"
+            for record in records
+        ]
+        embed = render_embed(
+            title=f"Заявки с этим видео: {len(records)}",
+            description="\n".join(lines),
+            color=discord.Color.orange()
+        )
+        await interaction.response.send_message(embed=embed, ephemeral=True)
+    except Exception as e:
+        print(f"Ошибка команды клип: {e}")
+        traceback.print_exc()
+        await interaction.response.send_message("❌ Произошла ошибка при поиске.", ephemeral=True)
+
+@bot.tree.command(
+    name="профиль",
+    description="Самые медленные из последних взаимодействий и задач"
+)
+@app_commands.describe(
+    количество="Сколько трасс показать"
+)
+@traced()
+async def slash_slowest_traces(interaction: discord.Interaction, количество: app_commands.Range[int, 1, 10] = 5):
+    """Slash-команда для просмотра медленных трасс"""
+    try:
+        if not has_slash_command_permission(interaction):
+            await interaction.response.send_message(
+                "❌ У вас нет прав для выполнения этой команды.\n"
+                f"Требуется одна из ролей: {required_roles_text(interaction.guild_id)}",
+                ephemeral=True
+            )
+            return
+        
+        traces = trace_recorder.slowest(количество)
+        if not traces:
+            await interaction.response.send_message("Трасс пока нет.", ephemeral=True)
+            return
+        
+        embed = render_embed(
+            title=f"🐢 Самые медленные трассы (из последних {len(trace_recorder.recent)})",
+            description=(
+                f"Всего трасс: {trace_recorder.stats['traces']}, "
+                f"профилировано: {trace_recorder.stats['profiled']} (доля {PROFILE_SAMPLE_RATE})"
+            ),
+            color=discord.Color.orange(),
+            fields=[
+                field(
+                    f"{trace.name} • {trace.duration * 1000:.0f} мс • {trace.started_at.strftime('%H:%M:%S')} • #{trace.trace_id}",
+                    lambda size, trace=trace: truncate(TraceRecorder.format_trace(trace), size)
+                )
+                for trace in traces
+            ]
+        )
+        await interaction.response.send_message(embed=embed, ephemeral=True)
+    except Exception as e:
+        print(f"Ошибка команды профиль: {e}")
+        traceback.print_exc()
+        await interaction.response.send_message("❌ Произошла ошибка при получении трасс.", ephemeral=True)
+
+@bot.tree.command(
+    name="настройка",
+    description="Настройки системы заявок для этого сервера"
+)
+@app_commands.describe(
+    канал_логов="Канал для логов принятых и отклоненных заявок",
+    категория="Категория для каналов заявок",
+    роль="Роль, которую нужно добавить или убрать из списка",
+    список_ролей="Список, в котором переключается роль",
+    шаблон_канала="Шаблон названия канала заявки, {name} - имя пользователя",
+    поле_формы="Поле формы, подпись которого нужно изменить",
+    подпись="Новая подпись поля формы"
+)
+@app_commands.choices(
+    список_ролей=[
+        app_commands.Choice(name="Рекруты (тег и кнопки)", value="tag"),
+        app_commands.Choice(name="Slash-команды", value="slash"),
+    ],
+    поле_формы=[app_commands.Choice(name=label[:100], value=field) for field, label in DEFAULT_FORM_LABELS.items()]
+)
+@traced()
+async def slash_guild_settings(interaction: discord.Interaction,
+                               канал_логов: discord.TextChannel = None,
+                               категория: discord.CategoryChannel = None,
+                               роль: discord.Role = None,
+                               список_ролей: app_commands.Choice[str] = None,
+                               шаблон_канала: str = None,
+                               поле_формы: app_commands.Choice[str] = None,
+                               подпись: str = None):
+    """Slash-команда для настройки сервера"""
+    try:
+        if not (has_slash_command_permission(interaction) or interaction.user.guild_permissions.administrator):
+            await interaction.response.send_message(
+                "❌ У вас нет прав для выполнения этой команды.\n"
+                f"Требуется одна из ролей: {required_roles_text(interaction.guild_id)}",
+                ephemeral=True
+            )
+            return
+        
+        current = guild_configs.get(interaction.guild_id)
+        tag_role_ids = list(current.tag_role_ids)
+        slash_role_ids = list(current.slash_role_ids)
+        form_labels = dict(current.form_labels)
+        
+        if роль and список_ролей:
+            role_ids = tag_role_ids if список_ролей.value == "tag" else slash_role_ids
+            if роль.id in role_ids:
+                role_ids.remove(роль.id)
+            else:
+                role_ids.append(роль.id)
+        
+        if поле_формы and подпись:
+            form_labels[поле_формы.value] = подпись[:45]
+        
+        config = GuildConfig(
+            guild_id=interaction.guild_id,
+            logs_channel_id=канал_логов.id if канал_логов else current.logs_channel_id,
+            applications_category_id=категория.id if категория else current.applications_category_id,
+            tag_role_ids=tag_role_ids,
+            slash_role_ids=slash_role_ids,
+            form_labels=form_labels,
+            channel_name_template=шаблон_канала or current.channel_name_template
+        )
+        
+        changed = any([канал_логов, категория, роль and список_ролей, шаблон_канала, поле_формы and подпись])
+        if changed:
+            await guild_configs.save(config)
+        
+        embed = render_embed(
+            title="⚙️ Настройки заявок" + (" (сохранено)" if changed else ""),
+            color=discord.Color.blue(),
+            timestamp=datetime.now(),
+            fields=[
+                field("Канал логов", f"<#{config.logs_channel_id}>" if config.logs_channel_id else "Не задан"),
+                field("Категория заявок", f"<#{config.applications_category_id}>" if config.applications_category_id else "Не задана"),
+                field("Рекруты", " ".join(f"<@&{r}>" for r in config.tag_role_ids) or "Нет"),
+                field("Slash-команды", " ".join(f"<@&{r}>" for r in config.slash_role_ids) or "Администраторы"),
+                field("Шаблон канала", f"`{config.channel_name_template}`"),
+                field("Заголовок формы", config.form_labels["title"]),
+            ]
+        )
+        
+        await interaction.response.send_message(embed=embed, ephemeral=True)
+    except Exception as e:
+        print(f"Ошибка команды настройка: {e}")
+        traceback.print_exc()
+        await interaction.response.send_message("❌ Произошла ошибка при сохранении настроек.", ephemeral=True)
 
 @bot.tree.command(
     name="тест",
     description="Тестовая команда для проверки работы бота"
 )
+@traced()
 async def slash_test_command(interaction: discord.Interaction):
     """Slash-команда для теста"""
     try:
         if not has_slash_command_permission(interaction):
             await interaction.response.send_message(
                 "❌ У вас нет прав для выполнения этой команды.\n"
-                "Требуется одна из ролей: <@&1310673963000528949> или <@&1381685630555258931>",
+                f"Требуется одна из ролей: {required_roles_text(interaction.guild_id)}",
                 ephemeral=True
             )
             return
         
-        await interaction.response.send_message(f"✅ Бот работает! Пинг: {round(bot.latency * 1000)}мс")
+        await interaction.response.send_message(
+            f"✅ Бот работает! Пинг: {round(bot.latency * 1000)}мс\n"
+            f"Лимиты заявок: {submission_limiter.format_metrics()}\n"
+            f"Фоновые задачи: {supervisor.format_metrics()}\n"
+            f"БД: {db_metrics.format_metrics()}\n"
+            f"Кэш заявок: {application_cache.format_metrics()}"
+        )
     except Exception as e:
         print(f"Ошибка команды тест: {e}")
         traceback.print_exc()
@@ -1029,38 +4691,51 @@ async def slash_test_command(interaction: discord.Interaction):
 
 # ============ КОМАНДЫ С ПРЕФИКСОМ ! ============
 
+def legacy_command_check(ctx):
+    """Проверка ролей для команд с префиксом по настройкам сервера"""
+    if ctx.guild is None:
+        raise commands.NoPrivateMessage()
+    config = guild_configs.get(ctx.guild.id)
+    if not config.slash_role_set:
+        # Роли не настроены: как и для slash-команд, доступ только администраторам
+        if not ctx.author.guild_permissions.administrator:
+            raise commands.MissingPermissions(["administrator"])
+    elif not any(role.id in config.slash_role_set for role in ctx.author.roles):
+        raise commands.MissingAnyRole(list(config.slash_role_ids))
+    return True
+
 @bot.command(name="заявко")
-@commands.has_any_role(*SLASH_COMMAND_ROLE_IDS)
+@commands.check(legacy_command_check)
 async def legacy_create_application_panel(ctx):
     """Старая команда для создания панели заявки"""
     await ctx.send("⚠️ Эта команда устарела. Пожалуйста, используйте slash-команду `/заявко`")
 
 @bot.command(name="заявки")
-@commands.has_any_role(*SLASH_COMMAND_ROLE_IDS)
+@commands.check(legacy_command_check)
 async def legacy_applications_list(ctx):
     """Старая команда для просмотра заявок"""
     await ctx.send("⚠️ Эта команда устарела. Пожалуйста, используйте slash-команду `/заявки`")
 
 @bot.command(name="очистка")
-@commands.has_any_role(*SLASH_COMMAND_ROLE_IDS)
+@commands.check(legacy_command_check)
 async def legacy_cleanup_channels(ctx):
     """Старая команда для очистки каналов"""
     await ctx.send("⚠️ Эта команда устарела. Пожалуйста, используйте slash-команду `/очистка`")
 
 @bot.command(name="статус")
-@commands.has_any_role(*SLASH_COMMAND_ROLE_IDS)
+@commands.check(legacy_command_check)
 async def legacy_application_status(ctx, discord_id: str = None):
     """Старая команда для проверки статуса"""
     await ctx.send("⚠️ Эта команда устарела. Пожалуйста, используйте slash-команду `/статус`")
 
 @bot.command(name="удалить_канал")
-@commands.has_any_role(*SLASH_COMMAND_ROLE_IDS)
+@commands.check(legacy_command_check)
 async def legacy_delete_channel_manual(ctx, channel_id: str = None):
     """Старая команда для удаления канала"""
     await ctx.send("⚠️ Эта команда устарела. Пожалуйста, используйте slash-команду `/удалить_канал`")
 
 @bot.command(name="тест")
-@commands.has_any_role(*SLASH_COMMAND_ROLE_IDS)
+@commands.check(legacy_command_check)
 async def legacy_test_command(ctx):
     """Старая тестовая команда"""
     await ctx.send("⚠️ Эта команда устарела. Пожалуйста, используйте slash-команду `/тест`")
@@ -1081,18 +4756,26 @@ async def on_command_error(ctx, error):
 
 @bot.event
 async def on_disconnect():
+    if supervisor.closing:
+        return
     print("Бот отключился. Пытаюсь переподключиться...")
 
 # Запуск бота
-if __name__ == "__main__":
+if __name__ == "__main__" and CLI_MODE:
+    asyncio.run(run_cli(sys.argv[1:]))
+elif __name__ == "__main__":
     print("=" * 50)
     print("Запуск Discord бота для системы заявок")
     print(f"Токен получен: {'Да' if TOKEN else 'Нет'}")
     print(f"Database URL получен: {'Да' if DATABASE_URL else 'Нет'}")
+    print(f"Режим: {BOT_MODE}")
     print("=" * 50)
     
     try:
-        bot.run(TOKEN)
+        if BOT_MODE == "worker":
+            asyncio.run(run_job_worker())
+        else:
+            asyncio.run(run_bot())
     except Exception as e:
         print(f"Критическая ошибка при запуске бота: {e}")
         traceback.print_exc()